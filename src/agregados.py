@@ -0,0 +1,281 @@
+import os
+import time
+from redis import ResponseError
+import ingesta
+import comandos
+
+# ---------------------------------------------------------------------------------------------------
+# Agregados y reglas de compactación de RedisTimeSeries
+# ---------------------------------------------------------------------------------------------------
+# Al arrancar se crean series compactadas de la serie original (por ejemplo la media, el mínimo y el
+# máximo por minuto, hora y día) con TS.CREATERULE, de modo que Redis las mantiene al insertar.
+# Las consultas de /agregar sobre rangos largos leen estas series ya agregadas en lugar de recorrer
+# todas las muestras originales.
+#
+# Las claves compactadas llevan el nombre de la serie original entre llaves ({mediciones}:avg:1h) para
+# que en modo CLUSTER caigan en el mismo hash slot que la original, requisito de TS.CREATERULE.
+
+# Tamaños de bucket de las compactaciones, nombre:milisegundos
+COMPACTACIONES = os.getenv('COMPACTACIONES', '1m:60000,1h:3600000,1d:86400000')
+# Funciones de agregación que se compactan
+FUNCIONES_COMPACTADAS = os.getenv('FUNCIONES_COMPACTADAS', 'avg,min,max')
+# Retención de las series compactadas por tamaño de bucket, nombre:milisegundos (por ejemplo
+# '1m:2592000000,1h:31536000000'); los buckets que no aparecen se conservan sin límite
+RETENCION_COMPACTADAS = os.getenv('RETENCION_COMPACTADAS', '')
+
+FUNCIONES = ("avg", "min", "max", "sum", "count", "first", "last", "range", "std.p", "std.s", "var.p", "var.s")
+
+# Funciones que se pueden volver a agregar sobre buckets mayores sin perder exactitud: para cada una,
+# la función de la regla cuya serie compactada se lee, la función que se aplica al leerla y cómo se
+# combinan dos valores del mismo bucket (el número de muestras es la suma de los 'count' compactados)
+REAGREGABLES = {
+    "min": ("min", "min", min),
+    "max": ("max", "max", max),
+    "sum": ("sum", "sum", lambda a, b: a + b),
+    "count": ("count", "sum", lambda a, b: a + b),
+}
+
+
+class ParametroInvalido(ValueError):
+    pass
+
+
+def buckets_configurados():
+    buckets = {}
+    for elemento in COMPACTACIONES.split(","):
+        nombre, ms = elemento.strip().split(":")
+        buckets[nombre] = int(ms)
+    return buckets
+
+
+def retenciones_configuradas():
+    retenciones = {}
+    for elemento in RETENCION_COMPACTADAS.split(","):
+        if elemento.strip():
+            nombre, ms = elemento.strip().split(":")
+            retenciones[nombre] = int(ms)
+    return retenciones
+
+
+def retencion(bucket_ms):
+    # RETENTION de la serie compactada con buckets de bucket_ms
+    retenciones = retenciones_configuradas()
+    for nombre, ms in buckets_configurados().items():
+        if ms == bucket_ms:
+            return retenciones.get(nombre, 0)
+    return 0
+
+
+def funciones_configuradas():
+    return [f.strip() for f in FUNCIONES_COMPACTADAS.split(",") if f.strip()]
+
+
+def clave_derivada(clave, sufijo):
+    # Clave de una serie derivada de 'clave' que cae en su mismo hash slot
+    if "{" in clave and "}" in clave:
+        return f"{clave}:{sufijo}"
+    return f"{{{clave}}}:{sufijo}"
+
+
+def clave_compactacion(clave, funcion, nombre_bucket):
+    return clave_derivada(clave, f"{funcion}:{nombre_bucket}")
+
+
+def reglas(clave):
+    # Lista de (función, nombre del bucket, milisegundos, clave compactada) configuradas para la serie
+    return [
+        (funcion, nombre, ms, clave_compactacion(clave, funcion, nombre))
+        for funcion in funciones_configuradas()
+        for nombre, ms in buckets_configurados().items()
+    ]
+
+
+def _pasos_rellenar_historico(clave, destino, funcion, bucket_ms):
+    # La regla solo agrega las muestras que llegan después de crearla: calculamos los buckets ya
+    # cerrados del histórico a partir de la serie original y los escribimos en la compactada
+    agregados = yield comando_historico(clave, funcion, bucket_ms)
+    for argumentos in comandos_madd(destino, agregados):
+        yield argumentos
+
+
+def _inicio_bucket_actual(bucket_ms):
+    return int(time.time() * 1000) // bucket_ms * bucket_ms
+
+
+def comando_historico(clave, funcion, bucket_ms):
+    # TS.RANGE que agrega los buckets ya cerrados de la serie original
+    return ['TS.RANGE', clave, '-', max(_inicio_bucket_actual(bucket_ms) - 1, 0), 'AGGREGATION', funcion, bucket_ms]
+
+
+def comandos_madd(destino, muestras):
+    # Comandos TS.MADD (en trozos) que escriben las muestras en la serie destino
+    for inicio in range(0, len(muestras), ingesta.TAM_TROZO_MADD):
+        argumentos = ['TS.MADD']
+        for t, v in muestras[inicio:inicio + ingesta.TAM_TROZO_MADD]:
+            argumentos += [destino, t, v]
+        yield argumentos
+
+
+def pasos_asegurar_compactaciones(clave):
+    # Crea (si no existen) la serie original, las series compactadas y sus reglas
+    yield from ingesta.pasos_asegurar_serie(clave)
+    for funcion, _, bucket_ms, destino in reglas(clave):
+        if (yield ['EXISTS', destino]):
+            continue
+        try:
+            yield comando_crear_compactada(clave, destino, funcion, bucket_ms)
+        except ResponseError as e:
+            # Otra réplica la está creando a la vez
+            if "already exists" in str(e):
+                continue
+            raise
+        yield comando_regla(clave, destino, funcion, bucket_ms)
+        yield from _pasos_rellenar_historico(clave, destino, funcion, bucket_ms)
+
+
+def asegurar_compactaciones(redis, clave):
+    comandos.ejecutar(redis, pasos_asegurar_compactaciones(clave))
+
+
+def comando_crear_compactada(clave, destino, funcion, bucket_ms):
+    return ['TS.CREATE', destino, 'RETENTION', retencion(bucket_ms),
+            'LABELS', 'origen', clave, 'agregacion', funcion, 'bucket', bucket_ms]
+
+
+def comando_regla(clave, destino, funcion, bucket_ms):
+    return ['TS.CREATERULE', clave, destino, 'AGGREGATION', funcion, bucket_ms]
+
+
+def claves_compactadas(clave):
+    return [destino for _, _, _, destino in reglas(clave)]
+
+
+def leer_parametros(args):
+    funcion = args.get("funcion", "avg")
+    if funcion not in FUNCIONES:
+        raise ParametroInvalido(f"'funcion' debe ser una de {', '.join(FUNCIONES)}")
+    bucket = args.get("bucket", "1h")
+    buckets = buckets_configurados()
+    if bucket in buckets:
+        bucket_ms = buckets[bucket]
+    else:
+        try:
+            bucket_ms = int(bucket)
+        except ValueError:
+            raise ParametroInvalido(f"'bucket' debe ser uno de {', '.join(buckets)} o un número de milisegundos")
+        if bucket_ms <= 0:
+            raise ParametroInvalido("'bucket' debe ser mayor que 0")
+    desde = args.get("desde", '-')
+    hasta = args.get("hasta", '+')
+    for nombre, valor in (("desde", desde), ("hasta", hasta)):
+        if valor not in ('-', '+') and not valor.isdigit():
+            raise ParametroInvalido(f"'{nombre}' debe ser un timestamp en milisegundos")
+    formato = args.get("formato", "json")
+    if formato not in ("json", "csv"):
+        raise ParametroInvalido("'formato' debe ser 'json' o 'csv'")
+    return funcion, bucket_ms, desde, hasta, formato
+
+
+def _elegir_origen(clave, funcion, bucket_ms):
+    # Devuelve (clave, función con la que se lee, bucket de la regla) de la serie compactada más barata
+    # que da un resultado exacto, o None si hay que agregar la serie original
+    lectura = REAGREGABLES[funcion][1] if funcion in REAGREGABLES else funcion
+    candidatas = []
+    for funcion_regla, _, ms, destino in reglas(clave):
+        if ms == bucket_ms and funcion_regla == funcion:
+            return destino, lectura, ms
+        if funcion in REAGREGABLES and bucket_ms % ms == 0 and funcion_regla == REAGREGABLES[funcion][0]:
+            candidatas.append((ms, destino))
+    if candidatas:
+        ms, destino = max(candidatas)
+        return destino, lectura, ms
+    return None
+
+
+def agregar(redis, clave, funcion, bucket_ms, desde='-', hasta='+'):
+    # Devuelve (clave de origen, [(time, valor), ...]) con TS.RANGE ... AGGREGATION
+    origen = _elegir_origen(clave, funcion, bucket_ms)
+    if origen is None or not redis.exists(origen[0]):
+        datos = redis.execute_command('TS.RANGE', clave, desde, hasta, 'AGGREGATION', funcion, bucket_ms)
+        return clave, [(int(t), float(v)) for t, v in datos]
+
+    destino, funcion_destino, bucket_regla = origen
+    # De la compactada solo se leen los buckets de la regla que están enteros dentro de [desde, hasta] y
+    # ya cerrados (hasta el último que ha escrito la regla). Cada muestra compactada lleva el inicio de su
+    # bucket, así que el bucket en el que cae 'desde' también tiene muestras anteriores a 'desde'
+    inicio = 0 if desde == '-' else -(-int(desde) // bucket_regla) * bucket_regla
+    ultimo = redis.execute_command('TS.GET', destino)
+    fin = int(ultimo[0]) + bucket_regla if ultimo else 0
+    if hasta != '+':
+        fin = min(fin, (int(hasta) + 1) // bucket_regla * bucket_regla)
+    resultado = {}
+    if fin > inicio:
+        datos = redis.execute_command('TS.RANGE', destino, inicio, fin - bucket_regla,
+                                      'AGGREGATION', funcion_destino, bucket_ms)
+        resultado = {int(t): float(v) for t, v in datos}
+
+    # El resto sale de la serie original y se combina con lo que ya venía de la compactada: el principio
+    # del primer bucket (de 'desde' al primer bucket entero), el bucket abierto y los que aún no ha
+    # cerrado la regla
+    partes = [(max(fin, inicio), hasta)]
+    if desde != '-' and int(desde) < inicio:
+        partes.insert(0, (desde, inicio - 1 if hasta == '+' else min(inicio - 1, int(hasta))))
+    combinar = REAGREGABLES[funcion][2] if funcion in REAGREGABLES else None
+    for parte_desde, parte_hasta in partes:
+        if parte_hasta != '+' and int(parte_desde) > int(parte_hasta):
+            continue
+        pendientes = redis.execute_command(
+            'TS.RANGE', clave, parte_desde, parte_hasta, 'AGGREGATION', funcion, bucket_ms)
+        for t, v in pendientes:
+            t, v = int(t), float(v)
+            resultado[t] = combinar(resultado[t], v) if t in resultado and combinar else v
+    return destino, sorted(resultado.items())
+
+
+def comandos_retencion(clave):
+    # TS.ALTER que aplican la retención configurada a una serie ya existente y a sus compactadas
+    # (las creadas con otra configuración la conservan hasta que se alteran)
+    yield ['TS.ALTER', clave, 'RETENTION', ingesta.RETENCION_MS]
+    for _, _, bucket_ms, destino in reglas(clave):
+        yield ['TS.ALTER', destino, 'RETENTION', retencion(bucket_ms)]
+
+
+# ---------------------------------------------------------------------------------------------------
+# Borrado por rango
+# ---------------------------------------------------------------------------------------------------
+# TS.DEL borra solo las muestras del rango, sin recorrer ni copiar el resto de la serie. Los buckets
+# compactados que se solapan con el rango ya estaban calculados con las muestras borradas: se borran
+# de la serie compactada y se vuelven a calcular con las que quedan (el bucket en curso lo sigue
+# manteniendo la regla).
+
+def limites_borrado(desde, hasta):
+    # TS.DEL necesita timestamps concretos
+    return (0 if desde == '-' else int(desde)), (ingesta.MAX_TIMESTAMP if hasta == '+' else int(hasta))
+
+
+def recalculos(clave, desde, hasta):
+    # Por cada serie compactada: (TS.DEL de los buckets afectados ya cerrados, TS.RANGE que los recalcula)
+    for funcion, _, bucket_ms, destino in reglas(clave):
+        inicio = desde // bucket_ms * bucket_ms
+        fin = min(hasta // bucket_ms * bucket_ms + bucket_ms, _inicio_bucket_actual(bucket_ms)) - 1
+        if fin < inicio:
+            continue
+        yield (destino, ['TS.DEL', destino, inicio, fin],
+               ['TS.RANGE', clave, inicio, fin, 'AGGREGATION', funcion, bucket_ms])
+
+
+def pasos_borrar_rango(clave, desde, hasta):
+    # Devuelve el número de muestras borradas de la serie original
+    desde, hasta = limites_borrado(desde, hasta)
+    borradas = yield ['TS.DEL', clave, desde, hasta]
+    for destino, borrar, recalcular in recalculos(clave, desde, hasta):
+        if not (yield ['EXISTS', destino]):
+            continue
+        yield borrar
+        for argumentos in comandos_madd(destino, (yield recalcular)):
+            yield argumentos
+    return borradas
+
+
+def borrar_rango(redis, clave, desde, hasta):
+    return comandos.ejecutar(redis, pasos_borrar_rango(clave, desde, hasta))
@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+
+# ---------------------------------------------------------------------------------------------------
+# Arranque en paralelo y estado de la réplica
+# ---------------------------------------------------------------------------------------------------
+# Las tareas lentas del arranque (conectar con Redis, cargar y calentar el modelo...) se lanzan a la vez
+# en hilos en segundo plano en lugar de ejecutarse una detrás de otra al importar la aplicación. Cada
+# tarea guarda su estado (pendiente, reintentando, listo o error), que usan /healthz y /readyz: la réplica
+# solo se da por preparada cuando todas han terminado bien.
+#
+# Las tareas con reintentar_s (por ejemplo la conexión con Redis) se repiten hasta que funcionan. Los
+# hilos no sobreviven a un fork: con Gunicorn y preload_app, el hook pre_fork de gunicorn.conf.py espera
+# a las tareas sin reintentos (el modelo se hereda ya cargado) y el hook post_fork hace que cada worker
+# vuelva a lanzar al empezar las que no habían terminado (comprobar_fork).
+
+# Tiempo máximo que una petición (o el maestro de Gunicorn) espera a que termine una tarea
+ARRANQUE_TIMEOUT_S = float(os.getenv('ARRANQUE_TIMEOUT_S', 60))
+# Espera entre intentos de las tareas que se reintentan
+ARRANQUE_REINTENTO_S = float(os.getenv('ARRANQUE_REINTENTO_S', 5))
+
+
+class _Tarea:
+    def __init__(self, nombre, funcion, reintentar_s):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.reintentar_s = reintentar_s
+        self.estado = "pendiente"
+        self.resultado = None
+        self.error = None
+        self.intentos = 0
+        self.segundos = None
+        self.evento = threading.Event()
+
+
+_tareas = {}
+_cerrojo = threading.Lock()
+_pid = os.getpid()
+
+
+def tarea(nombre, funcion, reintentar_s=None):
+    # Lanza funcion() en segundo plano; su resultado se obtiene con esperar(nombre)
+    t = _Tarea(nombre, funcion, reintentar_s)
+    with _cerrojo:
+        _tareas[nombre] = t
+    _lanzar(t)
+    return t
+
+
+def _lanzar(t):
+    t.estado = "pendiente"
+    t.evento = threading.Event()
+    threading.Thread(target=_ejecutar, args=(t,), name=f"arranque-{t.nombre}", daemon=True).start()
+
+
+def _ejecutar(t):
+    inicio = time.perf_counter()
+    while True:
+        t.intentos += 1
+        try:
+            t.resultado = t.funcion()
+            t.error = None
+            t.estado = "listo"
+            break
+        except Exception as e:
+            t.error = f"{type(e).__name__}: {e}"
+            print(f"ERROR: fallo al iniciar '{t.nombre}' (intento {t.intentos}): {e}")
+            if t.reintentar_s is None:
+                t.estado = "error"
+                break
+            t.estado = "reintentando"
+            time.sleep(t.reintentar_s)
+    t.segundos = time.perf_counter() - inicio
+    print(f"Arranque de '{t.nombre}': {t.estado} en {t.segundos:.2f} s")
+    t.evento.set()
+
+
+def comprobar_fork():
+    # En un proceso hijo los hilos del padre no existen: se relanzan las tareas que no habían terminado
+    global _pid
+    if _pid == os.getpid():
+        return
+    with _cerrojo:
+        if _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        for t in _tareas.values():
+            if t.estado != "listo":
+                _lanzar(t)
+
+
+def esperar(nombre, timeout=ARRANQUE_TIMEOUT_S):
+    comprobar_fork()
+    t = _tareas[nombre]
+    if not t.evento.wait(timeout):
+        raise TimeoutError(f"'{nombre}' aún no está listo ({t.estado}, {t.error or 'sin errores'})")
+    if t.estado != "listo":
+        raise RuntimeError(f"'{nombre}' no se pudo iniciar => {t.error}")
+    return t.resultado
+
+
+def esperar_todas(timeout=ARRANQUE_TIMEOUT_S):
+    # Espera a las tareas sin reintentos (las que se reintentan pueden no terminar nunca)
+    limite = time.monotonic() + timeout
+    for t in list(_tareas.values()):
+        if t.reintentar_s is None:
+            t.evento.wait(max(0, limite - time.monotonic()))
+
+
+def listo():
+    comprobar_fork()
+    return all(t.estado == "listo" for t in _tareas.values())
+
+
+def estado():
+    comprobar_fork()
+    return {
+        t.nombre: {"estado": t.estado, "intentos": t.intentos, "segundos": t.segundos, "error": t.error}
+        for t in _tareas.values()
+    }
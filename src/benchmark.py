@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import platform
+import importlib.util
+import urllib.request
+import urllib.error
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# ---------------------------------------------------------------------------------------------------
+# Pruebas de carga y rendimiento de la API
+# ---------------------------------------------------------------------------------------------------
+# Arranca las aplicaciones de main-ej1/2/3.py en este mismo proceso contra un Redis simulado con
+# fakeredis (que implementa los comandos de RedisTimeSeries), carga un histórico de mediciones y lanza
+# peticiones a /nuevo, /listar y /detectar con varios hilos a la vez. Para cada combinación de aplicación,
+# ruta, tamaño del histórico y concurrencia mide la latencia (p50, p95 y p99) y las peticiones por
+# segundo, y guarda el resultado en JSON para compararlo con el de versiones anteriores.
+#
+# Se ejecuta desde cualquier directorio, por ejemplo:
+#   python src/benchmark.py --apps ej1,ej2 --concurrencia 1,8 --historico 1000,100000
+#   python src/benchmark.py --comparar benchmark-anterior.json   # termina con error si hay regresiones
+# Con --url se mide un servidor ya desplegado (Redis real) en lugar de las aplicaciones en proceso:
+#   python src/benchmark.py --url http://localhost:4000 --apps ej2
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_SRC = os.path.join(RAIZ, "src")
+
+# Rutas que se prueban en cada aplicación (ej1 no tiene modelo y no ofrece /detectar)
+RUTAS = {
+    "ej1": ("/nuevo", "/listar"),
+    "ej2": ("/nuevo", "/listar", "/detectar"),
+    "ej3": ("/nuevo", "/listar", "/detectar"),
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def cargar_app(nombre, servidor):
+    # Importa src/main-<nombre>.py con el cliente de Redis sustituido por uno de fakeredis que comparte
+    # 'servidor' (los datos) entre todas las conexiones
+    import redis
+    import fakeredis
+
+    def cliente_falso(*args, **kwargs):
+        return fakeredis.FakeRedis(server=servidor, decode_responses=True)
+
+    os.environ.setdefault('MODO_REDIS', 'SIMPLE')
+    original = redis.Redis
+    redis.Redis = cliente_falso
+    try:
+        if DIRECTORIO_SRC not in sys.path:
+            sys.path.insert(0, DIRECTORIO_SRC)
+        # Los módulos compartidos recuerdan las series creadas por la aplicación anterior (otro servidor)
+        import series
+        series.olvidar(series.CLAVE_POR_DEFECTO)
+        spec = importlib.util.spec_from_file_location(f"main_{nombre}", os.path.join(DIRECTORIO_SRC, f"main-{nombre}.py"))
+        modulo = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modulo)
+        # La aplicación conecta con Redis y carga el modelo en segundo plano: esperamos a que termine
+        import arranque
+        for tarea in arranque.estado():
+            arranque.esperar(tarea)
+    finally:
+        redis.Redis = original
+    return modulo
+
+
+def cargar_historico(modulo, n):
+    # Vuelve a crear la serie 'mediciones' (con sus compactaciones) con n mediciones, una por segundo,
+    # que terminan una hora antes del momento actual
+    clave = modulo.series.CLAVE_POR_DEFECTO
+    modulo.redis.delete(clave, *modulo.agregados.claves_compactadas(clave))
+    modulo.series.olvidar(clave)
+    modulo.series.asegurar_sensor(modulo.redis)
+    fin = int(time.time() * 1000) - 3600 * 1000
+    marcas = fin - 1000 * np.arange(n, 0, -1)
+    valores = np.round(70 + 5 * np.sin(np.arange(n) / 50) + np.random.normal(0, 0.5, n), 2)
+    modulo.ingesta.almacenar_lote(modulo.redis, clave, marcas, valores, {})
+    if getattr(modulo, "cache_ventanas", None) is not None:
+        modulo.cache_ventanas.invalidar()
+
+
+def parametros_ruta(ruta, args):
+    if ruta == "/listar":
+        return args.listar
+    return f"dato={np.random.uniform(60, 80):.2f}"
+
+
+def peticion_en_proceso(app):
+    # Cada hilo usa su propio cliente de pruebas de Flask (WSGI, sin red)
+    locales = threading.local()
+
+    def pedir(url):
+        if not hasattr(locales, "cliente"):
+            locales.cliente = app.test_client()
+        respuesta = locales.cliente.get(url)
+        respuesta.get_data()
+        return respuesta.status_code
+    return pedir
+
+
+def peticion_http(base):
+    def pedir(url):
+        try:
+            with urllib.request.urlopen(base + url, timeout=30) as respuesta:
+                respuesta.read()
+                return respuesta.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except OSError:
+            return 0
+    return pedir
+
+
+def medir(pedir, ruta, args, peticiones, concurrencia):
+    # Lanza 'peticiones' peticiones con 'concurrencia' hilos y devuelve latencias, errores y rps
+    def una(_):
+        url = f"{ruta}?{parametros_ruta(ruta, args)}"
+        inicio = time.perf_counter()
+        estado = pedir(url)
+        return time.perf_counter() - inicio, estado
+
+    with ThreadPoolExecutor(concurrencia) as pool:
+        list(pool.map(una, range(min(args.calentamiento, peticiones))))
+        inicio = time.perf_counter()
+        resultados = list(pool.map(una, range(peticiones)))
+        segundos = time.perf_counter() - inicio
+
+    latencias = np.array([r[0] for r in resultados]) * 1000
+    errores = sum(1 for r in resultados if r[1] != 200)
+    return {
+        "peticiones": peticiones,
+        "errores": errores,
+        "segundos": segundos,
+        "rps": peticiones / segundos,
+        "latencia_ms": {
+            **{f"p{p}": float(np.percentile(latencias, p)) for p in PERCENTILES},
+            "media": float(latencias.mean()),
+            "maximo": float(latencias.max()),
+        },
+    }
+
+
+def comparar(resultados, ruta_anterior, tolerancia):
+    # Devuelve las regresiones respecto a un JSON anterior: rps menor o p95 mayor que la tolerancia
+    with open(ruta_anterior) as f:
+        anteriores = {
+            (r["app"], r["ruta"], r["historico"], r["concurrencia"]): r for r in json.load(f)["resultados"]
+        }
+    regresiones = []
+    for r in resultados:
+        anterior = anteriores.get((r["app"], r["ruta"], r["historico"], r["concurrencia"]))
+        if anterior is None:
+            continue
+        if r["rps"] < anterior["rps"] * (1 - tolerancia):
+            regresiones.append(f"{r['app']} {r['ruta']} h={r['historico']} c={r['concurrencia']}: "
+                               f"rps {anterior['rps']:.1f} => {r['rps']:.1f}")
+        if r["latencia_ms"]["p95"] > anterior["latencia_ms"]["p95"] * (1 + tolerancia):
+            regresiones.append(f"{r['app']} {r['ruta']} h={r['historico']} c={r['concurrencia']}: "
+                               f"p95 {anterior['latencia_ms']['p95']:.2f} ms => {r['latencia_ms']['p95']:.2f} ms")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pruebas de carga de /nuevo, /listar y /detectar")
+    parser.add_argument("--apps", default="ej1,ej2,ej3")
+    parser.add_argument("--rutas", help="rutas a probar separadas por comas (por defecto todas las de cada app)")
+    parser.add_argument("--concurrencia", default="1,8", help="hilos simultáneos, separados por comas")
+    parser.add_argument("--historico", default="1000,50000", help="mediciones previas en la serie, separadas por comas")
+    parser.add_argument("--peticiones", type=int, default=500, help="peticiones medidas por combinación")
+    parser.add_argument("--calentamiento", type=int, default=20, help="peticiones previas que no se miden")
+    parser.add_argument("--listar", default="limite=100&formato=json", help="parámetros de /listar")
+    parser.add_argument("--url", help="mide un servidor desplegado en lugar de las apps en proceso (sin cargar histórico)")
+    parser.add_argument("--salida", default="benchmark.json")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior para detectar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="empeoramiento admitido al comparar (0.2 = 20%%)")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.semilla)
+    # Las aplicaciones abren modelo.keras, scaler.pkl y config.json con rutas relativas a la raíz
+    os.chdir(RAIZ)
+    concurrencias = [int(c) for c in args.concurrencia.split(",")]
+    historicos = [int(h) for h in args.historico.split(",")] if not args.url else [0]
+
+    resultados = []
+    for nombre in args.apps.split(","):
+        rutas = [r for r in RUTAS[nombre] if not args.rutas or r in args.rutas.split(",")]
+        if args.url:
+            pedir, modulo = peticion_http(args.url.rstrip("/")), None
+        else:
+            import fakeredis
+            servidor = fakeredis.FakeServer()
+            modulo = cargar_app(nombre, servidor)
+            pedir = peticion_en_proceso(modulo.app)
+        for historico in historicos:
+            for ruta in rutas:
+                for concurrencia in concurrencias:
+                    if modulo is not None:
+                        # Cada medición empieza con el mismo histórico (/nuevo y /detectar lo hacen crecer)
+                        cargar_historico(modulo, historico)
+                    resultado = {"app": nombre, "ruta": ruta, "historico": historico, "concurrencia": concurrencia,
+                                 **medir(pedir, ruta, args, args.peticiones, concurrencia)}
+                    resultados.append(resultado)
+                    latencia = resultado["latencia_ms"]
+                    print(f"{nombre:4} {ruta:10} h={historico:<8} c={concurrencia:<3} "
+                          f"rps={resultado['rps']:9.1f} p50={latencia['p50']:8.2f} ms "
+                          f"p95={latencia['p95']:8.2f} ms p99={latencia['p99']:8.2f} ms "
+                          f"errores={resultado['errores']}")
+
+    informe = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "hostname": socket.gethostname(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "destino": args.url or "fakeredis",
+        "parametros": {"peticiones": args.peticiones, "calentamiento": args.calentamiento, "listar": args.listar},
+        "resultados": resultados,
+    }
+    with open(args.salida, "w") as f:
+        json.dump(informe, f, indent=2)
+    print(f"Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        regresiones = comparar(resultados, args.comparar, args.tolerancia)
+        for regresion in regresiones:
+            print(f"REGRESIÓN: {regresion}")
+        if regresiones:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
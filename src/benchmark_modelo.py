@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import subprocess
+import numpy as np
+
+# ---------------------------------------------------------------------------------------------------
+# Comparación de los backends del modelo
+# ---------------------------------------------------------------------------------------------------
+# Carga el modelo con cada backend de inferencia.py (keras, numpy, tflite-float16, tflite-int8) y mide:
+#   - latencia por ventana (lotes de 1, como /detectar sin agrupar) y por lote (--lote ventanas, como el
+#     planificador o /detectar/lote), en p50/p95/p99
+#   - desviación de las predicciones sobre todas las ventanas de datos.csv respecto al backend de
+#     referencia (keras si TensorFlow está instalado, numpy si no): error absoluto máximo y medio, y
+#     ventanas cuya decisión de anomalía (criterio de /detectar) cambia
+#   - memoria del proceso (RSS) antes y después de cargar el modelo y máxima tras las predicciones
+# Cada backend se mide en un proceso aparte para que la memoria de uno (por ejemplo TensorFlow) no se
+# sume a la de los demás.
+#
+# Se ejecuta desde cualquier directorio, por ejemplo:
+#   python src/benchmark_modelo.py
+#   python src/benchmark_modelo.py --backends numpy,tflite-float16 --lote 64 --repeticiones 2000
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_SRC = os.path.join(RAIZ, "src")
+RUTA_MODELO = os.path.join(DIRECTORIO_SRC, "modelo.keras")
+RUTA_PESOS = os.path.join(DIRECTORIO_SRC, "modelo_pesos.npz")
+RUTA_SCALER = os.path.join(DIRECTORIO_SRC, "scaler.pkl")
+RUTA_CONFIG = os.path.join(DIRECTORIO_SRC, "config.json")
+RUTA_DATOS = os.path.join(DIRECTORIO_SRC, "src_p1", "datos.csv")
+
+PERCENTILES = (50, 95, 99)
+
+if DIRECTORIO_SRC not in sys.path:
+    sys.path.insert(0, DIRECTORIO_SRC)
+
+
+def _estado_proceso(campo):
+    # Campo de /proc/self/status en MB (solo Linux), o None
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith(campo + ":"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_max_mb():
+    # VmHWM empieza de cero en el proceso hijo; ru_maxrss incluiría la memoria del padre antes del fork
+    maximo = _estado_proceso("VmHWM")
+    if maximo is not None:
+        return maximo
+    import resource
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    return maximo / (1024 * 1024) if platform.system() == "Darwin" else maximo / 1024
+
+
+def rss_mb():
+    # Memoria residente actual del proceso; en otros sistemas la máxima
+    actual = _estado_proceso("VmRSS")
+    return actual if actual is not None else rss_max_mb()
+
+
+def ventanas_datos():
+    # Todas las ventanas escaladas de datos.csv, igual que src_p1/exportar_pesos.py
+    import joblib
+    import pandas as pd
+    from numpy.lib.stride_tricks import sliding_window_view
+    with open(RUTA_CONFIG, "r") as f:
+        windows_size = json.load(f)["windows_size"]
+    df = pd.read_csv(RUTA_DATOS, index_col=0, parse_dates=True)
+    datos_escalados = joblib.load(RUTA_SCALER).transform(df.values).ravel()
+    X = sliding_window_view(datos_escalados[:-1], windows_size).reshape(-1, windows_size, 1)
+    return np.ascontiguousarray(X, dtype=np.float32), df.values[windows_size:].ravel()
+
+
+def latencias(predecir, X, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        predecir(X)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    tiempos = np.array(tiempos)
+    resumen = {f"p{p}_ms": float(np.percentile(tiempos, p)) for p in PERCENTILES}
+    resumen["media_ms"] = float(tiempos.mean())
+    return resumen
+
+
+def medir_backend(backend, lote, repeticiones, ruta_predicciones):
+    # Se ejecuta en el proceso hijo: devuelve las medidas y guarda las predicciones en ruta_predicciones
+    X, _ = ventanas_datos()
+    rss_inicial = rss_mb()
+    import inferencia
+    inicio = time.perf_counter()
+    modelo = inferencia.cargar_modelo(RUTA_MODELO, RUTA_PESOS, backend)
+    carga_s = time.perf_counter() - inicio
+    rss_cargado = rss_mb()
+
+    # Calentamiento con los dos tamaños de lote (Keras traza el grafo de cada uno)
+    for n in (1, lote):
+        for _ in range(5):
+            modelo.predict_on_batch(X[:n])
+    por_ventana = latencias(modelo.predict_on_batch, X[:1], repeticiones)
+    por_lote = latencias(modelo.predict_on_batch, X[:lote], max(1, repeticiones // 10))
+    por_lote["ventanas_s"] = lote / (por_lote["media_ms"] / 1000)
+
+    predicciones = np.concatenate([np.asarray(modelo.predict_on_batch(X[i:i + 1024]), dtype=np.float64).ravel()
+                                   for i in range(0, len(X), 1024)])
+    np.save(ruta_predicciones, predicciones)
+    return {"backend": backend, "carga_s": carga_s, "por_ventana": por_ventana, "por_lote": por_lote,
+            "rss_mb": {"inicial": rss_inicial, "modelo_cargado": rss_cargado, "maximo": rss_max_mb()}}
+
+
+def desviacion(predicciones, referencia, reales, umbral):
+    # Diferencia de las predicciones y de las anomalías (error > umbral, como /detectar) con la referencia
+    diferencia = np.abs(predicciones - referencia)
+    anomalias = np.abs(predicciones - reales) > umbral
+    anomalias_referencia = np.abs(referencia - reales) > umbral
+    return {"error_max": float(diferencia.max()), "error_medio": float(diferencia.mean()),
+            "anomalias": int(anomalias.sum()), "decisiones_distintas": int((anomalias != anomalias_referencia).sum())}
+
+
+def backends_disponibles():
+    import importlib.util
+    import inferencia
+    backends = ["numpy"]
+    if importlib.util.find_spec("tensorflow") is not None:
+        backends.insert(0, "keras")
+    if inferencia.tflite_disponible():
+        backends += [b for b in ("tflite-float16", "tflite-int8")
+                     if os.path.exists(inferencia.ruta_tflite(RUTA_MODELO, b.split("-")[1]))]
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara latencia, precisión y memoria de los backends del modelo")
+    parser.add_argument("--backends", help="backends separados por comas (por defecto todos los disponibles)")
+    parser.add_argument("--lote", type=int, default=32, help="ventanas por lote en la latencia por lote")
+    parser.add_argument("--repeticiones", type=int, default=1000, help="predicciones medidas por ventana")
+    parser.add_argument("--salida", default="benchmark-modelo.json")
+    parser.add_argument("--medir", help=argparse.SUPPRESS)
+    parser.add_argument("--predicciones", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir:
+        # Proceso hijo: una sola línea JSON con las medidas
+        print(json.dumps(medir_backend(args.medir, args.lote, args.repeticiones, args.predicciones)))
+        return
+
+    backends = args.backends.split(",") if args.backends else backends_disponibles()
+    referencia = "keras" if "keras" in backends else "numpy"
+    if referencia not in backends:
+        backends.insert(0, referencia)
+    with open(RUTA_CONFIG, "r") as f:
+        umbral = json.load(f)["threshold"] / 4
+    _, reales = ventanas_datos()
+
+    resultados, predicciones = [], {}
+    with tempfile.TemporaryDirectory() as directorio:
+        for backend in backends:
+            ruta = os.path.join(directorio, f"{backend}.npy")
+            proceso = subprocess.run([sys.executable, os.path.abspath(__file__), "--medir", backend, "--lote", str(args.lote),
+                                      "--repeticiones", str(args.repeticiones), "--predicciones", ruta],
+                                     capture_output=True, text=True)
+            if proceso.returncode != 0:
+                print(f"ERROR: no se pudo medir el backend '{backend}':\n{proceso.stderr.strip()[-2000:]}")
+                continue
+            resultados.append(json.loads(proceso.stdout.strip().splitlines()[-1]))
+            predicciones[backend] = np.load(ruta)
+
+    for resultado in resultados:
+        if referencia in predicciones:
+            resultado["desviacion"] = desviacion(predicciones[resultado["backend"]], predicciones[referencia], reales, umbral)
+        ventana, lote, rss = resultado["por_ventana"], resultado["por_lote"], resultado["rss_mb"]
+        print(f"{resultado['backend']:>15}: ventana p50 {ventana['p50_ms']:.3f} ms p99 {ventana['p99_ms']:.3f} ms | "
+              f"lote de {args.lote} p50 {lote['p50_ms']:.3f} ms ({lote['ventanas_s']:.0f} ventanas/s) | "
+              f"RSS {rss['modelo_cargado']:.0f} MB (máx. {rss['maximo']:.0f} MB)"
+              + (f" | error máx. {resultado['desviacion']['error_max']:.4f}, "
+                 f"{resultado['desviacion']['decisiones_distintas']} decisiones distintas" if "desviacion" in resultado else ""))
+
+    with open(args.salida, "w") as f:
+        json.dump({"fecha": time.strftime("%Y-%m-%dT%H:%M:%S"), "referencia": referencia, "lote": args.lote,
+                   "ventanas": len(reales), "umbral": umbral, "resultados": resultados}, f, indent=2)
+    print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
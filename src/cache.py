@@ -0,0 +1,226 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import Response, jsonify
+from redis import RedisError
+import consultas
+import agregados
+import metricas
+
+# ---------------------------------------------------------------------------------------------------
+# Caché de respuestas de /listar y /agregar
+# ---------------------------------------------------------------------------------------------------
+# Los paneles piden la misma página de /listar una y otra vez. Las respuestas ya generadas se guardan
+# en memoria (LRU acotada por número de entradas y por bytes) con la versión de la serie en la que se
+# calcularon: (totalSamples, firstTimestamp, lastTimestamp) de TS.INFO. Cada petición consulta solo
+# TS.INFO; si la versión no ha cambiado se devuelve la respuesta guardada y, si además el cliente envía
+# If-None-Match con su ETag, un 304 sin cuerpo.
+#
+# La versión cambia con cualquier escritura, también de otros workers o réplicas, así que nunca se
+# sirve una respuesta desactualizada. Las escrituras del propio proceso actualizan la caché al momento:
+# /nuevo y /detectar añaden la muestra a las páginas de /listar que la incluyen (y descartan las de
+# /agregar), y /borrar y /nuevo_lote descartan todas las de la serie.
+#
+# Con CACHE_REDIS_TTL_S > 0 las respuestas también se guardan en Redis (en '{<serie>}:cache:<hash>',
+# junto a la serie), para compartirlas entre workers y réplicas.
+#
+# Solo se guardan las páginas con 'limite' (como mucho CACHE_MAX_MUESTRAS muestras); las consultas sin
+# límite se siguen enviando en streaming.
+
+CACHE_RESPUESTAS = os.getenv('CACHE_RESPUESTAS', '1') == '1'
+CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_MAX_ENTRADAS', 512))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 32 * 1024 * 1024))
+CACHE_MAX_MUESTRAS = int(os.getenv('CACHE_MAX_MUESTRAS', 10000))
+CACHE_REDIS_TTL_S = float(os.getenv('CACHE_REDIS_TTL_S', 0))
+
+# Tamaño aproximado en memoria de cada muestra (time, valor) guardada para poder ampliar la página
+BYTES_MUESTRA = 100
+
+
+def version_serie(redis, clave):
+    # TS.INFO devuelve un diccionario (RESP3) o una lista [campo, valor, ...] (RESP2)
+    info = redis.execute_command('TS.INFO', clave)
+    if not isinstance(info, dict):
+        info = dict(zip(info[::2], info[1::2]))
+    return int(info['totalSamples']), int(info['firstTimestamp']), int(info['lastTimestamp'])
+
+
+def etag(clave_cache, version):
+    return '"' + hashlib.sha1(repr((clave_cache, version)).encode()).hexdigest()[:20] + '"'
+
+
+class Entrada:
+    def __init__(self, serie, version, cuerpo, tipo, muestras=None, parametros=None):
+        self.serie = serie
+        self.version = version
+        self.cuerpo = cuerpo
+        self.tipo = tipo
+        # Solo en las páginas de /listar: muestras y (desde, hasta, orden, limite, formato, args, plantilla)
+        self.muestras = muestras
+        self.parametros = parametros
+        self.tam = len(cuerpo) + BYTES_MUESTRA * len(muestras or ())
+
+
+class CacheRespuestas:
+    def __init__(self, max_entradas=CACHE_MAX_ENTRADAS, max_bytes=CACHE_MAX_BYTES, redis_ttl_s=CACHE_REDIS_TTL_S):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.redis_ttl_s = redis_ttl_s
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._cerrojo = threading.Lock()
+
+    # ---------------------------------------------------------------------------------------------
+    # Almacén LRU
+    # ---------------------------------------------------------------------------------------------
+    def _obtener(self, clave_cache, version):
+        with self._cerrojo:
+            entrada = self._entradas.get(clave_cache)
+            if entrada is None:
+                return None
+            if entrada.version != version:
+                self._quitar(clave_cache)
+                return None
+            self._entradas.move_to_end(clave_cache)
+            return entrada
+
+    def _guardar(self, clave_cache, entrada):
+        if entrada.tam > self.max_bytes:
+            return
+        with self._cerrojo:
+            if clave_cache in self._entradas:
+                self._quitar(clave_cache)
+            self._entradas[clave_cache] = entrada
+            self._bytes += entrada.tam
+            while len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes:
+                self._quitar(next(iter(self._entradas)))
+
+    def _quitar(self, clave_cache):
+        self._bytes -= self._entradas.pop(clave_cache).tam
+
+    def borrar_serie(self, serie):
+        with self._cerrojo:
+            for clave_cache in [c for c, e in self._entradas.items() if e.serie == serie]:
+                self._quitar(clave_cache)
+
+    def estadisticas(self):
+        with self._cerrojo:
+            return {"entradas": len(self._entradas), "bytes": self._bytes}
+
+    # ---------------------------------------------------------------------------------------------
+    # Segundo nivel en Redis
+    # ---------------------------------------------------------------------------------------------
+    def _clave_redis(self, serie, clave_cache):
+        return agregados.clave_derivada(serie, "cache:" + hashlib.sha1(repr(clave_cache).encode()).hexdigest())
+
+    def _obtener_redis(self, redis, serie, clave_cache, version):
+        if not self.redis_ttl_s:
+            return None
+        try:
+            guardada = redis.get(self._clave_redis(serie, clave_cache))
+        except RedisError:
+            return None
+        if guardada is None:
+            return None
+        guardada = json.loads(guardada)
+        if tuple(guardada["version"]) != version:
+            return None
+        return Entrada(serie, version, guardada["cuerpo"], guardada["tipo"])
+
+    def _guardar_redis(self, redis, clave_cache, entrada):
+        if not self.redis_ttl_s:
+            return
+        valor = json.dumps({"version": entrada.version, "cuerpo": entrada.cuerpo, "tipo": entrada.tipo})
+        try:
+            redis.set(self._clave_redis(entrada.serie, clave_cache), valor, px=int(self.redis_ttl_s * 1000))
+        except RedisError:
+            # Caché de mejor esfuerzo (por ejemplo una réplica de solo lectura): no afecta a la respuesta
+            pass
+
+    # ---------------------------------------------------------------------------------------------
+    # Respuestas
+    # ---------------------------------------------------------------------------------------------
+    def _responder(self, redis, serie, clave_cache, version, si_coincide, calcular):
+        etiqueta = etag(clave_cache, version)
+        if si_coincide == etiqueta:
+            metricas.registro.contar("cache_respuestas_total", resultado="no_modificada")
+            return Response(status=304, headers={"ETag": etiqueta})
+        entrada = self._obtener(clave_cache, version)
+        if entrada is None:
+            entrada = self._obtener_redis(redis, serie, clave_cache, version)
+            if entrada is not None:
+                self._guardar(clave_cache, entrada)
+        if entrada is None:
+            metricas.registro.contar("cache_respuestas_total", resultado="fallo")
+            entrada = calcular()
+            self._guardar(clave_cache, entrada)
+            self._guardar_redis(redis, clave_cache, entrada)
+        else:
+            metricas.registro.contar("cache_respuestas_total", resultado="acierto")
+        return Response(entrada.cuerpo, content_type=entrada.tipo, headers={"ETag": etiqueta, "Cache-Control": "no-cache"})
+
+    def listar(self, redis, clave, args, plantilla_html, si_coincide=None):
+        # Como consultas.listar, pero las páginas con límite se sirven desde la caché
+        desde, hasta, orden, limite, formato = consultas.leer_parametros(args)
+        if limite is None or limite > CACHE_MAX_MUESTRAS:
+            return consultas.listar(redis, clave, args, plantilla_html)
+        version = version_serie(redis, clave)
+        clave_cache = ("listar", clave, tuple(sorted(args.items())))
+
+        def calcular():
+            muestras = [(int(t), float(v)) for trozo in consultas.leer_trozos(redis, clave, desde, hasta, orden, limite)
+                        for t, v in trozo]
+            parametros = (desde, hasta, orden, limite, formato, dict(args.items()), plantilla_html)
+            return Entrada(clave, version, consultas.pagina(muestras, formato, parametros[5], plantilla_html, orden, limite),
+                           consultas.FORMATOS[formato], muestras, parametros)
+
+        return self._responder(redis, clave, clave_cache, version, si_coincide, calcular)
+
+    def agregar(self, redis, clave, funcion, bucket_ms, desde, hasta, formato, si_coincide=None, hostname=""):
+        # Respuesta de /agregar (JSON o CSV) desde la caché
+        version = version_serie(redis, clave)
+        clave_cache = ("agregar", clave, funcion, bucket_ms, desde, hasta, formato)
+
+        def calcular():
+            origen, datos = agregados.agregar(redis, clave, funcion, bucket_ms, desde, hasta)
+            if formato == "csv":
+                cuerpo, tipo = "time,valor\n" + "".join(f"{t},{v!r}\n" for t, v in datos), "text/csv; charset=utf-8"
+            else:
+                cuerpo = jsonify({"funcion": funcion, "bucket": bucket_ms, "origen": origen, "datos": datos,
+                                  "hostname": hostname}).get_data(as_text=True)
+                tipo = "application/json"
+            return Entrada(clave, version, cuerpo, tipo)
+
+        return self._responder(redis, clave, clave_cache, version, si_coincide, calcular)
+
+    # ---------------------------------------------------------------------------------------------
+    # Escrituras del propio proceso
+    # ---------------------------------------------------------------------------------------------
+    def anadido(self, serie, timestamp, valor):
+        # Se ha añadido (timestamp, valor) al final de la serie con TS.ADD: se amplían las páginas de /listar
+        # que la incluyen con la versión que tendrá ahora la serie y se descartan las de /agregar
+        with self._cerrojo:
+            for clave_cache, entrada in [(c, e) for c, e in self._entradas.items() if e.serie == serie]:
+                total, primero, ultimo = entrada.version
+                if entrada.muestras is None or timestamp <= ultimo:
+                    # Agregados o muestra fuera de orden
+                    self._quitar(clave_cache)
+                    continue
+                nueva = self._ampliar(entrada, timestamp, valor)
+                nueva.version = (total + 1, primero if total else timestamp, timestamp)
+                self._bytes += nueva.tam - entrada.tam
+                self._entradas[clave_cache] = nueva
+
+    def _ampliar(self, entrada, timestamp, valor):
+        desde, hasta, orden, limite, formato, args, plantilla_html = entrada.parametros
+        muestras = entrada.muestras
+        if (desde != '-' and timestamp < desde) or (hasta != '+' and timestamp > hasta):
+            return Entrada(entrada.serie, entrada.version, entrada.cuerpo, entrada.tipo, muestras, entrada.parametros)
+        if orden == "desc":
+            muestras = [(timestamp, valor)] + muestras[:limite - 1]
+        elif len(muestras) < limite:
+            muestras = muestras + [(timestamp, valor)]
+        cuerpo = consultas.pagina(muestras, formato, args, plantilla_html, orden, limite)
+        return Entrada(entrada.serie, entrada.version, cuerpo, entrada.tipo, muestras, entrada.parametros)
@@ -0,0 +1,42 @@
+# ---------------------------------------------------------------------------------------------------
+# Pasos de escritura compartidos por las aplicaciones síncronas y la asíncrona
+# ---------------------------------------------------------------------------------------------------
+# Las escrituras que dependen de respuestas anteriores (crear la serie si no existe, rellenar el histórico
+# de una compactada, recalcular buckets tras un borrado...) se escriben una sola vez como generadores de
+# "pasos": cada 'yield' entrega un comando de Redis (lista de argumentos para execute_command) y recibe su
+# respuesta, o la excepción que haya lanzado Redis. El valor con el que termina el generador es el
+# resultado de la operación. Así series.py, ingesta.py y agregados.py no dependen del tipo de cliente:
+#
+#   comandos.ejecutar(redis, series.pasos_asegurar_sensor(sensor))                   cliente síncrono
+#   await comandos.ejecutar_async(redis, series.pasos_asegurar_sensor(sensor))       redis.asyncio
+#
+# Como todo pasa por execute_command, las métricas (metricas.instrumentar_redis) y el circuito
+# (conexiones.proteger) se aplican igual que a los comandos sueltos.
+
+
+def ejecutar(redis, pasos):
+    try:
+        comando = next(pasos)
+        while True:
+            try:
+                respuesta = redis.execute_command(*comando)
+            except Exception as e:
+                comando = pasos.throw(e)
+            else:
+                comando = pasos.send(respuesta)
+    except StopIteration as fin:
+        return fin.value
+
+
+async def ejecutar_async(redis, pasos):
+    try:
+        comando = next(pasos)
+        while True:
+            try:
+                respuesta = await redis.execute_command(*comando)
+            except Exception as e:
+                comando = pasos.throw(e)
+            else:
+                comando = pasos.send(respuesta)
+    except StopIteration as fin:
+        return fin.value
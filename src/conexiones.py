@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from redis import BlockingConnectionPool, ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.backoff import EqualJitterBackoff
+from redis.exceptions import TryAgainError, ClusterDownError
+
+# ---------------------------------------------------------------------------------------------------
+# Conexiones resistentes a fallos de Redis
+# ---------------------------------------------------------------------------------------------------
+# - Pools acotados: como mucho REDIS_MAX_CONEXIONES conexiones por nodo; en modo SIMPLE una petición
+#   espera hasta REDIS_ESPERA_CONEXION_S a que quede una libre en lugar de abrir otra.
+# - Reintentos con espera exponencial y aleatoria (jitter) ante errores transitorios: conexión cortada,
+#   timeout, maestro degradado a réplica durante un failover de Sentinel (el cliente lo convierte en
+#   ConnectionError) y TRYAGAIN/CLUSTERDOWN durante un resharding. RedisCluster ya sigue él mismo las
+#   redirecciones MOVED y ASK.
+# - Circuito: tras CIRCUITO_FALLOS errores transitorios seguidos los comandos fallan al instante
+#   (CircuitoAbierto) durante CIRCUITO_ABIERTO_S segundos; después se deja pasar un comando de prueba
+#   y, si funciona, el circuito se vuelve a cerrar. Así las peticiones no se acumulan esperando timeouts.
+# - Buffer de escrituras de /nuevo: si Redis no está disponible la medición se añade a un fichero local
+#   (BUFFER_FICHERO) y un hilo en segundo plano la reenvía cuando Redis vuelve. El fichero es común a
+#   todos los workers (se bloquea con flock) y sobrevive a un reinicio del contenedor si está en un volumen.
+#   Las mediciones que Redis rechaza al reenviarlas se guardan en '<fichero>.rechazadas' con su error.
+
+REDIS_MAX_CONEXIONES = int(os.getenv('REDIS_MAX_CONEXIONES', 64))
+REDIS_ESPERA_CONEXION_S = float(os.getenv('REDIS_ESPERA_CONEXION_S', 2))
+# Timeout de los comandos; si no se indica se usa el de cada modo
+REDIS_TIMEOUT_S = os.getenv('REDIS_TIMEOUT_S')
+
+REDIS_REINTENTOS = int(os.getenv('REDIS_REINTENTOS', 3))
+REDIS_ESPERA_BASE_S = float(os.getenv('REDIS_ESPERA_BASE_S', 0.05))
+REDIS_ESPERA_MAX_S = float(os.getenv('REDIS_ESPERA_MAX_S', 1))
+
+CIRCUITO_FALLOS = int(os.getenv('CIRCUITO_FALLOS', 5))
+CIRCUITO_ABIERTO_S = float(os.getenv('CIRCUITO_ABIERTO_S', 10))
+
+# Fichero del buffer de /nuevo ('' lo desactiva; mejor en un volumen para que sobreviva al contenedor) y
+# espera entre intentos de reenvío
+BUFFER_FICHERO = os.getenv('BUFFER_FICHERO', os.path.join(tempfile.gettempdir(), 'buffer-nuevo.jsonl'))
+BUFFER_REINTENTO_S = float(os.getenv('BUFFER_REINTENTO_S', 2))
+BUFFER_TROZO = int(os.getenv('BUFFER_TROZO', 1000))
+
+ERRORES_TRANSITORIOS = (ConnectionError, TimeoutError, TryAgainError, ClusterDownError)
+
+
+class CircuitoAbierto(ConnectionError):
+    pass
+
+
+def timeout(por_defecto):
+    return float(REDIS_TIMEOUT_S) if REDIS_TIMEOUT_S else por_defecto
+
+
+def reintentos():
+    return Retry(EqualJitterBackoff(cap=REDIS_ESPERA_MAX_S, base=REDIS_ESPERA_BASE_S), REDIS_REINTENTOS,
+                 supported_errors=ERRORES_TRANSITORIOS)
+
+
+def opciones():
+    # Opciones comunes de los clientes de Sentinel (master_for/slave_for) y RedisCluster
+    return {"retry": reintentos(), "max_connections": REDIS_MAX_CONEXIONES}
+
+
+def pool_simple(host, **opciones_conexion):
+    return BlockingConnectionPool(host=host, max_connections=REDIS_MAX_CONEXIONES, timeout=REDIS_ESPERA_CONEXION_S,
+                                  retry=reintentos(), **opciones_conexion)
+
+
+class Circuito:
+    def __init__(self, fallos_max=CIRCUITO_FALLOS, abierto_s=CIRCUITO_ABIERTO_S):
+        self.fallos_max = fallos_max
+        self.abierto_s = abierto_s
+        self.estado = "cerrado"
+        self.fallos = 0
+        self.aperturas = 0
+        self._abierto_hasta = 0
+        self._probando = False
+        self._cerrojo = threading.Lock()
+
+    def antes(self):
+        with self._cerrojo:
+            if self.estado == "cerrado":
+                return
+            if self.estado == "abierto" and time.monotonic() >= self._abierto_hasta:
+                self.estado = "semiabierto"
+            if self.estado == "semiabierto" and not self._probando:
+                # Solo un comando de prueba a la vez; el resto sigue fallando al instante
+                self._probando = True
+                return
+            raise CircuitoAbierto(f"circuito abierto tras {self.fallos} errores seguidos de Redis")
+
+    def exito(self):
+        with self._cerrojo:
+            self.estado = "cerrado"
+            self.fallos = 0
+            self._probando = False
+
+    def fallo(self):
+        with self._cerrojo:
+            self.fallos += 1
+            self._probando = False
+            if self.estado == "semiabierto" or self.fallos >= self.fallos_max:
+                if self.estado != "abierto":
+                    self.aperturas += 1
+                self.estado = "abierto"
+                self._abierto_hasta = time.monotonic() + self.abierto_s
+
+    def estadisticas(self):
+        with self._cerrojo:
+            return {"estado": self.estado, "fallos": self.fallos, "aperturas": self.aperturas}
+
+
+def _por_circuito(funcion, circuito):
+    def protegida(*args, **kwargs):
+        circuito.antes()
+        try:
+            resultado = funcion(*args, **kwargs)
+        except ERRORES_TRANSITORIOS:
+            circuito.fallo()
+            raise
+        except Exception:
+            # Errores de la petición (serie inexistente, timestamp duplicado...): Redis sí ha respondido
+            circuito.exito()
+            raise
+        circuito.exito()
+        return resultado
+
+    return protegida
+
+
+def proteger(cliente, circuito):
+    # Igual que metricas.instrumentar_redis: envuelve execute_command para pasar por el circuito. Los
+    # pipelines no usan execute_command del cliente, así que también se envuelve su execute
+    cliente.execute_command = _por_circuito(cliente.execute_command, circuito)
+    original_pipeline = cliente.pipeline
+
+    def pipeline(*args, **kwargs):
+        pipe = original_pipeline(*args, **kwargs)
+        pipe.execute = _por_circuito(pipe.execute, circuito)
+        return pipe
+
+    cliente.pipeline = pipeline
+    return cliente
+
+
+class BufferEscrituras:
+    # reenviar(entradas) escribe en Redis una lista de {"sensor", "time", "valor"}, lanza una excepción si
+    # no lo consigue y devuelve las entradas que Redis ha rechazado, cada una con su "error"
+    def __init__(self, reenviar, fichero=BUFFER_FICHERO):
+        self.reenviar = reenviar
+        self.fichero = fichero
+        self._cerrojo = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self.guardadas = 0
+        self.reenviadas = 0
+        self.rechazadas = 0
+        self.errores = 0
+
+    def activo(self):
+        return bool(self.fichero)
+
+    def guardar(self, sensor, timestamp, valor):
+        with open(self.fichero + ".lock", "a") as cerrojo:
+            fcntl.flock(cerrojo, fcntl.LOCK_EX)
+            with open(self.fichero, "a") as f:
+                f.write(json.dumps({"sensor": sensor, "time": timestamp, "valor": valor}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        with self._cerrojo:
+            self.guardadas += 1
+        self.asegurar_hilo()
+
+    def asegurar_hilo(self):
+        # Como en resultados.RegistroResultados: el hilo se vuelve a arrancar si el proceso se ha bifurcado
+        if not self.activo():
+            return
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._cerrojo:
+            if self._pid != os.getpid() or self._hilo is None or not self._hilo.is_alive():
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name="buffer-escrituras", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            try:
+                self.reenviar_pendientes()
+            except Exception as e:
+                print(f"ERROR: no se pudo reenviar el buffer de /nuevo, se reintentará: {e}")
+                with self._cerrojo:
+                    self.errores += 1
+            time.sleep(BUFFER_REINTENTO_S)
+
+    def reenviar_pendientes(self):
+        # Solo un proceso reenvía a la vez. Las mediciones pendientes se mueven a '<fichero>.reenviando'
+        # (mientras tanto /nuevo sigue añadiendo al fichero principal) y se borra al terminar; si el
+        # reenvío falla a medias se repite entero (Redis rechaza las que ya estaban escritas)
+        reenviando = self.fichero + ".reenviando"
+        if not os.path.exists(reenviando) and (not os.path.exists(self.fichero) or os.path.getsize(self.fichero) == 0):
+            # Nada pendiente: no se crean los ficheros de bloqueo
+            return 0
+        with open(self.fichero + ".reenvio.lock", "a") as reenvio:
+            try:
+                fcntl.flock(reenvio, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            if not os.path.exists(reenviando):
+                with open(self.fichero + ".lock", "a") as cerrojo:
+                    fcntl.flock(cerrojo, fcntl.LOCK_EX)
+                    if not os.path.exists(self.fichero) or os.path.getsize(self.fichero) == 0:
+                        return 0
+                    os.replace(self.fichero, reenviando)
+            with open(reenviando) as f:
+                entradas = [json.loads(linea) for linea in f if linea.strip()]
+            rechazadas = []
+            for inicio in range(0, len(entradas), BUFFER_TROZO):
+                rechazadas += self.reenviar(entradas[inicio:inicio + BUFFER_TROZO]) or []
+            if rechazadas:
+                self._guardar_rechazadas(rechazadas)
+            os.remove(reenviando)
+        with self._cerrojo:
+            self.reenviadas += len(entradas) - len(rechazadas)
+            self.rechazadas += len(rechazadas)
+        print(f"Reenviadas a Redis {len(entradas) - len(rechazadas)} mediciones del buffer de /nuevo"
+              + (f", {len(rechazadas)} rechazadas (ver {self.fichero}.rechazadas)" if rechazadas else ""))
+        return len(entradas)
+
+    def _guardar_rechazadas(self, rechazadas):
+        # Las mediciones rechazadas no se vuelven a intentar (Redis las rechazaría otra vez), pero se
+        # conservan con su error. Si el reenvío se repite tras un fallo a medias, las que ya se habían
+        # escrito aparecen aquí rechazadas por timestamp duplicado
+        for entrada in rechazadas:
+            print(f"ERROR: Redis ha rechazado la medición del buffer {entrada}")
+        with open(self.fichero + ".rechazadas", "a") as f:
+            f.writelines(json.dumps(entrada) + "\n" for entrada in rechazadas)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pendientes(self):
+        total = 0
+        for ruta in (self.fichero, self.fichero + ".reenviando"):
+            if os.path.exists(ruta):
+                with open(ruta) as f:
+                    total += sum(1 for _ in f)
+        return total
+
+    def estadisticas(self):
+        with self._cerrojo:
+            estadisticas = {"guardadas": self.guardadas, "reenviadas": self.reenviadas, "rechazadas": self.rechazadas,
+                            "errores": self.errores}
+        return {"fichero": self.fichero, "pendientes": self.pendientes() if self.activo() else 0, **estadisticas}
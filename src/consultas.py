@@ -0,0 +1,192 @@
+import os
+import json
+import socket
+from datetime import datetime
+from functools import lru_cache
+from itertools import chain
+from urllib.parse import urlencode
+from flask import Response, stream_with_context
+
+# ---------------------------------------------------------------------------------------------------
+# Consultas paginadas y en streaming sobre las series temporales
+# ---------------------------------------------------------------------------------------------------
+# En lugar de traer la serie completa con un único TS.REVRANGE y construir la respuesta en memoria,
+# se leen trozos de TAM_TROZO_CONSULTA muestras con COUNT y se van enviando al cliente según llegan,
+# así el worker nunca tiene en memoria más de un trozo aunque la serie tenga meses de datos.
+#
+# Parámetros de /listar:
+#   desde, hasta: timestamps en milisegundos (por defecto '-' y '+', toda la serie)
+#   limite:       número máximo de muestras de la página (por defecto sin límite)
+#   orden:        'desc' (más recientes primero, por defecto) o 'asc'
+#   cursor:       valor devuelto por la página anterior para pedir la siguiente
+#   formato:      'html' (por defecto), 'json' o 'csv'
+
+TAM_TROZO_CONSULTA = int(os.getenv('TAM_TROZO_CONSULTA', 1000))
+
+FORMATOS = {
+    "html": "text/html; charset=utf-8",
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class ParametroInvalido(ValueError):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def _fecha_segundos(segundos):
+    return datetime.fromtimestamp(segundos).strftime('%d/%m/%Y %H:%M:%S')
+
+
+def fecha_con_formato(timestamp):
+    # Las muestras del mismo segundo comparten la fecha ya formateada
+    return _fecha_segundos(int(timestamp) // 1000)
+
+
+def _timestamp(args, nombre, por_defecto):
+    valor = args.get(nombre, por_defecto)
+    if valor in ('-', '+'):
+        return valor
+    try:
+        valor = int(valor)
+    except (TypeError, ValueError):
+        raise ParametroInvalido(f"'{nombre}' debe ser un timestamp en milisegundos")
+    if valor < 0:
+        raise ParametroInvalido(f"'{nombre}' no puede ser negativo")
+    return valor
+
+
+def leer_rango(args):
+    desde = _timestamp(args, "desde", '-')
+    hasta = _timestamp(args, "hasta", '+')
+    return desde, hasta
+
+
+def leer_parametros(args):
+    desde, hasta = leer_rango(args)
+    orden = args.get("orden", "desc")
+    if orden not in ("asc", "desc"):
+        raise ParametroInvalido("'orden' debe ser 'asc' o 'desc'")
+    if "cursor" in args:
+        # El cursor es el siguiente timestamp a partir del cual continuar, en el sentido del orden
+        if orden == "desc":
+            hasta = _timestamp(args, "cursor", '+')
+        else:
+            desde = _timestamp(args, "cursor", '-')
+    limite = args.get("limite")
+    if limite is not None:
+        try:
+            limite = int(limite)
+        except ValueError:
+            raise ParametroInvalido("'limite' debe ser un número entero")
+        if limite <= 0:
+            raise ParametroInvalido("'limite' debe ser mayor que 0")
+    formato = args.get("formato", "html")
+    if formato not in FORMATOS:
+        raise ParametroInvalido(f"'formato' debe ser uno de {', '.join(FORMATOS)}")
+    return desde, hasta, orden, limite, formato
+
+
+def comando_rango(orden):
+    return 'TS.REVRANGE' if orden == "desc" else 'TS.RANGE'
+
+
+def tam_siguiente_trozo(pendientes, tam_trozo=TAM_TROZO_CONSULTA):
+    return tam_trozo if pendientes is None else min(tam_trozo, pendientes)
+
+
+def avanzar(trozo, n, orden, desde, hasta):
+    # Tras recibir un trozo de las n muestras pedidas devuelve el (desde, hasta) del siguiente trozo,
+    # que empieza justo después de la última muestra recibida, o None si ya no quedan más
+    if len(trozo) < n:
+        return None
+    ultimo = int(trozo[-1][0])
+    if orden == "desc":
+        hasta = ultimo - 1
+        if hasta < 0 or (desde != '-' and hasta < desde):
+            return None
+    else:
+        desde = ultimo + 1
+        if hasta != '+' and desde > hasta:
+            return None
+    return desde, hasta
+
+
+def leer_trozos(redis, clave, desde, hasta, orden="desc", limite=None, tam_trozo=TAM_TROZO_CONSULTA):
+    # Generador de trozos [(time, valor), ...] con TS.RANGE/TS.REVRANGE ... COUNT
+    pendientes = limite
+    while pendientes is None or pendientes > 0:
+        n = tam_siguiente_trozo(pendientes, tam_trozo)
+        trozo = redis.execute_command(comando_rango(orden), clave, desde, hasta, 'COUNT', n)
+        if not trozo:
+            return
+        yield trozo
+        if pendientes is not None:
+            pendientes -= len(trozo)
+        rango = avanzar(trozo, n, orden, desde, hasta)
+        if rango is None:
+            return
+        desde, hasta = rango
+
+
+def cabecera(formato):
+    if formato == "json":
+        return '{"hostname": ' + json.dumps(socket.gethostname()) + ', "mediciones": ['
+    if formato == "csv":
+        return "time,valor\n"
+    return f"<b>Hostname:</b> {socket.gethostname()}<br>"
+
+
+def filas(formato, trozo, plantilla_html, primero=False):
+    # Texto de un trozo de muestras; en JSON los trozos después del primero empiezan con una coma
+    if formato == "json":
+        return ("" if primero else ", ") + ", ".join(
+            f'{{"time": {int(t)}, "valor": {float(v)!r}}}' for t, v in trozo)
+    if formato == "csv":
+        return "".join(f"{int(t)},{float(v)!r}\n" for t, v in trozo)
+    return "".join(plantilla_html.format(fecha=fecha_con_formato(t), valor=v) for t, v in trozo)
+
+
+def pie(formato, args, cursor):
+    if formato == "json":
+        return f'], "cursor": {json.dumps(cursor)}}}'
+    if formato == "html" and cursor is not None and cursor >= 0:
+        parametros = dict(args.items(), cursor=cursor)
+        return f'<a href="?{urlencode(parametros)}">Siguiente página</a><br>'
+    return ""
+
+
+def siguiente_cursor(orden, limite, enviadas, ultimo):
+    # Hay (posiblemente) más páginas si se ha llenado el límite
+    if limite is None or enviadas < limite:
+        return None
+    return ultimo - 1 if orden == "desc" else ultimo + 1
+
+
+def pagina(muestras, formato, args, plantilla_html, orden, limite):
+    # La misma respuesta que listar() pero de una vez, para las páginas que se guardan en la caché
+    ultimo = int(muestras[-1][0]) if muestras else None
+    return (cabecera(formato) + (filas(formato, muestras, plantilla_html, primero=True) if muestras else "")
+            + pie(formato, args, siguiente_cursor(orden, limite, len(muestras), ultimo)))
+
+
+def listar(redis, clave, args, plantilla_html):
+    # Devuelve una respuesta en streaming con la página de muestras pedida
+    desde, hasta, orden, limite, formato = leer_parametros(args)
+    trozos = leer_trozos(redis, clave, desde, hasta, orden, limite)
+
+    # Leemos el primer trozo antes de empezar a responder para que los errores de Redis
+    # (conexión, serie inexistente...) todavía se puedan devolver con su código de estado
+    primero = next(trozos, None)
+
+    def cuerpo():
+        yield cabecera(formato)
+        enviadas, ultimo = 0, None
+        for trozo in chain([primero], trozos) if primero else ():
+            yield filas(formato, trozo, plantilla_html, primero=enviadas == 0)
+            enviadas += len(trozo)
+            ultimo = int(trozo[-1][0])
+        yield pie(formato, args, siguiente_cursor(orden, limite, enviadas, ultimo))
+
+    return Response(stream_with_context(cuerpo()), content_type=FORMATOS[formato])
@@ -0,0 +1,289 @@
+import os
+import sys
+import time
+import signal
+import socket
+import numpy as np
+from redis import ResponseError
+import ingesta
+import agregados
+import puntuacion
+import series
+import conexiones
+import comandos
+
+# ---------------------------------------------------------------------------------------------------
+# Detección asíncrona con Redis Streams
+# ---------------------------------------------------------------------------------------------------
+# Con DETECCION_ASINCRONA=1 /nuevo no espera al modelo: añade la medición a la serie (TS.ADD) y a un
+# stream de Redis (XADD a DETECCION_STREAM) y responde. Uno o varios procesos detectores, lanzados aparte
+# y sin servidor web, leen el stream como consumidores de un mismo grupo (XREADGROUP), así que cada
+# medición la procesa un solo detector y se puede escalar el número de detectores según la carga:
+#
+#   python src/detector.py              (desde la raíz del proyecto; usa MODO_REDIS como main-ej3.py)
+#
+# Cada detector lee lotes de hasta DETECCION_LOTE mediciones, las agrupa por sensor y las puntúa como
+# /detectar/lote (puntuacion.py): la ventana de cada medición son las windows_size muestras anteriores de
+# la serie y las ventanas de cada sensor se predicen juntas en llamadas grandes al modelo, en lugar de
+# una llamada por medición. Los resultados se escriben en series propias junto a la del sensor:
+#   '{<serie>}:anomalias'     1 si la medición es anómala, 0 si no
+#   '{<serie>}:predicciones'  valor predicho por el modelo
+# y después se confirman las mediciones con XACK. Si un detector se cae con mediciones sin confirmar,
+# otro las reclama (XAUTOCLAIM) cuando llevan DETECCION_RECLAMAR_MS sin confirmarse.
+#
+# Si falla la puntuación de un sensor, sus mediciones se quedan sin confirmar y se reintentan cuando se
+# reclaman; tras DETECCION_MAX_ENTREGAS entregas (o al momento si el mensaje está mal formado) se pasan
+# con el error al stream DETECCION_STREAM_FALLIDAS y se confirman, para que una medición que hace fallar
+# al detector no se reparta indefinidamente entre todos.
+#
+# Los sensores con modelos propios en el registro de modelos (modelos.py) se puntúan con la versión activa
+# de su modelo; el resto, con el modelo base.
+
+DETECCION_ASINCRONA = os.getenv('DETECCION_ASINCRONA', '0') == '1'
+DETECCION_STREAM = os.getenv('DETECCION_STREAM', 'detectar:pendientes')
+DETECCION_GRUPO = os.getenv('DETECCION_GRUPO', 'detectores')
+# Longitud aproximada máxima del stream (XADD MAXLEN ~): las mediciones más antiguas se descartan
+DETECCION_STREAM_MAXLEN = int(os.getenv('DETECCION_STREAM_MAXLEN', 1000000))
+# Mediciones por lote y espera máxima (ms) de XREADGROUP cuando no hay ninguna
+DETECCION_LOTE = int(os.getenv('DETECCION_LOTE', 1000))
+DETECCION_BLOQUEO_MS = int(os.getenv('DETECCION_BLOQUEO_MS', 1000))
+# Tiempo sin confirmar tras el que otro detector reclama una medición
+DETECCION_RECLAMAR_MS = int(os.getenv('DETECCION_RECLAMAR_MS', 60000))
+# Entregas de una medición que falla antes de pasarla al stream de fallidas
+DETECCION_MAX_ENTREGAS = int(os.getenv('DETECCION_MAX_ENTREGAS', 3))
+DETECCION_STREAM_FALLIDAS = os.getenv('DETECCION_STREAM_FALLIDAS', 'detectar:fallidas')
+# Cada cuántos segundos se imprime el resumen de lo procesado
+DETECCION_INFORME_S = float(os.getenv('DETECCION_INFORME_S', 10))
+
+
+def clave_predicciones(clave):
+    return agregados.clave_derivada(clave, "predicciones")
+
+
+def claves_resultados(clave):
+    # Series de resultados de la serie 'clave' que escriben los detectores y /detectar/lote (se borran con ella)
+    return [puntuacion.clave_anomalias(clave), clave_predicciones(clave), puntuacion.clave_anomalias_csv(clave)]
+
+
+def claves_serie_completa(clave):
+    # Todo lo que se borra con /borrar sin rango: la serie, sus compactadas y sus resultados
+    return [clave, *agregados.claves_compactadas(clave), *claves_resultados(clave)]
+
+
+def pasos_borrar_rango(clave, desde, hasta):
+    # /borrar con rango: las mediciones (recalculando las compactadas, ver agregados.py) y los resultados
+    # de la detección del mismo rango. Devuelve el número de mediciones borradas
+    borradas = yield from agregados.pasos_borrar_rango(clave, desde, hasta)
+    for resultados_clave in claves_resultados(clave):
+        if (yield ['EXISTS', resultados_clave]):
+            yield ['TS.DEL', resultados_clave, *agregados.limites_borrado(desde, hasta)]
+    return borradas
+
+
+def borrar_rango(redis, clave, desde, hasta):
+    return comandos.ejecutar(redis, pasos_borrar_rango(clave, desde, hasta))
+
+
+def publicar(redis, sensor, timestamp, valor):
+    # Encola la medición para los detectores
+    redis.xadd(DETECCION_STREAM, {"sensor": sensor or "", "time": timestamp, "valor": valor},
+               maxlen=DETECCION_STREAM_MAXLEN, approximate=True)
+
+
+def anadir_y_publicar(redis, clave, sensor, timestamp, valor):
+    # TS.ADD de la medición y XADD al stream en un solo viaje a Redis. El pipeline no es transaccional
+    # porque en modo CLUSTER la serie y el stream están en slots distintos
+    pipe = redis.pipeline(transaction=False)
+    pipe.execute_command('TS.ADD', clave, timestamp, valor)
+    publicar(pipe, sensor, timestamp, valor)
+    pipe.execute()
+
+
+async def anadir_y_publicar_async(redis, clave, sensor, timestamp, valor):
+    # Igual que anadir_y_publicar con un cliente de redis.asyncio (main-ej3-async.py)
+    pipe = redis.pipeline(transaction=False)
+    pipe.execute_command('TS.ADD', clave, timestamp, valor)
+    publicar(pipe, sensor, timestamp, valor)
+    await pipe.execute()
+
+
+class Detector:
+    def __init__(self, redis, predecir, escalar, windows_size, umbral, nombre=None, registro=None):
+        self.redis = redis
+        self.predecir = predecir
+        self.escalar = escalar
+        self.windows_size = windows_size
+        self.umbral = umbral
+        self.registro = registro
+        self.nombre = nombre or f"{socket.gethostname()}-{os.getpid()}"
+        self.activo = True
+        self.procesadas = 0
+        self.anomalias = 0
+        self.sin_ventana = 0
+        self.fallidas = 0
+
+    def crear_grupo(self):
+        # El grupo empieza en el principio del stream para no perder las mediciones ya encoladas
+        try:
+            self.redis.xgroup_create(DETECCION_STREAM, DETECCION_GRUPO, id='0', mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _leer(self):
+        # Primero las mediciones abandonadas por un detector caído y después las nuevas
+        _, mensajes, *_ = self.redis.xautoclaim(DETECCION_STREAM, DETECCION_GRUPO, self.nombre,
+                                                DETECCION_RECLAMAR_MS, '0-0', count=DETECCION_LOTE)
+        if mensajes:
+            return mensajes
+        respuesta = self.redis.xreadgroup(DETECCION_GRUPO, self.nombre, {DETECCION_STREAM: '>'},
+                                          count=DETECCION_LOTE, block=DETECCION_BLOQUEO_MS)
+        return respuesta[0][1] if respuesta else []
+
+    def procesar(self, mensajes):
+        # Puntúa las mediciones del lote por sensor, escribe los resultados y confirma las puntuadas. Un error
+        # en un sensor no afecta al resto del lote
+        campos_por_id = dict(mensajes)
+        por_sensor = {}
+        confirmar = []
+        fallidas = {}
+        for identificador, campos in mensajes:
+            if not campos:
+                confirmar.append(identificador)
+                continue
+            try:
+                por_sensor.setdefault(campos["sensor"] or None, {})[identificador] = int(campos["time"])
+            except (KeyError, ValueError) as e:
+                # No se podrá puntuar nunca: directamente a fallidas
+                fallidas[identificador] = f"mensaje mal formado: {e!r}"
+        reintentar = {}
+        for sensor, marcas in por_sensor.items():
+            try:
+                self._puntuar(series.clave_serie(sensor), set(marcas.values()), *self._modelo(sensor))
+            except conexiones.ERRORES_TRANSITORIOS:
+                raise
+            except Exception as e:
+                # Por ejemplo la serie se ha borrado después de encolar la medición o el modelo del sensor no
+                # se puede cargar
+                print(f"ERROR: no se pudieron puntuar {len(marcas)} mediciones del sensor '{sensor}': {e!r}")
+                reintentar.update(dict.fromkeys(marcas, repr(e)))
+                continue
+            confirmar += marcas
+        if reintentar:
+            # Las que ya se han entregado DETECCION_MAX_ENTREGAS veces no se vuelven a intentar; el resto se
+            # queda sin confirmar hasta que se reclame
+            entregas = self._entregas(list(reintentar))
+            fallidas.update({identificador: error for identificador, error in reintentar.items()
+                             if entregas.get(identificador, DETECCION_MAX_ENTREGAS) >= DETECCION_MAX_ENTREGAS})
+        if confirmar or fallidas:
+            pipe = self.redis.pipeline(transaction=False)
+            for identificador, error in fallidas.items():
+                pipe.xadd(DETECCION_STREAM_FALLIDAS, {**campos_por_id[identificador], "id": identificador,
+                                                      "error": error, "detector": self.nombre},
+                          maxlen=DETECCION_STREAM_MAXLEN, approximate=True)
+            pipe.xack(DETECCION_STREAM, DETECCION_GRUPO, *confirmar, *fallidas)
+            pipe.execute()
+        self.procesadas += len(confirmar)
+        self.fallidas += len(fallidas)
+
+    def _entregas(self, identificadores):
+        # Veces que se ha entregado cada medición pendiente (XPENDING)
+        pipe = self.redis.pipeline(transaction=False)
+        for identificador in identificadores:
+            pipe.xpending_range(DETECCION_STREAM, DETECCION_GRUPO, min=identificador, max=identificador, count=1)
+        return {p["message_id"]: p["times_delivered"] for pendientes in pipe.execute() for p in pendientes}
+
+    def _modelo(self, sensor):
+        # (predecir, escalar, windows_size, umbral) del modelo propio del sensor o del modelo base
+        modelo = self.registro.obtener(sensor or series.SENSOR_POR_DEFECTO) if self.registro else None
+        if modelo is None:
+            return self.predecir, self.escalar, self.windows_size, self.umbral
+        return modelo.predecir, modelo.escalar, modelo.windows_size, modelo.threshold / 4
+
+    def _puntuar(self, clave, marcas, predecir, escalar, windows_size, umbral):
+        # Se lee el rango del lote con las windows_size muestras anteriores como contexto; solo se escriben
+        # los resultados de las mediciones del lote
+        trozos = puntuacion.trozos_redis(self.redis, clave, min(marcas), max(marcas), contexto=windows_size)
+        evaluadas = 0
+        for t, _, predicciones, anomalas in puntuacion.puntuar(trozos, predecir, escalar, windows_size, umbral):
+            del_lote = np.isin(t, list(marcas))
+            t, predicciones, anomalas = t[del_lote], predicciones[del_lote], anomalas[del_lote]
+            if not len(t):
+                continue
+            for destino, tipo, valores in ((puntuacion.clave_anomalias(clave), 'anomalias', anomalas.astype(int)),
+                                           (clave_predicciones(clave), 'predicciones', predicciones)):
+                # Si una medición se vuelve a puntuar (reclamada tras una caída) se sobrescribe el resultado
+                ingesta.asegurar_serie(self.redis, destino, ['tipo', tipo], politica_duplicados='LAST')
+                for argumentos in agregados.comandos_madd(destino, list(zip(t.tolist(), valores.tolist()))):
+                    self.redis.execute_command(*argumentos)
+            evaluadas += len(t)
+            self.anomalias += int(anomalas.sum())
+        # Las primeras mediciones de una serie no tienen ventana completa y no se puntúan
+        self.sin_ventana += len(marcas) - evaluadas
+
+    def ejecutar(self):
+        self.crear_grupo()
+        print(f"Detector '{self.nombre}' leyendo el stream '{DETECCION_STREAM}' (grupo '{DETECCION_GRUPO}')")
+        informe = time.monotonic()
+        while self.activo:
+            try:
+                self.procesar(self._leer())
+            except conexiones.ERRORES_TRANSITORIOS as e:
+                # Las mediciones leídas y sin confirmar se vuelven a reclamar pasado DETECCION_RECLAMAR_MS
+                print(f"ERROR: Redis no disponible, se reintentará: {e}")
+                time.sleep(conexiones.BUFFER_REINTENTO_S)
+            if time.monotonic() - informe >= DETECCION_INFORME_S:
+                informe = time.monotonic()
+                print(f"Procesadas {self.procesadas} mediciones: {self.anomalias} anómalas, "
+                      f"{self.sin_ventana} sin ventana completa, {self.fallidas} fallidas")
+
+
+def conectar(modo):
+    # Cliente de Redis del modo indicado, con las mismas variables de entorno que main-ej3.py. El timeout
+    # tiene que ser mayor que la espera de XREADGROUP
+    timeout_s = max(conexiones.timeout(0), DETECCION_BLOQUEO_MS / 1000 + 2)
+    if modo == 'SENTINEL':
+        from redis.sentinel import Sentinel
+        sentinel = Sentinel([(os.getenv('SENTINEL_HOST', 'sentinel1'), 26379),
+                             (os.getenv('SENTINEL_HOST2', 'sentinel2'), 26380),
+                             (os.getenv('SENTINEL_HOST3', 'sentinel3'), 26381)], socket_timeout=0.1)
+        return sentinel.master_for('mymaster', socket_timeout=timeout_s, decode_responses=True,
+                                   **conexiones.opciones())
+    if modo == 'CLUSTER':
+        from redis.cluster import RedisCluster
+        return RedisCluster(startup_nodes=[{"host": os.getenv(variable, nodo), "port": 6379} for variable, nodo in
+                                           (('REDIS_HOST', 'redis-node-1'), ('REDIS_HOST2', 'redis-node-2'),
+                                            ('REDIS_HOST3', 'redis-node-3'))],
+                            decode_responses=True, skip_full_coverage_check=True,
+                            socket_timeout=timeout_s, socket_connect_timeout=5, **conexiones.opciones())
+    from redis import Redis
+    return Redis(connection_pool=conexiones.pool_simple(os.getenv('REDIS_HOST', 'localhost'), db=0,
+                                                        socket_connect_timeout=2, socket_timeout=timeout_s,
+                                                        decode_responses=True))
+
+
+if __name__ == "__main__":
+    import json
+    import joblib
+    import inferencia
+    import ventanas
+    import modelos
+
+    redis = conectar(os.getenv('MODO_REDIS', 'SIMPLE'))
+    model = inferencia.cargar_modelo('src/modelo.keras', 'src/modelo_pesos.npz')
+    with open("src/config.json", "r") as f:
+        data = json.load(f)
+    # Mismo criterio que /detectar: anomalía si el error supera la cuarta parte del umbral
+    detector = Detector(redis, model.predict_on_batch, ventanas.funcion_escalado(joblib.load('src/scaler.pkl')),
+                        data['windows_size'], data['threshold'] / 4, registro=modelos.RegistroModelos(redis))
+
+    def parar(*_):
+        # Termina al acabar el lote actual (las mediciones leídas se confirman antes de salir)
+        detector.activo = False
+
+    signal.signal(signal.SIGTERM, parar)
+    signal.signal(signal.SIGINT, parar)
+    try:
+        detector.ejecutar()
+    except Exception as e:
+        sys.exit(f"ERROR: el detector se ha detenido => {e}")
@@ -0,0 +1,178 @@
+import os
+import io
+import zlib
+import importlib.util
+from itertools import chain
+import numpy as np
+from flask import Response, stream_with_context
+import consultas
+import ingesta
+
+# ---------------------------------------------------------------------------------------------------
+# Exportación de rangos en formato binario
+# ---------------------------------------------------------------------------------------------------
+# /listar está pensado para personas (fechas con formato europeo en HTML, o JSON/CSV en texto). Para
+# análisis /exportar envía el rango pedido con los timestamps como int64 (milisegundos) y los valores
+# como float64, sin formatear nada, en uno de estos formatos:
+#   npy:     array de NumPy con registros (time, valor); se lee con np.load(f)['time'] / ['valor']
+#   arrow:   flujo IPC de Apache Arrow (un record batch por trozo, columnas 'time' y 'valor'); se lee con
+#            pyarrow.ipc.open_stream(f).read_all() o pandas/polars
+#   binario: registros de 16 bytes little-endian (int64 + float64) sin cabecera, el mismo formato que
+#            acepta POST /nuevo_lote, así que una exportación se puede volver a importar tal cual
+#
+# Las muestras se leen de Redis en trozos de EXPORTAR_TROZO y cada trozo se convierte y se envía antes
+# de leer el siguiente, así que exportar millones de puntos no necesita más memoria que un trozo.
+# Opcionalmente el flujo se comprime con gzip o zstd (cabecera Content-Encoding).
+#
+# La cabecera de npy lleva el número de registros antes de enviar ninguno. Por eso, al empezar, el rango
+# se fija a la primera y la última muestra actuales y se cuentan las que hay entre ellas: las mediciones
+# nuevas quedan fuera. Un borrado (/borrar o la retención) de muestras del rango durante la exportación sí
+# la deja con menos registros de los anunciados; en ese caso se corta el flujo con un error en lugar de
+# enviar un .npy que no se puede leer. Las muestras que se inserten con fecha pasada dentro del rango no
+# se envían más allá del recuento. Arrow y binario no tienen este problema porque no anuncian el tamaño.
+
+EXPORTAR_TROZO = int(os.getenv('EXPORTAR_TROZO', 50000))
+# Nivel de compresión de gzip (1-9) y zstd (1-22)
+EXPORTAR_NIVEL_GZIP = int(os.getenv('EXPORTAR_NIVEL_GZIP', 6))
+EXPORTAR_NIVEL_ZSTD = int(os.getenv('EXPORTAR_NIVEL_ZSTD', 3))
+
+FORMATOS = {
+    "npy": ("application/x-npy", "npy"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "binario": ("application/octet-stream", "bin"),
+}
+COMPRESIONES = ("ninguna", "gzip", "zstd")
+
+# Módulos opcionales que necesita cada formato o compresión
+DEPENDENCIAS = {"arrow": "pyarrow", "zstd": "zstandard"}
+
+
+class ParametroInvalido(ValueError):
+    pass
+
+
+class ExportacionIncompleta(RuntimeError):
+    pass
+
+
+def _comprobar_dependencia(nombre):
+    modulo = DEPENDENCIAS.get(nombre)
+    if modulo and importlib.util.find_spec(modulo) is None:
+        raise ParametroInvalido(f"'{nombre}' no está disponible en este servidor (falta el paquete {modulo})")
+
+
+def leer_parametros(args):
+    desde, hasta = consultas.leer_rango(args)
+    formato = args.get("formato", "npy")
+    if formato not in FORMATOS:
+        raise ParametroInvalido(f"'formato' debe ser uno de {', '.join(FORMATOS)}")
+    compresion = args.get("compresion", "ninguna")
+    if compresion not in COMPRESIONES:
+        raise ParametroInvalido(f"'compresion' debe ser una de {', '.join(COMPRESIONES)}")
+    _comprobar_dependencia(formato)
+    _comprobar_dependencia(compresion)
+    return desde, hasta, formato, compresion
+
+
+def registros(trozo):
+    # Trozo [(time, valor), ...] de Redis => array de registros ingesta.REGISTRO_BINARIO
+    pares = np.asarray(trozo, dtype=np.float64)
+    salida = np.empty(len(pares), dtype=ingesta.REGISTRO_BINARIO)
+    salida["time"] = pares[:, 0]
+    salida["valor"] = pares[:, 1]
+    return salida
+
+
+def contar(redis, clave, desde, hasta):
+    # Número de muestras del rango con un único bucket de TS.RANGE ... AGGREGATION count
+    respuesta = redis.execute_command('TS.RANGE', clave, desde, hasta, 'AGGREGATION', 'count', ingesta.MAX_TIMESTAMP)
+    return int(float(respuesta[0][1])) if respuesta else 0
+
+
+def cabecera_npy(total):
+    cabecera = io.BytesIO()
+    np.lib.format.write_array_header_1_0(cabecera, {
+        "descr": np.lib.format.dtype_to_descr(ingesta.REGISTRO_BINARIO), "fortran_order": False, "shape": (total,)})
+    return cabecera.getvalue()
+
+
+def _cuerpo_npy(trozos, total):
+    yield cabecera_npy(total)
+    enviados = 0
+    for trozo in trozos:
+        yield registros(trozo).tobytes()
+        enviados += len(trozo)
+    if enviados < total:
+        raise ExportacionIncompleta(f"se anunciaron {total} registros y solo se han enviado {enviados}: se han "
+                                    f"borrado muestras del rango durante la exportación")
+
+
+def _cuerpo_binario(trozos):
+    for trozo in trozos:
+        yield registros(trozo).tobytes()
+
+
+def _cuerpo_arrow(trozos, clave):
+    import pyarrow as pa
+    esquema = pa.schema([("time", pa.int64()), ("valor", pa.float64())], metadata={"serie": clave})
+    sumidero = io.BytesIO()
+    with pa.ipc.new_stream(sumidero, esquema) as escritor:
+        for trozo in trozos:
+            datos = registros(trozo)
+            escritor.write_batch(pa.record_batch([datos["time"], datos["valor"]], schema=esquema))
+            # Enviamos lo escrito hasta ahora y vaciamos el buffer
+            yield sumidero.getvalue()
+            sumidero.seek(0)
+            sumidero.truncate()
+    yield sumidero.getvalue()
+
+
+def _comprimir(partes, compresion):
+    if compresion == "gzip":
+        compresor = zlib.compressobj(EXPORTAR_NIVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compresion == "zstd":
+        import zstandard
+        compresor = zstandard.ZstdCompressor(level=EXPORTAR_NIVEL_ZSTD).compressobj()
+    else:
+        yield from partes
+        return
+    for parte in partes:
+        comprimida = compresor.compress(parte)
+        if comprimida:
+            yield comprimida
+    yield compresor.flush()
+
+
+def exportar(redis, clave, args, nombre="mediciones"):
+    # Respuesta en streaming con el rango pedido en el formato y la compresión indicados
+    desde, hasta, formato, compresion = leer_parametros(args)
+
+    total = None
+    if formato == "npy":
+        # La cabecera de .npy lleva el número de registros: fijamos el rango en la primera y la última
+        # muestra actuales para que las que lleguen mientras se exporta no cambien el recuento
+        if hasta == '+':
+            ultima = redis.execute_command('TS.GET', clave)
+            hasta = int(ultima[0]) if ultima else 0
+        primera = redis.execute_command('TS.RANGE', clave, desde, hasta, 'COUNT', 1)
+        if primera:
+            desde = int(primera[0][0])
+        total = contar(redis, clave, desde, hasta)
+    trozos = consultas.leer_trozos(redis, clave, desde, hasta, "asc", total, tam_trozo=EXPORTAR_TROZO)
+
+    # Como en consultas.listar, el primer trozo se lee antes de responder para que los errores de Redis
+    # todavía se devuelvan con su código de estado
+    primero = next(trozos, None)
+    trozos = chain([primero], trozos) if primero else ()
+    if formato == "npy":
+        cuerpo = _cuerpo_npy(trozos, total)
+    elif formato == "arrow":
+        cuerpo = _cuerpo_arrow(trozos, clave)
+    else:
+        cuerpo = _cuerpo_binario(trozos)
+
+    tipo, extension = FORMATOS[formato]
+    cabeceras = {"Content-Disposition": f'attachment; filename="{nombre}.{extension}"'}
+    if compresion != "ninguna":
+        cabeceras["Content-Encoding"] = compresion
+    return Response(stream_with_context(_comprimir(cuerpo, compresion)), content_type=tipo, headers=cabeceras)
@@ -0,0 +1,74 @@
+import os
+import sys
+import importlib.util
+import multiprocessing
+
+# ---------------------------------------------------------------------------------------------------
+# Configuración de Gunicorn (modo de producción)
+# ---------------------------------------------------------------------------------------------------
+# Sustituye al servidor de desarrollo de Flask (app.run) por varios procesos worker, cada uno con
+# varios hilos. Se lanza, por ejemplo, con:
+#   gunicorn --config src/gunicorn.conf.py --pythonpath src main-ej3:app
+#
+# Con preload_app el proceso maestro importa la aplicación (modelo, escalador y config.json) una sola
+# vez antes de hacer fork, y los workers comparten esa memoria por copy-on-write. Solo se activa por
+# defecto cuando el modelo no se carga con TensorFlow (ver _precarga_segura). La aplicación carga el
+# modelo en segundo plano (arranque.py), así que antes de cada fork se espera a que termine.
+#
+# Recarga ordenada: 'kill -HUP <pid maestro>' arranca workers nuevos y deja terminar las peticiones en
+# curso de los antiguos (hasta graceful_timeout). Como la aplicación está precargada, los workers nuevos
+# reutilizan el código y el modelo ya cargados; para cambiar de versión se despliega un contenedor nuevo.
+
+# Obtiene el puerto de la variable de entorno PORT, igual que app.run, por defecto el 80
+bind = f"0.0.0.0:{os.getenv('PORT', 80)}"
+
+# Número de procesos worker y de hilos por worker
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('WEB_THREADS', 4))
+worker_class = "gthread"
+
+
+def _precarga_segura():
+    # El motor NumPy del modelo es seguro tras un fork, pero TensorFlow no: si el modelo se va a cargar
+    # con Keras (MODELO_BACKEND=keras, o auto con TensorFlow instalado, como en Dockerfile-ej2/ej3) cada
+    # worker importa la aplicación por su cuenta. Las réplicas sin modelo (ROL=ingesta|consulta) no lo cargan
+    rol = os.getenv('ROL', os.getenv('ROLE', 'todo')).lower()
+    backend = os.getenv('MODELO_BACKEND', 'auto')
+    if rol in ('ingesta', 'consulta', 'ingest', 'query') or backend == 'numpy':
+        return True
+    return backend != 'keras' and importlib.util.find_spec('tensorflow') is None
+
+
+# Carga la aplicación antes del fork; PRELOAD_APP=1|0 fuerza el valor
+preload_app = os.getenv('PRELOAD_APP', '1' if _precarga_segura() else '0') == '1'
+
+# Una petición que tarde más de 'timeout' segundos hace que se reinicie el worker
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Reinicia cada worker tras un número de peticiones (con algo de aleatoriedad para que no coincidan)
+# para acotar el crecimiento de memoria; 0 lo desactiva
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def pre_fork(server, worker):
+    # Los hilos del arranque no pasan al worker: esperamos a que el maestro termine de cargar el modelo
+    # para que los workers lo hereden ya cargado. La conexión con Redis (que se reintenta) no se espera,
+    # cada worker la vuelve a intentar por su cuenta
+    arranque = sys.modules.get("arranque")
+    if arranque is not None:
+        arranque.esperar_todas()
+
+
+def post_fork(server, worker):
+    # El worker relanza al momento las tareas del arranque que no habían terminado en el maestro (por
+    # ejemplo la conexión con Redis), en lugar de esperar a la primera petición que las compruebe
+    arranque = sys.modules.get("arranque")
+    if arranque is not None:
+        arranque.comprobar_fork()
@@ -0,0 +1,315 @@
+import os
+import copy
+import time
+import queue
+import threading
+import numpy as np
+
+# ---------------------------------------------------------------------------------------------------
+# Planificador de inferencia por micro-lotes
+# ---------------------------------------------------------------------------------------------------
+# Cada llamada a model.predict tiene un coste fijo muy superior al cálculo de la LSTM de 50 unidades,
+# así que en lugar de hacer una predicción por petición se encolan las ventanas y un único hilo las
+# agrupa en un lote, hace una sola pasada hacia delante y devuelve a cada petición su predicción.
+# El lote se cierra al llegar a INFERENCIA_MAX_LOTE ventanas o al agotar INFERENCIA_ESPERA_MS.
+
+INFERENCIA_MAX_LOTE = int(os.getenv('INFERENCIA_MAX_LOTE', 32))
+INFERENCIA_ESPERA_MS = float(os.getenv('INFERENCIA_ESPERA_MS', 3))
+# Tiempo máximo que una petición espera su predicción antes de dar error
+INFERENCIA_TIMEOUT_S = float(os.getenv('INFERENCIA_TIMEOUT_S', 30))
+
+# Límites superiores de los cubos de los histogramas de estadísticas
+CUBOS_TAM_LOTE = (1, 2, 4, 8, 16, 32, 64, 128)
+CUBOS_ESPERA_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+
+class _Peticion:
+    __slots__ = ("predecir", "ventana", "encolada", "evento", "resultado", "error")
+
+    def __init__(self, predecir, ventana):
+        self.predecir = predecir
+        self.ventana = ventana
+        self.encolada = time.perf_counter()
+        self.evento = threading.Event()
+        self.resultado = None
+        self.error = None
+
+
+class Histograma:
+    # Histograma acumulado sencillo: cuenta, suma y número de observaciones por debajo de cada límite
+    def __init__(self, cubos):
+        self.cubos = tuple(cubos)
+        self.cuentas = [0] * len(self.cubos)
+        self.total = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    def observar(self, valor):
+        self.total += 1
+        self.suma += valor
+        self.maximo = max(self.maximo, valor)
+        for i, limite in enumerate(self.cubos):
+            if valor <= limite:
+                self.cuentas[i] += 1
+
+    def resumen(self):
+        return {
+            "total": self.total,
+            "suma": self.suma,
+            "media": self.suma / self.total if self.total else 0.0,
+            "maximo": self.maximo,
+            "cubos": {str(limite): cuenta for limite, cuenta in zip(self.cubos, self.cuentas)},
+        }
+
+
+class PlanificadorInferencia:
+    def __init__(self, max_lote=INFERENCIA_MAX_LOTE, espera_ms=INFERENCIA_ESPERA_MS, timeout_s=INFERENCIA_TIMEOUT_S):
+        self.max_lote = max_lote
+        self.espera_s = espera_ms / 1000
+        self.timeout_s = timeout_s
+        self._cola = queue.Queue()
+        self._cerrojo = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self._tam_lote = Histograma(CUBOS_TAM_LOTE)
+        self._espera = Histograma(CUBOS_ESPERA_MS)
+
+    def predecir(self, predecir, ventana):
+        # predecir: función que recibe un array (n, windows_size, 1) y devuelve n predicciones.
+        # Las ventanas que comparten función se agrupan en el mismo lote.
+        self._asegurar_hilo()
+        peticion = _Peticion(predecir, np.asarray(ventana, dtype=np.float32).reshape(-1, 1))
+        self._cola.put(peticion)
+        if not peticion.evento.wait(self.timeout_s):
+            raise TimeoutError(f"la predicción no terminó en {self.timeout_s} s")
+        if peticion.error is not None:
+            raise peticion.error
+        return peticion.resultado
+
+    def estadisticas(self):
+        with self._cerrojo:
+            return {
+                "max_lote": self.max_lote,
+                "espera_ms": self.espera_s * 1000,
+                "en_cola": self._cola.qsize(),
+                "tam_lote": self._tam_lote.resumen(),
+                "espera_cola_ms": self._espera.resumen(),
+            }
+
+    def histogramas(self):
+        # Copia de los histogramas de tamaño de lote y espera en cola, y ventanas en cola (para /metrics)
+        with self._cerrojo:
+            return copy.deepcopy(self._tam_lote), copy.deepcopy(self._espera), self._cola.qsize()
+
+    def _asegurar_hilo(self):
+        # El hilo se arranca en la primera petición y se vuelve a arrancar si el proceso se ha
+        # bifurcado (los hilos no sobreviven a un fork, por ejemplo con workers precargados)
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._cerrojo:
+            if self._pid != os.getpid() or self._hilo is None or not self._hilo.is_alive():
+                if self._pid != os.getpid():
+                    self._cola = queue.Queue()
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name="planificador-inferencia", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self):
+        cola = self._cola
+        while True:
+            lote = [cola.get()]
+            limite = time.perf_counter() + self.espera_s
+            while len(lote) < self.max_lote:
+                restante = limite - time.perf_counter()
+                try:
+                    # Si ya hay peticiones esperando las recogemos sin bloquear
+                    lote.append(cola.get(timeout=restante) if restante > 0 else cola.get_nowait())
+                except queue.Empty:
+                    break
+            self._ejecutar(lote)
+
+    def _ejecutar(self, lote):
+        inicio = time.perf_counter()
+        grupos = {}
+        for peticion in lote:
+            grupos.setdefault(peticion.predecir, []).append(peticion)
+
+        with self._cerrojo:
+            for peticion in lote:
+                self._espera.observar((inicio - peticion.encolada) * 1000)
+
+        for predecir, peticiones in grupos.items():
+            with self._cerrojo:
+                self._tam_lote.observar(len(peticiones))
+            try:
+                X = np.stack([p.ventana for p in peticiones])
+                predicciones = np.asarray(predecir(X), dtype=np.float64).reshape(len(peticiones), -1)
+                for p, prediccion in zip(peticiones, predicciones):
+                    p.resultado = float(prediccion[0])
+            except Exception as e:
+                for p in peticiones:
+                    p.error = e
+            for p in peticiones:
+                p.evento.set()
+
+
+# ---------------------------------------------------------------------------------------------------
+# Motor de inferencia solo con NumPy
+# ---------------------------------------------------------------------------------------------------
+# Reproduce la pasada hacia delante del modelo de la práctica 1 (LSTM(50, activation='relu') + Dense(1))
+# a partir de los pesos exportados con src_p1/exportar_pesos.py, sin importar TensorFlow/Keras.
+# Usa el mismo orden de puertas que Keras en el kernel de la LSTM: entrada, olvido, celda y salida.
+
+# Backend del modelo: 'keras', 'numpy', 'tflite-float16' o 'tflite-int8' (ver cargar_modelo). 'auto' usa
+# TFLite float16 solo si está instalado ai-edge-litert y existe el modelo exportado, si no Keras si
+# TensorFlow está instalado y NumPy en caso contrario. Con otros intérpretes TFLite hay que pedirlo
+# expresamente con MODELO_BACKEND
+MODELO_BACKEND = os.getenv('MODELO_BACKEND', 'auto')
+BACKENDS = ('keras', 'numpy', 'tflite-float16', 'tflite-int8')
+
+ACTIVACIONES = {
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "linear": lambda x: x,
+}
+
+
+class ModeloNumpy:
+    def __init__(self, ruta_pesos):
+        with np.load(ruta_pesos, allow_pickle=False) as pesos:
+            self.kernel = pesos["kernel"].astype(np.float32)
+            self.recurrent_kernel = pesos["recurrent_kernel"].astype(np.float32)
+            self.bias = pesos["bias"].astype(np.float32)
+            self.dense_kernel = pesos["dense_kernel"].astype(np.float32)
+            self.dense_bias = pesos["dense_bias"].astype(np.float32)
+            self.activacion = ACTIVACIONES[str(pesos["activation"])]
+            self.activacion_recurrente = ACTIVACIONES[str(pesos["recurrent_activation"])]
+        self.unidades = self.recurrent_kernel.shape[0]
+
+    def predict_on_batch(self, X):
+        # X: (n, pasos, características); devuelve (n, 1)
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 2:
+            X = X[:, :, np.newaxis]
+        n, pasos, _ = X.shape
+        u = self.unidades
+        # La contribución de la entrada se calcula para todos los pasos de una sola vez
+        entradas = X @ self.kernel + self.bias
+        h = np.zeros((n, u), dtype=np.float32)
+        c = np.zeros((n, u), dtype=np.float32)
+        for t in range(pasos):
+            z = entradas[:, t, :] + h @ self.recurrent_kernel
+            i = self.activacion_recurrente(z[:, :u])
+            f = self.activacion_recurrente(z[:, u:2 * u])
+            c = f * c + i * self.activacion(z[:, 2 * u:3 * u])
+            o = self.activacion_recurrente(z[:, 3 * u:])
+            h = o * self.activacion(c)
+        return h @ self.dense_kernel + self.dense_bias
+
+    def predict(self, X, verbose=0):
+        return self.predict_on_batch(X)
+
+
+# ---------------------------------------------------------------------------------------------------
+# Motor de inferencia con TFLite
+# ---------------------------------------------------------------------------------------------------
+# src_p1/exportar_tflite.py convierte modelo.keras a TFLite junto a él en dos variantes:
+#   modelo_float16.tflite: pesos en float16 (la mitad de tamaño, predicciones casi idénticas)
+#   modelo_int8.tflite:    cuantización de rango dinámico (pesos en int8, activaciones en float32)
+# El intérprete se toma de ai-edge-litert, tflite-runtime o TensorFlow, el primero que esté instalado,
+# así que las réplicas pueden usar TFLite sin instalar TensorFlow.
+
+# Hilos de cada intérprete de TFLite
+TFLITE_HILOS = int(os.getenv('TFLITE_HILOS', 1))
+
+INTERPRETES_TFLITE = (
+    ("ai_edge_litert", "ai_edge_litert.interpreter"),
+    ("tflite_runtime", "tflite_runtime.interpreter"),
+    ("tensorflow", "tensorflow.lite.python.interpreter"),
+)
+
+
+def ruta_tflite(ruta_keras, variante):
+    # 'src/modelo.keras', 'float16' => 'src/modelo_float16.tflite'
+    return f"{os.path.splitext(ruta_keras)[0]}_{variante}.tflite"
+
+
+def tflite_disponible():
+    import importlib.util
+    return any(importlib.util.find_spec(paquete) is not None for paquete, _ in INTERPRETES_TFLITE)
+
+
+def clase_interprete_tflite():
+    # Clase Interpreter del primer paquete de TFLite instalado, o None si no hay ninguno
+    import importlib
+    import importlib.util
+    for paquete, modulo in INTERPRETES_TFLITE:
+        if importlib.util.find_spec(paquete) is not None:
+            return importlib.import_module(modulo).Interpreter
+    return None
+
+
+class ModeloTFLite:
+    def __init__(self, ruta_tflite, hilos=TFLITE_HILOS):
+        Interpreter = clase_interprete_tflite()
+        if Interpreter is None:
+            raise ValueError("no hay ningún intérprete de TFLite instalado (ai-edge-litert, tflite-runtime o tensorflow)")
+        self.interprete = Interpreter(model_path=ruta_tflite, num_threads=hilos)
+        self.entrada = self.interprete.get_input_details()[0]["index"]
+        self.salida = self.interprete.get_output_details()[0]["index"]
+        self.tam_lote = None
+        # Un intérprete no admite llamadas concurrentes (planificador, /detectar/lote, detectores...)
+        self._cerrojo = threading.Lock()
+
+    def predict_on_batch(self, X):
+        # X: (n, pasos, características); devuelve (n, 1)
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 2:
+            X = X[:, :, np.newaxis]
+        with self._cerrojo:
+            # Los tensores solo se vuelven a reservar cuando cambia el tamaño del lote
+            if len(X) != self.tam_lote:
+                self.interprete.resize_tensor_input(self.entrada, X.shape)
+                self.interprete.allocate_tensors()
+                self.tam_lote = len(X)
+            self.interprete.set_tensor(self.entrada, X)
+            self.interprete.invoke()
+            return self.interprete.get_tensor(self.salida).copy()
+
+    def predict(self, X, verbose=0):
+        return self.predict_on_batch(X)
+
+
+# ---------------------------------------------------------------------------------------------------
+# Carga del modelo con el backend configurado
+# ---------------------------------------------------------------------------------------------------
+def tensorflow_disponible():
+    import importlib.util
+    return importlib.util.find_spec("tensorflow") is not None
+
+
+def elegir_backend(ruta_keras, backend=MODELO_BACKEND):
+    import importlib.util
+    if backend != 'auto':
+        return backend
+    # El intérprete de tf.lite está obsoleto y tflite-runtime ya no se mantiene: por defecto solo se usa
+    # TFLite con ai-edge-litert
+    litert = importlib.util.find_spec("ai_edge_litert") is not None
+    if litert and os.path.exists(ruta_tflite(ruta_keras, 'float16')):
+        return 'tflite-float16'
+    return 'keras' if tensorflow_disponible() else 'numpy'
+
+
+def cargar_modelo(ruta_keras, ruta_pesos, backend=MODELO_BACKEND):
+    # Carga el modelo con el backend configurado y devuelve un objeto con predict_on_batch
+    backend = elegir_backend(ruta_keras, backend)
+    print(f"Backend del modelo: {backend}")
+    if backend == 'numpy':
+        return ModeloNumpy(ruta_pesos)
+    if backend == 'keras':
+        from keras.models import load_model
+        return load_model(ruta_keras)
+    if backend in ('tflite-float16', 'tflite-int8'):
+        return ModeloTFLite(ruta_tflite(ruta_keras, backend.split('-')[1]))
+    raise ValueError(f"backend de modelo desconocido: {backend}")
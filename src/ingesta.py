@@ -0,0 +1,179 @@
+import os
+import json
+import numpy as np
+from redis import ResponseError
+import comandos
+
+# ---------------------------------------------------------------------------------------------------
+# Ingesta de mediciones por lotes
+# ---------------------------------------------------------------------------------------------------
+# Un lote es una lista de pares (timestamp en milisegundos, valor). Se admiten tres formatos de cuerpo:
+#   - JSON:    [[t, v], ...], [{"time": t, "valor": v}, ...] o {"mediciones": [...]}
+#   - NDJSON:  un par o un objeto por línea (application/x-ndjson)
+#   - Binario: registros de 16 bytes little-endian, int64 timestamp + float64 valor (application/octet-stream)
+
+# Número máximo de mediciones aceptadas en una sola petición
+MAX_LOTE = int(os.getenv('MAX_LOTE', 10000))
+# Número de mediciones que se envían en cada TS.MADD (evita comandos gigantes que bloqueen Redis)
+TAM_TROZO_MADD = int(os.getenv('TAM_TROZO_MADD', 1000))
+# Milisegundos de histórico que conserva Redis en cada serie (RETENTION de TS.CREATE, 0 = sin límite).
+# Las muestras más antiguas que la última menos la retención se descartan solas al insertar
+RETENCION_MS = int(os.getenv('RETENCION_MS', 0))
+
+REGISTRO_BINARIO = np.dtype([("time", "<i8"), ("valor", "<f8")])
+
+# Mayor entero representable sin pérdida en un float64, límite superior para los timestamps
+MAX_TIMESTAMP = 2 ** 53
+
+TIPOS_NDJSON = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
+TIPOS_BINARIOS = ("application/octet-stream",)
+
+
+class LoteInvalido(ValueError):
+    pass
+
+
+def _par_de_item(item):
+    # Cada elemento puede ser [time, valor] o {"time": time, "valor": valor}
+    if isinstance(item, dict):
+        return item.get("time"), item.get("valor")
+    if isinstance(item, (list, tuple)) and len(item) == 2:
+        return item[0], item[1]
+    raise ValueError("formato de medición no reconocido")
+
+
+def _items_a_arrays(items):
+    n = len(items)
+    errores = {}
+    try:
+        # Camino rápido: una lista de pares numéricos se convierte de una vez con numpy
+        pares = np.asarray(items, dtype=np.float64)
+        if pares.shape == (n, 2):
+            return pares[:, 0].copy(), pares[:, 1].copy(), errores
+    except (TypeError, ValueError):
+        pass
+
+    # Camino lento: hay objetos o elementos mal formados, se convierten uno a uno y se
+    # anota el error de los que no se puedan leer (se marcan con NaN para la validación)
+    marcas = np.full(n, np.nan)
+    valores = np.full(n, np.nan)
+    for i, item in enumerate(items):
+        try:
+            t, v = _par_de_item(item)
+            if isinstance(t, bool) or isinstance(v, bool):
+                raise ValueError
+            marcas[i] = float(t)
+            valores[i] = float(v)
+        except (TypeError, ValueError):
+            errores[i] = "formato inválido, se espera [time, valor] o {\"time\": t, \"valor\": v}"
+    return marcas, valores, errores
+
+
+def leer_lote(cuerpo, tipo):
+    # Devuelve (marcas int64, valores float64, errores {indice: mensaje}) para el cuerpo recibido
+    if not cuerpo:
+        raise LoteInvalido("el cuerpo de la petición está vacío")
+
+    if tipo in TIPOS_BINARIOS:
+        if len(cuerpo) % REGISTRO_BINARIO.itemsize != 0:
+            raise LoteInvalido(f"el cuerpo binario debe ser múltiplo de {REGISTRO_BINARIO.itemsize} bytes")
+        registros = np.frombuffer(cuerpo, dtype=REGISTRO_BINARIO)
+        if len(registros) > MAX_LOTE:
+            raise LoteInvalido(f"el lote supera el máximo de {MAX_LOTE} mediciones")
+        marcas = registros["time"].astype(np.float64)
+        valores = registros["valor"].astype(np.float64)
+        errores = {}
+    else:
+        try:
+            texto = cuerpo.decode("utf-8")
+            if tipo in TIPOS_NDJSON:
+                items = [json.loads(linea) for linea in texto.splitlines() if linea.strip()]
+            else:
+                items = json.loads(texto)
+                if isinstance(items, dict):
+                    items = items.get("mediciones")
+        except (UnicodeDecodeError, ValueError) as e:
+            raise LoteInvalido(f"no se pudo leer el lote => {e}")
+        if not isinstance(items, list):
+            raise LoteInvalido("se esperaba una lista de mediciones")
+        if len(items) > MAX_LOTE:
+            raise LoteInvalido(f"el lote supera el máximo de {MAX_LOTE} mediciones")
+        marcas, valores, errores = _items_a_arrays(items)
+
+    validar_lote(marcas, valores, errores)
+    return marcas.astype(np.int64), valores, errores
+
+
+def validar_lote(marcas, valores, errores):
+    # Todas las comprobaciones se hacen sobre el array completo, sin recorrer el lote en Python
+    invalidas = ~np.isfinite(marcas) | (marcas < 0) | (marcas > MAX_TIMESTAMP) | (marcas != np.floor(marcas))
+    no_numericos = ~np.isfinite(valores)
+
+    # Timestamps repetidos dentro del propio lote: se acepta la primera aparición
+    _, primeras = np.unique(marcas, return_index=True)
+    duplicadas = np.ones(len(marcas), dtype=bool)
+    duplicadas[primeras] = False
+
+    for i in np.flatnonzero(invalidas):
+        errores.setdefault(int(i), "timestamp inválido, debe ser un entero no negativo en milisegundos")
+    for i in np.flatnonzero(no_numericos):
+        errores.setdefault(int(i), "el valor debe ser numérico")
+    for i in np.flatnonzero(duplicadas & ~invalidas):
+        errores.setdefault(int(i), "timestamp repetido dentro del lote")
+    return errores
+
+
+def pasos_asegurar_serie(clave, etiquetas=None, politica_duplicados=None):
+    # TS.MADD no crea la serie (a diferencia de TS.ADD), así que la creamos si aún no existe
+    if (yield ['EXISTS', clave]):
+        return
+    argumentos = ['RETENTION', RETENCION_MS]
+    if politica_duplicados:
+        argumentos += ['DUPLICATE_POLICY', politica_duplicados]
+    if etiquetas:
+        argumentos += ['LABELS', *etiquetas]
+    try:
+        yield ['TS.CREATE', clave, *argumentos]
+    except ResponseError as e:
+        # Otra réplica puede haberla creado entre el EXISTS y el TS.CREATE
+        if "already exists" not in str(e):
+            raise
+
+
+def asegurar_serie(redis, clave, etiquetas=None, politica_duplicados=None):
+    comandos.ejecutar(redis, pasos_asegurar_serie(clave, etiquetas, politica_duplicados))
+
+
+def pasos_almacenar_lote(clave, marcas, valores, errores):
+    # Escribe las mediciones válidas con TS.MADD en trozos y devuelve el resumen por elemento
+    validos = np.ones(len(marcas), dtype=bool)
+    validos[list(errores)] = False
+    indices = np.flatnonzero(validos)
+
+    if len(indices):
+        yield from pasos_asegurar_serie(clave)
+    for inicio in range(0, len(indices), TAM_TROZO_MADD):
+        trozo = indices[inicio:inicio + TAM_TROZO_MADD]
+        argumentos = []
+        for t, v in zip(marcas[trozo].tolist(), valores[trozo].tolist()):
+            argumentos += [clave, t, v]
+        respuestas = yield ['TS.MADD', *argumentos]
+        # Redis devuelve un error por cada elemento rechazado (por ejemplo timestamp duplicado)
+        for i, r in zip(trozo.tolist(), respuestas):
+            if isinstance(r, Exception):
+                errores[i] = str(r)
+
+    return resumen_lote(len(marcas), errores)
+
+
+def almacenar_lote(redis, clave, marcas, valores, errores):
+    return comandos.ejecutar(redis, pasos_almacenar_lote(clave, marcas, valores, errores))
+
+
+def resumen_lote(total, errores):
+    return {
+        "recibidas": total,
+        "almacenadas": total - len(errores),
+        "rechazadas": len(errores),
+        "errores": [{"indice": i, "error": errores[i]} for i in sorted(errores)],
+    }
@@ -1,8 +1,17 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from redis import Redis, RedisError
 import os
 import socket 
 from datetime import datetime
+import ingesta
+import consultas
+import agregados
+import series
+import metricas
+import cache
+import exportar
+import detector
+import arranque
 
 # ---------------------------------------------------------------------------------------------------
 # Funciones auxiliares
@@ -29,15 +38,39 @@ print("REDIS_HOST: "+REDIS_HOST) # Confirmamos el host usado
 # conectarse y para realizar operaciones(evita que el programa se bloquee si Redis no responde) y usará el puerto 
 # 6379(predeterminado de redis) 
 redis = Redis(host=REDIS_HOST, db=0, socket_connect_timeout=2, socket_timeout=2, decode_responses=True)
+# Latencia de cada comando, errores y uso del pool de conexiones de Redis para /metrics
+redis = metricas.instrumentar_redis(redis, 'SIMPLE')
+
+# Caché de las respuestas de /listar y /agregar, validada con la versión de la serie (TS.INFO) y con
+# soporte de ETag/If-None-Match; CACHE_RESPUESTAS=0 la desactiva
+cache_respuestas = cache.CacheRespuestas() if cache.CACHE_RESPUESTAS else None
 
 # Creamos la instancia de la aplicación web Flask
 app = Flask(__name__)
+# Latencia y código de estado de cada ruta para /metrics
+metricas.instrumentar_flask(app)
+
+def preparar_redis():
+    # Comprueba la conexión y crea la serie 'mediciones' con sus etiquetas y sus series compactadas (media,
+    # mínimo y máximo por minuto, hora y día) con sus reglas TS.CREATERULE para que las consultas de /agregar
+    # no recorran las muestras originales. Las series de otros sensores se crean igual la primera vez que se usan.
+    print("Ping Redis: ", redis.ping())
+    series.preparar_serie_principal(redis)
+
+# Se hace en segundo plano y se reintenta hasta que Redis responde; mientras tanto /readyz devuelve 503
+arranque.tarea("redis", preparar_redis, reintentar_s=arranque.ARRANQUE_REINTENTO_S)
 
 # Registra la función nueva_medicion() como el manejador de las soliciturdes HTTP GET a la ruta "/nuevo"
 # Cuando  un cliente acceda a http://host:port/ => Flask ejecutará la función hello() y delvolverá el resultado como
 # respuesta HTTP
 @app.route("/nuevo")
 def nueva_medicion():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
     # Hacemos una petición GET del valor enviado
     dato = request.args.get("dato")
     # Si no hay valor devolveremos un mensaje de error y el "status code" de HTTP 400
@@ -57,10 +90,23 @@ def nueva_medicion():
         # convertimos este valor a el tipo  entero(el formato de redis lo requiere)
         timestamp = int(datetime.now().timestamp() * 1000) 
 
+        # Tiempo de cada etapa de la petición para /metrics
+        cronometro = metricas.registro.cronometro("/nuevo")
         try:
+            series.asegurar_sensor(redis, sensor)
+            cronometro.marca("asegurar_serie")
             # Ejecutamos el comando de RedisTimeSeries TS.ADD para añadir una instancia
-            # a la serie temporal 'mediciones'
-            redis.execute_command('TS.ADD', 'mediciones', timestamp, valor)
+            # a la serie temporal del sensor
+            if detector.DETECCION_ASINCRONA:
+                # La detección la hacen aparte los procesos de detector.py: la medición se añade a la serie
+                # y se encola en el mismo viaje a Redis
+                detector.anadir_y_publicar(redis, clave, sensor, timestamp, valor)
+                cronometro.marca("ts_add_xadd")
+            else:
+                redis.execute_command('TS.ADD', clave, timestamp, valor)
+                cronometro.marca("ts_add")
+            if cache_respuestas is not None:
+                cache_respuestas.anadido(clave, timestamp, valor)
         except RedisError as e:
             return f"ERROR: error al insertar un dato con Redis => {e}", 500
         except Exception as e:
@@ -69,55 +115,228 @@ def nueva_medicion():
         return f"CORRECTO: <b>Dato={dato}</b> almacenado en la fecha <b>{timestamp_a_fecha_con_formato(timestamp)}</b><br> por el hostname: <b>{socket.gethostname()}</b>"
     
 
+@app.route("/nuevo_lote", methods=["POST"])
+def nuevo_lote():
+    # Recibe muchas mediciones (timestamp, valor) en una sola petición en formato JSON, NDJSON o binario
+    # y las almacena con TS.MADD, devolviendo un resumen con el estado de cada elemento
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    cronometro = metricas.registro.cronometro("/nuevo_lote")
+    try:
+        marcas, valores, errores = ingesta.leer_lote(request.get_data(), request.mimetype)
+    except ingesta.LoteInvalido as e:
+        return f"ERROR: {e}", 400
+    cronometro.marca("lectura_lote")
+
+    try:
+        series.asegurar_sensor(redis, sensor)
+        resumen = ingesta.almacenar_lote(redis, clave, marcas, valores, errores)
+        cronometro.marca("ts_madd")
+        if cache_respuestas is not None:
+            cache_respuestas.borrar_serie(clave)
+    except RedisError as e:
+        return f"ERROR: error al insertar el lote con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al insertar el lote en Redis => {e}", 500
+
+    resumen["hostname"] = socket.gethostname()
+    return jsonify(resumen)
+
 @app.route("/listar")
 def listar():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
     try:
-        # Obtener las muestras de la serie temporal mediciones
-        # El - indica comenzar desde el tiempo más temprano (antiguo) al + que indica el tiempo más reciente
-        muestras = redis.execute_command('TS.REVRANGE', 'mediciones', '-', '+',)
-        # Indicaremos el nombre del host
-        salida = f"<b>Hostname:</b> {socket.gethostname()}<br>"
-        
-        # Si hay muestras => listaremos los valores en la variable salida en formato html
-        for time, valor in muestras:
-            salida += f"{timestamp_a_fecha_con_formato(time)} => {valor}<br>" 
-        return salida
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        # Obtener las muestras de la serie temporal mediciones por páginas (desde, hasta, limite, cursor)
+        # y en trozos: la respuesta se envía en streaming en formato html, json o csv
+        if cache_respuestas is not None:
+            # Las páginas con límite se sirven desde la caché (o con un 304 si el cliente ya la tiene)
+            return cache_respuestas.listar(redis, clave, request.args, "{fecha} => {valor}<br>", request.headers.get("If-None-Match"))
+        return consultas.listar(redis, clave, request.args, "{fecha} => {valor}<br>")
+    except consultas.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
     except RedisError as e:
         return f"ERROR: error al listar los datos con Redis => {e}", 500
     except Exception as e:
         return f"ERROR: error inesperado listar los datos => {e}", 500
 
+@app.route("/exportar")
+def exportar_mediciones():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        # Rango de la serie en binario (npy, arrow o registros de 16 bytes), leído de Redis y enviado por trozos
+        return exportar.exportar(redis, clave, request.args, sensor or "mediciones")
+    except (consultas.ParametroInvalido, exportar.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al exportar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al exportar los datos => {e}", 500
+
+@app.route("/agregar")
+def agregar():
+    # Agregados (avg, min, max...) de las mediciones por buckets de tiempo; si existe una serie
+    # compactada que da el resultado exacto se lee de ella en lugar de la serie original
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        funcion, bucket_ms, desde, hasta, formato = agregados.leer_parametros(request.args)
+    except agregados.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+
+    try:
+        if cache_respuestas is not None:
+            return cache_respuestas.agregar(redis, clave, funcion, bucket_ms, desde, hasta, formato,
+                                            request.headers.get("If-None-Match"), socket.gethostname())
+        origen, datos = agregados.agregar(redis, clave, funcion, bucket_ms, desde, hasta)
+    except RedisError as e:
+        return f"ERROR: error al agregar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al agregar los datos => {e}", 500
+
+    if formato == "csv":
+        return "time,valor\n" + "".join(f"{t},{v!r}\n" for t, v in datos), {"Content-Type": "text/csv; charset=utf-8"}
+    return jsonify({"funcion": funcion, "bucket": bucket_ms, "origen": origen, "datos": datos,
+                    "hostname": socket.gethostname()})
+
+@app.route("/sensores")
+def listar_sensores():
+    # Última medición de cada sensor (TS.MGET sobre todas las series con la etiqueta tipo=mediciones,
+    # en modo CLUSTER en todos los maestros). Se puede filtrar con ?sensores=s1,s2
+    sensores = [s for s in request.args.get("sensores", "").split(",") if s]
+    try:
+        return jsonify({"sensores": series.ultimos_valores(redis, sensores), "hostname": socket.gethostname()})
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al consultar los sensores con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al consultar los sensores => {e}", 500
+
+@app.route("/sensores/mediciones")
+def mediciones_sensores():
+    # Mediciones de varios sensores a la vez con TS.MRANGE (opcionalmente agregadas con funcion y bucket)
+    sensores = [s for s in request.args.get("sensores", "").split(",") if s]
+    try:
+        desde, hasta, _, limite, _ = consultas.leer_parametros(request.args)
+        funcion, bucket_ms = None, None
+        if "funcion" in request.args:
+            funcion, bucket_ms, _, _, _ = agregados.leer_parametros(request.args)
+        datos = series.rango_sensores(redis, desde, hasta, sensores, limite, funcion, bucket_ms)
+    except (consultas.ParametroInvalido, agregados.ParametroInvalido, series.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al consultar los sensores con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al consultar los sensores => {e}", 500
+    return jsonify({"sensores": datos, "hostname": socket.gethostname()})
+
 @app.route("/borrar")
 def borrar_mediciones():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
     try:
-        # Ejecutaremos este comando para comprobar si hay muestras o no disponibles
-        redis.execute_command('TS.REVRANGE', 'mediciones', '-', '+',)
-    
-        # Si hay muestras => borramos la serie temporal
-        redis.delete("mediciones")
-        return "Las mediciones se han borrado con éxito."
+        clave = series.clave_serie(sensor)
+        # Rango opcional en milisegundos; sin él se borra toda la serie
+        desde, hasta = consultas.leer_rango(request.args)
+    except (series.ParametroInvalido, consultas.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    try:
+        if desde != '-' or hasta != '+':
+            # Solo las mediciones del rango con TS.DEL; se recalculan los buckets compactados afectados
+            # (y los resultados de la detección del mismo rango)
+            borradas = detector.borrar_rango(redis, clave, desde, hasta)
+            mensaje = f"Se han borrado {borradas} mediciones."
+        else:
+            # La serie entera con sus compactadas: UNLINK las quita al momento y Redis libera la memoria en
+            # segundo plano, sin bloquear al resto de clientes como haría un DEL de una serie grande.
+            # Después volvemos a crear la serie vacía con sus etiquetas y reglas (los demás workers la
+            # siguen dando por creada, ver series.recrear)
+            redis.unlink(*detector.claves_serie_completa(clave))
+            series.recrear(redis, sensor)
+            mensaje = "Las mediciones se han borrado con éxito."
+        if cache_respuestas is not None:
+            cache_respuestas.borrar_serie(clave)
+        return mensaje
     except RedisError as e:
         return f"ERROR: error al borrar los datos con Redis => {e}", 500
     except Exception as e:
         return f"ERROR: error inesperado al borrar los datos => {e}", 500
 
+@app.route("/metrics")
+def metricas_prometheus():
+    # Métricas de este worker en formato de texto de Prometheus
+    return metricas.registro.exposicion(), 200, {"Content-Type": metricas.TIPO_CONTENIDO}
+
+@app.route("/debug/perfil")
+def perfil():
+    # Muestrea las pilas de todos los hilos durante 'segundos' y devuelve las pilas en formato 'folded'
+    # para generar un flame graph (solo con PERFILADOR=1)
+    if not metricas.PERFILADOR:
+        return "ERROR: el perfilador está desactivado (PERFILADOR=1)", 404
+    try:
+        segundos = float(request.args.get("segundos", 5))
+    except ValueError:
+        return "ERROR: 'segundos' debe ser un número", 400
+    return metricas.perfil(segundos), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route("/healthz")
+def vivo():
+    # Sonda de vida: el proceso responde aunque siga arrancando; incluye el estado de cada tarea del arranque
+    return jsonify({"estado": arranque.estado(), "hostname": socket.gethostname()})
+
+@app.route("/readyz")
+def preparado():
+    # Sonda de disponibilidad: la réplica solo debe recibir tráfico con si puede hablar con Redis
+    if not arranque.listo():
+        pendientes = ", ".join(f"{nombre}: {t['estado']}" for nombre, t in arranque.estado().items() if t["estado"] != "listo")
+        return f"ERROR: la réplica aún se está iniciando => {pendientes}", 503
+    try:
+        redis.ping()
+    except Exception as e:
+        return f"ERROR: Redis no disponible => {e}", 503
+    return "OK"
+
 @app.route("/")
 def bienvenido_instrucciones():
     return (
     f"<b>Hostname:</b> {socket.gethostname()}<br>"
     "Bienvenid@ a la API de <b>mediciones</b>!<br>"
-    "Funciones disponibles:<br>"
+    "Funciones disponibles (todas admiten ?sensor=ID para usar la serie de otro sensor):<br>"
     "<b>(1) /nuevo?dato=VALOR </b>: añade una medición<br>"
-    "<b>(2) /listar </b>: muestra las mediciones tomadas<br>"
-    "<b>(3) /borrar </b>: borra todas las mediciones<br>"
-    "<b>(4) / </b>: página principal<br>")
+    "<b>(2) /listar?desde=&hasta=&limite=&formato=html|json|csv </b>: muestra las mediciones tomadas<br>"
+    "<b>(3) /borrar </b>: borra todas las mediciones (o solo las del rango ?desde=...&hasta=...)<br>"
+    "<b>(4) POST /nuevo_lote </b>: añade un lote de mediciones (JSON, NDJSON o binario)<br>"
+    "<b>(5) /agregar?funcion=avg|min|max&bucket=1m|1h|1d </b>: agregados de las mediciones por intervalos<br>"
+    "<b>(6) /sensores </b>: última medición de cada sensor<br>"
+    "<b>(7) /sensores/mediciones?sensores=s1,s2&desde=&hasta= </b>: mediciones de varios sensores<br>"
+    "<b>(8) /exportar?desde=&hasta=&formato=npy|arrow|binario&compresion=gzip|zstd </b>: exporta las mediciones en binario<br>"
+    "<b>(9) /metrics </b>: métricas en formato Prometheus<br>"
+    "<b>(10) / </b>: página principal<br>")
 
 if __name__ == "__main__":
     # Obtiene el valor de la variable de entorno PORT y si no está definidad usará el puerto 80
     PORT = os.getenv('PORT', 80)
     # Imprime el puerto para una verificación
     print("PORT: "+str(PORT))
-    # Arranca el servidor Flask escuchando a todas las interfaces(0.0.0.0) para ser accesible desde otros contenedores
-    # o la máquina host
+    # Arranca el servidor de desarrollo de Flask escuchando a todas las interfaces(0.0.0.0) para ser accesible
+    # desde otros contenedores o la máquina host (en producción se usa Gunicorn con gunicorn.conf.py)
     app.run(host='0.0.0.0', port=PORT)
 
@@ -1,18 +1,35 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from redis import Redis, RedisError
 import os
 import socket 
 from datetime import datetime
-import joblib
-from keras.models import load_model
+import ingesta
+import consultas
+import agregados
+import series
+import metricas
+import cache
+import exportar
+import detector
+import arranque
+import inferencia
+import ventanas
+import resultados
+import puntuacion
+import modelos
+import roles
 import json
 import numpy as np
 
 # ---------------------------------------------------------------------------------------------------
 # Cargamos el modelo actual, escalador y json con la configuración de la práctica 1
 # ---------------------------------------------------------------------------------------------------
-model = load_model('src/modelo.keras')
-scaler = joblib.load('src/scaler.pkl')
+# Las réplicas de ingesta y consulta (ROL, ver roles.py) no importan joblib ni scikit-learn ni cargan
+# el escalador y el modelo
+scaler = None
+if roles.con_modelo():
+    import joblib
+    scaler = joblib.load('src/scaler.pkl')
 
 # Recuperamos el threshold y el valor de ventana
 with open("src/config.json", "r") as f:
@@ -20,9 +37,51 @@ with open("src/config.json", "r") as f:
     threshold = data['threshold']
     windows_size = data['windows_size']
 
+def cargar_modelo():
+    # El modelo se carga con Keras si TensorFlow está instalado y, si no, con el motor de NumPy a partir
+    # de los pesos exportados (se puede forzar con la variable de entorno MODELO_BACKEND=keras|numpy)
+    modelo = inferencia.cargar_modelo('src/modelo.keras', 'src/modelo_pesos.npz')
+    # Calentamiento: la primera predicción de Keras traza el grafo para cada tamaño de lote; la hacemos
+    # aquí con los tamaños habituales para que no la pague la primera petición
+    for n in sorted({1, inferencia.INFERENCIA_MAX_LOTE}):
+        modelo.predict_on_batch(np.zeros((n, windows_size, 1), dtype=np.float32))
+    return modelo
+
+# La carga y el calentamiento del modelo se hacen en segundo plano, a la vez que se conecta con Redis
+if roles.con_modelo():
+    arranque.tarea("modelo", cargar_modelo)
+
+# Función de predicción que usa el planificador: recibe un lote de ventanas (n, windows_size, 1).
+# Si el modelo aún se está cargando espera a que termine (hasta ARRANQUE_TIMEOUT_S)
+def predecir_modelo(X):
+    return arranque.esperar("modelo").predict_on_batch(X)
+
+# Agrupa las ventanas de las peticiones concurrentes de /detectar en una sola llamada al modelo
+planificador = inferencia.PlanificadorInferencia()
+metricas.instrumentar_planificador(planificador)
+
+# Escalado de ventanas sin la validación de scaler.transform (puntuación por lotes y modo online)
+escalar_ventanas = ventanas.funcion_escalado(scaler) if scaler is not None else None
+
+# Modo online (MODO_VENTANA=ONLINE): la ventana de cada serie se guarda ya escalada en memoria y
+# /detectar no necesita leerla de Redis en cada petición
+cache_ventanas = None
+if ventanas.MODO_VENTANA == 'ONLINE' and escalar_ventanas is not None:
+    cache_ventanas = ventanas.CacheVentanas(windows_size, escalar_ventanas)
+
+# Modelo base (src/) con la misma forma que los modelos propios de cada sensor
+modelo_base = modelos.VersionModelo(None, modelos.VERSION_BASE, predecir_modelo, scaler, threshold, windows_size)
+# Modelos propios de cada sensor, versionados y con cambio de versión en caliente (ver modelos.py); el
+# cliente de Redis se asigna al crearlo
+registro_modelos = modelos.RegistroModelos()
+
 # ---------------------------------------------------------------------------------------------------
 # Funciones auxiliares
 # ---------------------------------------------------------------------------------------------------
+def modelo_sensor(sensor):
+    # Versión activa del modelo propio del sensor (se carga la primera vez) o, si no tiene, el modelo base
+    return registro_modelos.obtener(sensor or series.SENSOR_POR_DEFECTO) or modelo_base
+
 def timestamp_a_fecha_con_formato(timestamp):
     fecha_segundos = timestamp / 1000 # a segundos
     fecha = datetime.fromtimestamp(fecha_segundos) # Transforma de segundos a un objeto datatime
@@ -45,15 +104,48 @@ print("REDIS_HOST: "+REDIS_HOST) # Confirmamos el host usado
 # conectarse y para realizar operaciones(evita que el programa se bloquee si Redis no responde) y usará el puerto 
 # 6379(predeterminado de redis) 
 redis = Redis(host=REDIS_HOST, db=0, socket_connect_timeout=2, socket_timeout=2, decode_responses=True)
+# Latencia de cada comando, errores y uso del pool de conexiones de Redis para /metrics
+redis = metricas.instrumentar_redis(redis, 'SIMPLE')
+
+# Caché de las respuestas de /listar y /agregar, validada con la versión de la serie (TS.INFO) y con
+# soporte de ETag/If-None-Match; CACHE_RESPUESTAS=0 la desactiva
+cache_respuestas = cache.CacheRespuestas() if cache.CACHE_RESPUESTAS else None
+
+# Registro de los resultados de /detectar: los últimos en memoria y, si RESULTADOS_DESTINO lo indica,
+# escritos por lotes en segundo plano en un fichero JSONL o un stream de Redis
+registro_resultados = resultados.RegistroResultados(redis)
+registro_modelos.redis = redis
 
 # Creamos la instancia de la aplicación web Flask
 app = Flask(__name__)
+# Latencia y código de estado de cada ruta para /metrics
+metricas.instrumentar_flask(app)
+# Con ROL=ingesta|consulta|deteccion las rutas de los otros roles responden 404 (ver roles.py)
+roles.instalar(app)
+
+def preparar_redis():
+    # Comprueba la conexión y crea la serie 'mediciones' con sus etiquetas y sus series compactadas (media,
+    # mínimo y máximo por minuto, hora y día) con sus reglas TS.CREATERULE para que las consultas de /agregar
+    # no recorran las muestras originales. Las series de otros sensores se crean igual la primera vez que se usan.
+    print("Ping Redis: ", redis.ping())
+    series.preparar_serie_principal(redis)
+    # Script de /detectar que lee la ventana y añade la medición en una sola llamada atómica
+    return ventanas.registrar_script(redis)
+
+# Se hace en segundo plano y se reintenta hasta que Redis responde; mientras tanto /readyz devuelve 503
+arranque.tarea("redis", preparar_redis, reintentar_s=arranque.ARRANQUE_REINTENTO_S)
 
 # Registra la función nueva_medicion() como el manejador de las soliciturdes HTTP GET a la ruta "/nuevo"
 # Cuando  un cliente acceda a http://host:port/ => Flask ejecutará la función hello() y delvolverá el resultado como
 # respuesta HTTP
 @app.route("/nuevo")
 def nueva_medicion():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
     # Hacemos una petición GET del valor enviado
     dato = request.args.get("dato")
     # Si no hay valor devolveremos un mensaje de error y el "status code" de HTTP 400
@@ -73,10 +165,25 @@ def nueva_medicion():
         # convertimos este valor a el tipo  entero(el formato de redis lo requiere)
         timestamp = int(datetime.now().timestamp() * 1000) 
 
+        # Tiempo de cada etapa de la petición para /metrics
+        cronometro = metricas.registro.cronometro("/nuevo")
         try:
+            series.asegurar_sensor(redis, sensor)
+            cronometro.marca("asegurar_serie")
             # Ejecutamos el comando de RedisTimeSeries TS.ADD para añadir una instancia
-            # a la serie temporal 'mediciones'
-            redis.execute_command('TS.ADD', 'mediciones', timestamp, valor)
+            # a la serie temporal del sensor
+            if detector.DETECCION_ASINCRONA:
+                # La detección la hacen aparte los procesos de detector.py: la medición se añade a la serie
+                # y se encola en el mismo viaje a Redis
+                detector.anadir_y_publicar(redis, clave, sensor, timestamp, valor)
+                cronometro.marca("ts_add_xadd")
+            else:
+                redis.execute_command('TS.ADD', clave, timestamp, valor)
+                cronometro.marca("ts_add")
+            if cache_respuestas is not None:
+                cache_respuestas.anadido(clave, timestamp, valor)
+            if cache_ventanas is not None:
+                cache_ventanas.anadir(clave, timestamp, valor)
         except RedisError as e:
             return f"ERROR: error al insertar un dato con Redis => {e}", 500
         except Exception as e:
@@ -84,52 +191,242 @@ def nueva_medicion():
         
         return f"CORRECTO: <b>Dato={dato} °C </b> almacenado en la fecha <b>{timestamp_a_fecha_con_formato(timestamp)}</b><br> por el hostname: <b>{socket.gethostname()}</b>"
     
+@app.route("/nuevo_lote", methods=["POST"])
+def nuevo_lote():
+    # Recibe muchas mediciones (timestamp, valor) en una sola petición en formato JSON, NDJSON o binario
+    # y las almacena con TS.MADD, devolviendo un resumen con el estado de cada elemento
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    cronometro = metricas.registro.cronometro("/nuevo_lote")
+    try:
+        marcas, valores, errores = ingesta.leer_lote(request.get_data(), request.mimetype)
+    except ingesta.LoteInvalido as e:
+        return f"ERROR: {e}", 400
+    cronometro.marca("lectura_lote")
+
+    try:
+        series.asegurar_sensor(redis, sensor)
+        resumen = ingesta.almacenar_lote(redis, clave, marcas, valores, errores)
+        cronometro.marca("ts_madd")
+        if cache_respuestas is not None:
+            cache_respuestas.borrar_serie(clave)
+        if cache_ventanas is not None:
+            # El lote puede traer mediciones fuera de orden: la ventana se vuelve a cargar de Redis
+            cache_ventanas.invalidar(clave)
+    except RedisError as e:
+        return f"ERROR: error al insertar el lote con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al insertar el lote en Redis => {e}", 500
+
+    resumen["hostname"] = socket.gethostname()
+    return jsonify(resumen)
+
 @app.route("/listar")
 def listar():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
     try:
-        # Obtener las muestras de la serie temporal mediciones
-        # El - indica comenzar desde el tiempo más temprano (antiguo) al + que indica el tiempo más reciente
-        muestras = redis.execute_command('TS.REVRANGE', 'mediciones', '-', '+',)
-        # Indicaremos el nombre del host
-        salida = f"<b>Hostname:</b> {socket.gethostname()}<br>"
-        
-        # Si hay muestras => listaremos los valores en la variable salida en formato html
-        for time, valor in muestras:
-            salida += f"Fecha: {timestamp_a_fecha_con_formato(time)} => Valor: {valor} °C<br>" 
-        return salida
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        # Obtener las muestras de la serie temporal mediciones por páginas (desde, hasta, limite, cursor)
+        # y en trozos: la respuesta se envía en streaming en formato html, json o csv
+        if cache_respuestas is not None:
+            # Las páginas con límite se sirven desde la caché (o con un 304 si el cliente ya la tiene)
+            return cache_respuestas.listar(redis, clave, request.args, "Fecha: {fecha} => Valor: {valor} °C<br>", request.headers.get("If-None-Match"))
+        return consultas.listar(redis, clave, request.args, "Fecha: {fecha} => Valor: {valor} °C<br>")
+    except consultas.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
     except RedisError as e:
         return f"ERROR: error al listar los datos con Redis => {e}", 500
     except Exception as e:
         return f"ERROR: error inesperado listar los datos => {e}", 500
 
+@app.route("/exportar")
+def exportar_mediciones():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        # Rango de la serie en binario (npy, arrow o registros de 16 bytes), leído de Redis y enviado por trozos
+        return exportar.exportar(redis, clave, request.args, sensor or "mediciones")
+    except (consultas.ParametroInvalido, exportar.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al exportar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al exportar los datos => {e}", 500
+
+@app.route("/agregar")
+def agregar():
+    # Agregados (avg, min, max...) de las mediciones por buckets de tiempo; si existe una serie
+    # compactada que da el resultado exacto se lee de ella en lugar de la serie original
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        funcion, bucket_ms, desde, hasta, formato = agregados.leer_parametros(request.args)
+    except agregados.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+
+    try:
+        if cache_respuestas is not None:
+            return cache_respuestas.agregar(redis, clave, funcion, bucket_ms, desde, hasta, formato,
+                                            request.headers.get("If-None-Match"), socket.gethostname())
+        origen, datos = agregados.agregar(redis, clave, funcion, bucket_ms, desde, hasta)
+    except RedisError as e:
+        return f"ERROR: error al agregar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al agregar los datos => {e}", 500
+
+    if formato == "csv":
+        return "time,valor\n" + "".join(f"{t},{v!r}\n" for t, v in datos), {"Content-Type": "text/csv; charset=utf-8"}
+    return jsonify({"funcion": funcion, "bucket": bucket_ms, "origen": origen, "datos": datos,
+                    "hostname": socket.gethostname()})
+
+@app.route("/sensores")
+def listar_sensores():
+    # Última medición de cada sensor (TS.MGET sobre todas las series con la etiqueta tipo=mediciones,
+    # en modo CLUSTER en todos los maestros). Se puede filtrar con ?sensores=s1,s2
+    sensores = [s for s in request.args.get("sensores", "").split(",") if s]
+    try:
+        return jsonify({"sensores": series.ultimos_valores(redis, sensores), "hostname": socket.gethostname()})
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al consultar los sensores con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al consultar los sensores => {e}", 500
+
+@app.route("/sensores/mediciones")
+def mediciones_sensores():
+    # Mediciones de varios sensores a la vez con TS.MRANGE (opcionalmente agregadas con funcion y bucket)
+    sensores = [s for s in request.args.get("sensores", "").split(",") if s]
+    try:
+        desde, hasta, _, limite, _ = consultas.leer_parametros(request.args)
+        funcion, bucket_ms = None, None
+        if "funcion" in request.args:
+            funcion, bucket_ms, _, _, _ = agregados.leer_parametros(request.args)
+        datos = series.rango_sensores(redis, desde, hasta, sensores, limite, funcion, bucket_ms)
+    except (consultas.ParametroInvalido, agregados.ParametroInvalido, series.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    except RedisError as e:
+        return f"ERROR: error al consultar los sensores con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al consultar los sensores => {e}", 500
+    return jsonify({"sensores": datos, "hostname": socket.gethostname()})
+
 @app.route("/borrar")
 def borrar_mediciones():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
     try:
-        # Ejecutaremos este comando para comprobar si hay muestras o no disponibles
-        redis.execute_command('TS.REVRANGE', 'mediciones', '-', '+',)
-    
-        # Si hay muestras => borramos la serie temporal
-        redis.delete("mediciones")
-        return "Las mediciones se han borrado con éxito."
+        clave = series.clave_serie(sensor)
+        # Rango opcional en milisegundos; sin él se borra toda la serie
+        desde, hasta = consultas.leer_rango(request.args)
+    except (series.ParametroInvalido, consultas.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    try:
+        if desde != '-' or hasta != '+':
+            # Solo las mediciones del rango con TS.DEL; se recalculan los buckets compactados afectados
+            # (y los resultados de la detección del mismo rango)
+            borradas = detector.borrar_rango(redis, clave, desde, hasta)
+            mensaje = f"Se han borrado {borradas} mediciones."
+        else:
+            # La serie entera con sus compactadas: UNLINK las quita al momento y Redis libera la memoria en
+            # segundo plano, sin bloquear al resto de clientes como haría un DEL de una serie grande.
+            # Después volvemos a crear la serie vacía con sus etiquetas y reglas (los demás workers la
+            # siguen dando por creada, ver series.recrear)
+            redis.unlink(*detector.claves_serie_completa(clave))
+            series.recrear(redis, sensor)
+            mensaje = "Las mediciones se han borrado con éxito."
+        if cache_respuestas is not None:
+            cache_respuestas.borrar_serie(clave)
+        if cache_ventanas is not None:
+            cache_ventanas.invalidar(clave)
+        return mensaje
     except RedisError as e:
         return f"ERROR: error al borrar los datos con Redis => {e}", 500
     except Exception as e:
         return f"ERROR: error inesperado al borrar los datos => {e}", 500
 
+@app.route("/metrics")
+def metricas_prometheus():
+    # Métricas de este worker en formato de texto de Prometheus
+    return metricas.registro.exposicion(), 200, {"Content-Type": metricas.TIPO_CONTENIDO}
+
+@app.route("/debug/perfil")
+def perfil():
+    # Muestrea las pilas de todos los hilos durante 'segundos' y devuelve las pilas en formato 'folded'
+    # para generar un flame graph (solo con PERFILADOR=1)
+    if not metricas.PERFILADOR:
+        return "ERROR: el perfilador está desactivado (PERFILADOR=1)", 404
+    try:
+        segundos = float(request.args.get("segundos", 5))
+    except ValueError:
+        return "ERROR: 'segundos' debe ser un número", 400
+    return metricas.perfil(segundos), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route("/healthz")
+def vivo():
+    # Sonda de vida: el proceso responde aunque siga arrancando; incluye el estado de cada tarea del arranque
+    return jsonify({"estado": arranque.estado(), "hostname": socket.gethostname()})
+
+@app.route("/readyz")
+def preparado():
+    # Sonda de disponibilidad: la réplica solo debe recibir tráfico con el modelo cargado y calentado y
+    # si puede hablar con Redis
+    if not arranque.listo():
+        pendientes = ", ".join(f"{nombre}: {t['estado']}" for nombre, t in arranque.estado().items() if t["estado"] != "listo")
+        return f"ERROR: la réplica aún se está iniciando => {pendientes}", 503
+    try:
+        redis.ping()
+    except Exception as e:
+        return f"ERROR: Redis no disponible => {e}", 503
+    return "OK"
+
 @app.route("/")
 def bienvenido_instrucciones():
     return (
     f"<b>Hostname:</b> {socket.gethostname()}<br>"
     "Bienvenid@ a la API de <b>mediciones</b>!<br>"
-    "Funciones disponibles:<br>"
+    "Funciones disponibles (todas admiten ?sensor=ID para usar la serie de otro sensor):<br>"
     "<b>(1) /nuevo?dato=VALOR </b>: añade una medición<br>"
-    "<b>(2) /listar </b>: muestra las mediciones tomadas<br>"
-    "<b>(3) /borrar </b>: borra todas las mediciones<br>"
+    "<b>(2) /listar?desde=&hasta=&limite=&formato=html|json|csv </b>: muestra las mediciones tomadas<br>"
+    "<b>(3) /borrar </b>: borra todas las mediciones (o solo las del rango ?desde=...&hasta=...)<br>"
     "<b>(4) /detectar?dato=VALOR </b>: analiza si es una anomalía y añade la medicición<br>"
-    "<b>(5) / </b>: página principal<br>")
+    "<b>(5) POST /nuevo_lote </b>: añade un lote de mediciones (JSON, NDJSON o binario)<br>"
+    "<b>(6) /inferencia/estadisticas </b>: tamaño de lote y espera en cola de la inferencia<br>"
+    "<b>(7) /agregar?funcion=avg|min|max&bucket=1m|1h|1d </b>: agregados de las mediciones por intervalos<br>"
+    "<b>(8) /sensores </b>: última medición de cada sensor<br>"
+    "<b>(9) /sensores/mediciones?sensores=s1,s2&desde=&hasta= </b>: mediciones de varios sensores<br>"
+    "<b>(10) /detectar/resultados?limite=&sensor= </b>: últimos resultados de la detección<br>"
+    "<b>(11) /detectar/lote?desde=&hasta= </b>: puntúa por lotes un rango de la serie (o un CSV con POST)<br>"
+    "<b>(12) /exportar?desde=&hasta=&formato=npy|arrow|binario&compresion=gzip|zstd </b>: exporta las mediciones en binario<br>"
+    "<b>(13) /modelos </b>: versiones de los modelos de cada sensor y modelos cargados<br>"
+    "<b>(14) /modelos/activar?sensor=&version= </b>: activa una versión del modelo de un sensor<br>"
+    "<b>(15) /metrics </b>: métricas en formato Prometheus<br>"
+    "<b>(16) / </b>: página principal<br>")
 
 @app.route("/detectar")
 def detectar_dato_anomalia():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
     # Hacemos una petición GET del valor enviado
     dato = request.args.get("dato")
     # Si no hay valor devolveremos un mensaje de error y el "status code" de HTTP 400
@@ -149,42 +446,51 @@ def detectar_dato_anomalia():
         # convertimos este valor a el tipo  entero(el formato de redis lo requiere)
         timestamp = int(datetime.now().timestamp() * 1000) 
 
+        # Tiempo de cada etapa de la petición para /metrics
+        cronometro = metricas.registro.cronometro("/detectar")
         try:
-            # Guardamos 10 muestras de redis
-            muestras = redis.execute_command(
-                'TS.REVRANGE',
-                'mediciones',
-                '-',
-                '+',
-                'COUNT',
-                windows_size
-            )
-
-            # Lo ejecutamos después para que no tenga el cuenta el nuevo valor añadido
-            # Ejecutamos el comando de RedisTimeSeries TS.ADD para añadir una instancia
-            # a la serie temporal 'mediciones'
-            redis.execute_command('TS.ADD', 'mediciones', timestamp, valor)
-
-            # Redis las da al revés cronológicamente  
-            muestras = list(reversed(muestras))
-            # Cogemos lo valores de cada instancia de la ventan
-            valores_ventana = [float(v) for _, v in muestras]
-            # Lo convertimos en un array de numpy y la redimensionamos 
-            # al tamaño correcto(en columnas (windows_size, 1) en este caso(10, 1)),
-            # (el -1 calcula automáticamente el tamaño adecuado)
-            valores_ventana_np = np.array(valores_ventana).reshape(-1, 1)
-            # Escalamos la ventana ya en columnas(ya que el escalador esparan arrays en 2D
-            valores_escalados = scaler.transform(valores_ventana_np)
-            # Redimensionamos de nuevo a una lista para hacer la predicción(1, windows_size)
-            # una muestra con #windows_size características, en este caso (1, 10)
-            ventana_escalada = valores_escalados.reshape(1, windows_size)
-            # Hacemos la predicción y extraemos el valor único pasándolo a float de Python
+            series.asegurar_sensor(redis, sensor)
+            cronometro.marca("asegurar_serie")
+            # El modelo se obtiene una vez y se usa hasta el final aunque mientras tanto se active otra versión
+            modelo = modelo_sensor(sensor)
+            cronometro.marca("modelo")
+            # La ventana en memoria del modo online está escalada con el escalador del modelo base
+            if cache_ventanas is not None and modelo is modelo_base:
+                # Modo online: la ventana anterior ya está escalada en memoria, solo se escribe en Redis
+                muestras, valores_escalados = cache_ventanas.anadir_y_ventana(redis, clave, timestamp, valor)
+                cronometro.marca("ventana_online")
+            else:
+                # Leemos la ventana con las windows_size muestras anteriores y añadimos el nuevo valor con
+                # TS.ADD en una sola llamada atómica a Redis (script Lua de ventanas.py), así la ventana no
+                # cambia entre la lectura y la escritura aunque otras réplicas escriban en la misma serie.
+                # La tarea 'redis' del arranque devuelve el script ya cargado
+                muestras = ventanas.anadir_y_leer(arranque.esperar("redis"), clave, timestamp, valor, modelo.windows_size)
+                cronometro.marca("ventana_y_ts_add")
+                if cache_ventanas is not None:
+                    # Serie con modelo propio: su ventana en memoria (si la tiene) ya no está al día
+                    cache_ventanas.invalidar(clave)
+                # Cogemos lo valores de cada instancia de la ventan
+                valores_ventana = [float(v) for _, v in muestras]
+                # Lo convertimos en un array de numpy y la redimensionamos 
+                # al tamaño correcto(en columnas (windows_size, 1) en este caso(10, 1)),
+                # (el -1 calcula automáticamente el tamaño adecuado)
+                valores_ventana_np = np.array(valores_ventana).reshape(-1, 1)
+                # Escalamos la ventana ya en columnas(ya que el escalador esparan arrays en 2D
+                valores_escalados = modelo.scaler.transform(valores_ventana_np)
+                cronometro.marca("escalado")
+            if cache_respuestas is not None:
+                cache_respuestas.anadido(clave, timestamp, valor)
+            # Redimensionamos a la forma de entrada del modelo (windows_size, 1): una secuencia de
+            # #windows_size pasos con una característica, en este caso (10, 1)
+            ventana_escalada = valores_escalados.reshape(modelo.windows_size, 1)
+            # Encolamos la ventana en el planificador, que la agrupa con las de otras peticiones
+            # concurrentes en una sola llamada al modelo y nos devuelve nuestra predicción como float
             # (predicción del siguiente valor de la ventana)
-            prediccion = float(model.predict(ventana_escalada)[0][0])
-            # Versión más elegante: prediccion = float(model.predict(ventana_escalada).squeeze())
+            prediccion = planificador.predecir(modelo.predecir, ventana_escalada)
+            cronometro.marca("prediccion")
             
             # Calculamos el error absoluto de la diferencia y lo comparamos con un umbral ajustado
-            threshold_ajustado = threshold/4
+            threshold_ajustado = modelo.threshold/4
             # Si la difrencia entre el valor y la predicción es mayor que la cuarta parte del
             # umbral => anomalía
             es_anomalo = abs(valor - prediccion) > threshold_ajustado
@@ -195,11 +501,14 @@ def detectar_dato_anomalia():
                     {"time": t, "valor": float(v)} for t, v in muestras
                 ],
                 "prediccion": prediccion,
-                "threshold": threshold,
-                "es_anomalo": es_anomalo
+                "threshold": modelo.threshold,
+                "es_anomalo": es_anomalo,
+                "modelo": modelo.version
             }
-            with open("src/respuesta.json", "w") as f:
-                json.dump({"respuesta": respuesta}, f)
+            # Lo añadimos al registro de resultados (sin escribir en disco dentro de la petición)
+            registro_resultados.registrar({"time": timestamp, "sensor": sensor or series.SENSOR_POR_DEFECTO,
+                                           "valor": valor, **respuesta})
+            cronometro.marca("registro_resultado")
                 
         except RedisError as e:
             return f"ERROR: error al evaluar un dato con Redis => {e}", 500
@@ -207,16 +516,87 @@ def detectar_dato_anomalia():
             return f"ERROR: error inesperado al evaluar un datos en Redis => {e}", 500
         
         return (f"Para el dato: <b>{valor}</b>, se ha hecho la predicción: <b>{prediccion}</b>.<br>" 
-                f"¿Es {valor} un dato anómalo para el umbral {threshold:.3f}?: <b>{es_anomalo}</b><br>"
+                f"¿Es {valor} un dato anómalo para el umbral {modelo.threshold:.3f}?: <b>{es_anomalo}</b><br>"
                 f"CORRECTO: <b>Dato={dato} °C </b> almacenado en la fecha <b>{timestamp_a_fecha_con_formato(timestamp)}</b><br> por el hostname: <b>{socket.gethostname()}</b>")
 
+@app.route("/detectar/lote", methods=["GET", "POST"])
+def detectar_lote():
+    # Puntúa por lotes todas las ventanas de un rango de la serie (GET, con desde y hasta) o de un CSV
+    # fecha,valor enviado en el cuerpo (POST). Con escribir=1 guarda el resultado de cada una en la serie
+    # de anomalías (la de la serie o, para un CSV, una aparte; ver puntuacion.py)
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    try:
+        clave = series.clave_serie(sensor)
+        desde, hasta, _, _, _ = consultas.leer_parametros(request.args)
+    except (series.ParametroInvalido, consultas.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    escribir = request.args.get("escribir", "0") == "1"
+
+    try:
+        modelo = modelo_sensor(sensor)
+        if request.method == "POST":
+            trozos = puntuacion.trozos_csv(puntuacion.leer_csv(request.stream))
+            destino = puntuacion.clave_anomalias_csv(clave)
+        else:
+            puntuacion.comprobar_rango(redis, clave, desde, hasta)
+            trozos = puntuacion.trozos_redis(redis, clave, desde, hasta, modelo.windows_size)
+            destino = puntuacion.clave_anomalias(clave)
+        resumen = puntuacion.ejecutar(trozos, modelo.predecir, modelo.escalar, modelo.windows_size, modelo.threshold/4,
+                                      redis, destino if escribir else None)
+    except puntuacion.LoteDemasiadoGrande as e:
+        return f"ERROR: {e}", 413
+    except RedisError as e:
+        return f"ERROR: error al puntuar la serie con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al puntuar la serie => {e}", 500
+
+    resumen["modelo"] = modelo.version
+    resumen["hostname"] = socket.gethostname()
+    return jsonify(resumen)
+
+@app.route("/detectar/resultados")
+def resultados_deteccion():
+    # Últimos resultados de /detectar (más recientes primero), opcionalmente de un solo sensor
+    sensor = request.args.get("sensor")
+    try:
+        limite = int(request.args.get("limite", 100))
+    except ValueError:
+        return "ERROR: 'limite' debe ser un número entero", 400
+    return jsonify({"resultados": registro_resultados.ultimos(limite, sensor), **registro_resultados.estadisticas(),
+                    "hostname": socket.gethostname()})
+
+@app.route("/modelos")
+def estado_modelos():
+    # Versiones de los modelos de cada sensor (en disco y activas) y modelos cargados en este worker
+    return jsonify({**registro_modelos.estado(), "hostname": socket.gethostname()})
+
+@app.route("/modelos/activar")
+def activar_modelo():
+    # Activa una versión del modelo de un sensor en todas las réplicas (la usan desde su siguiente refresco)
+    sensor = request.args.get("sensor") or series.SENSOR_POR_DEFECTO
+    version = request.args.get("version")
+    if not version:
+        return "ERROR: falta el parámetro 'version'", 400
+    try:
+        registro_modelos.activar(redis, sensor, version)
+    except ValueError as e:
+        return f"ERROR: {e}", 404
+    except RedisError as e:
+        return f"ERROR: no se pudo activar la versión en Redis => {e}", 500
+    return f"Versión '{version}' del modelo del sensor '{sensor}' activada."
+
+@app.route("/inferencia/estadisticas")
+def estadisticas_inferencia():
+    # Tamaño de los lotes de inferencia y tiempo de espera en cola de las ventanas
+    return jsonify(planificador.estadisticas())
 
 if __name__ == "__main__":
     # Obtiene el valor de la variable de entorno PORT y si no está definidad usará el puerto 80
     PORT = os.getenv('PORT', 80)
     # Imprime el puerto para una verificación
     print("PORT: "+str(PORT))
-    # Arranca el servidor Flask escuchando a todas las interfaces(0.0.0.0) para ser accesible desde otros contenedores
-    # o la máquina host
+    # Arranca el servidor de desarrollo de Flask escuchando a todas las interfaces(0.0.0.0) para ser accesible
+    # desde otros contenedores o la máquina host (en producción se usa Gunicorn con gunicorn.conf.py)
     app.run(host='0.0.0.0', port=PORT)
 
@@ -0,0 +1,409 @@
+from quart import Quart, request, jsonify
+from redis import RedisError
+from redis.asyncio import Redis
+from redis.asyncio.sentinel import Sentinel
+from redis.asyncio.cluster import RedisCluster, ClusterNode
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import socket
+from datetime import datetime
+import numpy as np
+import ingesta
+import consultas
+import series
+import detector
+import inferencia
+import ventanas
+import resultados
+import arranque
+import roles
+import modelos
+import comandos
+import json
+
+# ---------------------------------------------------------------------------------------------------
+# Variante asíncrona (asyncio) de main-ej3.py
+# ---------------------------------------------------------------------------------------------------
+# Mismas rutas principales (/nuevo, /nuevo_lote, /listar, /borrar y /detectar) servidas con Quart y el
+# cliente asíncrono de redis-py (redis.asyncio) en los tres modos: SIMPLE, SENTINEL y CLUSTER.
+# Un solo proceso atiende muchas peticiones a la vez sin un hilo por petición: mientras una espera a
+# Redis el bucle de eventos atiende las demás. La inferencia del modelo es trabajo de CPU, así que no
+# se ejecuta en el bucle sino en un pool de hilos (run_in_executor) a través del planificador de lotes.
+#
+# Comparte con main-ej3.py la lógica de escritura (los pasos de series.py, ingesta.py, agregados.py y
+# detector.py, ejecutados con comandos.ejecutar_async), el arranque en segundo plano del modelo con las
+# sondas /healthz y /readyz (arranque.py), los roles (ROL, roles.py) y los modelos por sensor (modelos.py).
+# No incluye el resto de rutas de main-ej3.py (/agregar, /exportar, /sensores, /detectar/lote, /modelos,
+# /metrics...), ni la caché de respuestas, el modo de ventana online, la lectura en réplicas, el circuito
+# y el buffer de /nuevo para cuando Redis no está disponible.
+#
+# Se lanza con Hypercorn, por ejemplo:
+#   hypercorn --bind 0.0.0.0:80 --workers 2 src/main-ej3-async:app
+
+# Variable de entorno para el modo de ejecución (igual que en main-ej3.py)
+MODO_REDIS = os.getenv('MODO_REDIS', 'SIMPLE')
+# Conexiones máximas del pool del cliente asíncrono (las peticiones en vuelo las comparten)
+REDIS_MAX_CONEXIONES = int(os.getenv('REDIS_MAX_CONEXIONES', 64))
+# Hilos del pool en el que esperan las ventanas enviadas al planificador de inferencia
+INFERENCIA_HILOS = int(os.getenv('INFERENCIA_HILOS', 64))
+
+redis = None
+script_ventana = None
+
+print(f"Iniciando aplicación asíncrona en modo: {MODO_REDIS}")
+
+
+def crear_cliente_redis():
+    if MODO_REDIS == 'SENTINEL':
+        sentinel_hosts = [
+            (os.getenv('SENTINEL_HOST', 'sentinel1'), 26379),
+            (os.getenv('SENTINEL_HOST2', 'sentinel2'), 26380),
+            (os.getenv('SENTINEL_HOST3', 'sentinel3'), 26381)
+        ]
+        sentinel = Sentinel(sentinel_hosts, socket_timeout=0.1)
+        return sentinel.master_for('mymaster', socket_timeout=0.1, decode_responses=True,
+                                   max_connections=REDIS_MAX_CONEXIONES)
+    if MODO_REDIS == 'CLUSTER':
+        startup_nodes = [
+            ClusterNode(os.getenv('REDIS_HOST', 'redis-node-1'), 6379),
+            ClusterNode(os.getenv('REDIS_HOST2', 'redis-node-2'), 6379),
+            ClusterNode(os.getenv('REDIS_HOST3', 'redis-node-3'), 6379),
+        ]
+        return RedisCluster(
+            startup_nodes=startup_nodes,
+            decode_responses=True,
+            require_full_coverage=False,
+            socket_timeout=5,
+            socket_connect_timeout=5,
+            max_connections=REDIS_MAX_CONEXIONES,
+        )
+    REDIS_HOST = os.getenv('REDIS_HOST', "localhost")
+    print("REDIS_HOST: "+REDIS_HOST)
+    return Redis(host=REDIS_HOST, db=0, socket_connect_timeout=2, socket_timeout=2, decode_responses=True,
+                 max_connections=REDIS_MAX_CONEXIONES)
+
+# ---------------------------------------------------------------------------------------------------
+# Cargamos el modelo actual, escalador y json con la configuración de la práctica 1
+# ---------------------------------------------------------------------------------------------------
+# Como en main-ej3.py, las réplicas de ingesta y consulta (ROL, ver roles.py) no importan joblib ni
+# scikit-learn ni cargan el escalador y el modelo. El modelo se carga y se calienta en segundo plano
+# (tarea 'modelo' de arranque.py, lanzada en before_serving): mientras tanto /readyz responde 503
+scaler = None
+if roles.con_modelo():
+    import joblib
+    scaler = joblib.load('src/scaler.pkl')
+
+with open("src/config.json", "r") as f:
+    data = json.load(f)
+    threshold = data['threshold']
+    windows_size = data['windows_size']
+
+def cargar_modelo():
+    modelo = inferencia.cargar_modelo('src/modelo.keras', 'src/modelo_pesos.npz')
+    # Calentamiento con los tamaños de lote habituales para que no lo pague la primera petición
+    for n in sorted({1, inferencia.INFERENCIA_MAX_LOTE}):
+        modelo.predict_on_batch(np.zeros((n, windows_size, 1), dtype=np.float32))
+    return modelo
+
+def predecir_modelo(X):
+    # Se ejecuta en un hilo del ejecutor: si el modelo aún se está cargando espera a que termine
+    return arranque.esperar("modelo").predict_on_batch(X)
+
+# Modelo base (src/) con la misma forma que los modelos propios de cada sensor
+modelo_base = modelos.VersionModelo(None, modelos.VERSION_BASE, predecir_modelo, scaler, threshold, windows_size)
+# Modelos propios de cada sensor (ver modelos.py). El registro es síncrono (lee el directorio, carga los
+# modelos y lee las versiones activas con HGETALL): se usa desde el ejecutor y con un cliente de Redis
+# síncrono propio, que se crea en segundo plano (tarea 'registro_modelos')
+registro_modelos = modelos.RegistroModelos()
+
+def conectar_registro_modelos():
+    cliente = detector.conectar(MODO_REDIS)
+    cliente.ping()
+    registro_modelos.redis = cliente
+    return cliente
+
+# Agrupa las ventanas de las peticiones concurrentes de /detectar en una sola llamada al modelo. Cada
+# ventana espera su resultado en un hilo del ejecutor, nunca en el bucle de eventos
+planificador = inferencia.PlanificadorInferencia()
+ejecutor = ThreadPoolExecutor(max_workers=INFERENCIA_HILOS, thread_name_prefix="inferencia")
+
+# Registro de los resultados de /detectar. El escritor en segundo plano es un hilo y no puede usar el
+# cliente asíncrono, así que aquí solo se admite el destino 'jsonl' (además de la memoria)
+registro_resultados = resultados.RegistroResultados()
+
+# ---------------------------------------------------------------------------------------------------
+# Funciones auxiliares
+# ---------------------------------------------------------------------------------------------------
+def timestamp_a_fecha_con_formato(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000).strftime('%d/%m/%Y %H:%M:%S')
+
+def clave_de_peticion():
+    # Serie del sensor indicado (o 'mediciones' si no se indica ninguno)
+    sensor = request.args.get("sensor")
+    return sensor, series.clave_serie(sensor)
+
+async def ejecutar(pasos):
+    # Pasos de escritura compartidos con las aplicaciones síncronas (ver comandos.py)
+    return await comandos.ejecutar_async(redis, pasos)
+
+def modelo_sensor(sensor):
+    # Versión activa del modelo propio del sensor (se carga la primera vez) o, si no tiene, el modelo base.
+    # Puede leer de disco y de Redis: se llama desde el ejecutor
+    return registro_modelos.obtener(sensor or series.SENSOR_POR_DEFECTO) or modelo_base
+
+async def leer_trozos(clave, desde, hasta, orden, limite):
+    # Versión asíncrona de consultas.leer_trozos
+    pendientes = limite
+    while pendientes is None or pendientes > 0:
+        n = consultas.tam_siguiente_trozo(pendientes)
+        trozo = await redis.execute_command(consultas.comando_rango(orden), clave, desde, hasta, 'COUNT', n)
+        if not trozo:
+            return
+        yield trozo
+        if pendientes is not None:
+            pendientes -= len(trozo)
+        rango = consultas.avanzar(trozo, n, orden, desde, hasta)
+        if rango is None:
+            return
+        desde, hasta = rango
+
+# ---------------------------------------------------------------------------------------------------
+# Aplicación Quart
+# ---------------------------------------------------------------------------------------------------
+app = Quart(__name__)
+
+@app.before_serving
+async def arrancar():
+    # El cliente asíncrono se crea dentro del bucle de eventos del servidor. El modelo se carga en
+    # segundo plano, en cada worker de Hypercorn
+    global redis, script_ventana
+    redis = crear_cliente_redis()
+    if roles.con_modelo():
+        arranque.tarea("modelo", cargar_modelo)
+        arranque.tarea("registro_modelos", conectar_registro_modelos, reintentar_s=arranque.ARRANQUE_REINTENTO_S)
+    # Script atómico de /detectar (ventanas.SCRIPT_VENTANA); si aún no se puede cargar, EVALSHA lo carga
+    # en la primera llamada
+    script_ventana = redis.register_script(ventanas.SCRIPT_VENTANA)
+    try:
+        await redis.script_load(ventanas.SCRIPT_VENTANA)
+        await ejecutar(series.pasos_preparar_serie_principal())
+    except Exception as e:
+        print(f"ERROR: No se pudo preparar la serie 'mediciones' y sus compactaciones: {e}")
+
+@app.before_request
+async def comprobar_rol():
+    # Con ROL=ingesta|consulta|deteccion las rutas de los otros roles responden 404 (ver roles.py)
+    return roles.rechazo(request.endpoint)
+
+@app.after_serving
+async def parar():
+    ejecutor.shutdown(wait=False)
+    await redis.aclose()
+
+@app.route("/nuevo")
+async def nueva_medicion():
+    try:
+        sensor, clave = clave_de_peticion()
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    dato = request.args.get("dato")
+    if dato is None:
+        return "ERROR: falta el parámetro 'dato'", 400
+    try:
+        valor = float(dato)
+    except ValueError:
+        return "ERROR: el valor debe ser numérico", 400
+
+    timestamp = int(datetime.now().timestamp() * 1000)
+    try:
+        await ejecutar(series.pasos_asegurar_sensor(sensor))
+        if detector.DETECCION_ASINCRONA:
+            # La detección la hacen aparte los procesos de detector.py, como en main-ej3.py
+            await detector.anadir_y_publicar_async(redis, clave, sensor, timestamp, valor)
+        else:
+            await redis.execute_command('TS.ADD', clave, timestamp, valor)
+    except RedisError as e:
+        return f"ERROR: error al insertar un dato con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al insertar un datos en Redis => {e}", 500
+
+    return f"CORRECTO: <b>Dato={dato} °C </b> almacenado en la fecha <b>{timestamp_a_fecha_con_formato(timestamp)}</b><br> por el hostname: <b>{socket.gethostname()}</b>"
+
+@app.route("/nuevo_lote", methods=["POST"])
+async def nuevo_lote():
+    try:
+        sensor, clave = clave_de_peticion()
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    try:
+        marcas, valores, errores = ingesta.leer_lote(await request.get_data(), request.mimetype)
+    except ingesta.LoteInvalido as e:
+        return f"ERROR: {e}", 400
+
+    try:
+        await ejecutar(series.pasos_asegurar_sensor(sensor))
+        resumen = await ejecutar(ingesta.pasos_almacenar_lote(clave, marcas, valores, errores))
+    except RedisError as e:
+        return f"ERROR: error al insertar el lote con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al insertar el lote en Redis => {e}", 500
+
+    resumen["hostname"] = socket.gethostname()
+    return jsonify(resumen)
+
+@app.route("/listar")
+async def listar():
+    try:
+        _, clave = clave_de_peticion()
+        desde, hasta, orden, limite, formato = consultas.leer_parametros(request.args)
+    except (series.ParametroInvalido, consultas.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+
+    args = request.args
+    trozos = leer_trozos(clave, desde, hasta, orden, limite)
+    try:
+        # El primer trozo se lee antes de responder para poder devolver los errores de Redis con su código
+        primero = await anext(trozos, None)
+    except RedisError as e:
+        return f"ERROR: error al listar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado listar los datos => {e}", 500
+
+    async def cuerpo():
+        yield consultas.cabecera(formato)
+        enviadas, ultimo, trozo = 0, None, primero
+        while trozo:
+            yield consultas.filas(formato, trozo, "Fecha: {fecha} => Valor: {valor} °C<br>", primero=enviadas == 0)
+            enviadas += len(trozo)
+            ultimo = int(trozo[-1][0])
+            trozo = await anext(trozos, None)
+        yield consultas.pie(formato, args, consultas.siguiente_cursor(orden, limite, enviadas, ultimo))
+
+    return cuerpo(), 200, {"Content-Type": consultas.FORMATOS[formato]}
+
+@app.route("/borrar")
+async def borrar_mediciones():
+    try:
+        sensor, clave = clave_de_peticion()
+        desde, hasta = consultas.leer_rango(request.args)
+    except (series.ParametroInvalido, consultas.ParametroInvalido) as e:
+        return f"ERROR: {e}", 400
+    try:
+        if desde != '-' or hasta != '+':
+            # Las mediciones del rango y los resultados de la detección del mismo rango
+            borradas = await ejecutar(detector.pasos_borrar_rango(clave, desde, hasta))
+            return f"Se han borrado {borradas} mediciones."
+        # Como en main-ej3.py: UNLINK de la serie, sus compactadas y sus resultados (Redis libera la memoria
+        # en segundo plano) y la volvemos a crear vacía con sus etiquetas y reglas (ver series.recrear)
+        await redis.unlink(*detector.claves_serie_completa(clave))
+        await ejecutar(series.pasos_recrear(sensor))
+        return "Las mediciones se han borrado con éxito."
+    except RedisError as e:
+        return f"ERROR: error al borrar los datos con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al borrar los datos => {e}", 500
+
+@app.route("/detectar")
+async def detectar_dato_anomalia():
+    try:
+        sensor, clave = clave_de_peticion()
+    except series.ParametroInvalido as e:
+        return f"ERROR: {e}", 400
+    dato = request.args.get("dato")
+    if dato is None:
+        return "ERROR: falta el parámetro 'dato'", 400
+    try:
+        valor = float(dato)
+    except ValueError:
+        return "ERROR: el valor debe ser numérico", 400
+
+    timestamp = int(datetime.now().timestamp() * 1000)
+    try:
+        await ejecutar(series.pasos_asegurar_sensor(sensor))
+        bucle = asyncio.get_running_loop()
+        # El modelo se obtiene una vez y se usa hasta el final aunque mientras tanto se active otra versión
+        modelo = await bucle.run_in_executor(ejecutor, modelo_sensor, sensor)
+        # Ventana anterior al nuevo valor y TS.ADD en una sola llamada atómica (Redis da la ventana al revés
+        # cronológicamente)
+        muestras = await script_ventana(keys=[clave], args=[timestamp, valor, modelo.windows_size])
+        muestras = list(reversed(muestras))
+
+        ventana_escalada = modelo.escalar([float(v) for _, v in muestras]).reshape(modelo.windows_size, 1)
+        # El planificador bloquea hasta tener la predicción del lote: se espera en un hilo del ejecutor
+        prediccion = await bucle.run_in_executor(ejecutor, planificador.predecir, modelo.predecir, ventana_escalada)
+
+        threshold_ajustado = modelo.threshold/4
+        es_anomalo = abs(valor - prediccion) > threshold_ajustado
+
+        respuesta = {
+            "mediciones": [
+                {"time": t, "valor": float(v)} for t, v in muestras
+            ],
+            "prediccion": prediccion,
+            "threshold": modelo.threshold,
+            "es_anomalo": es_anomalo,
+            "modelo": modelo.version
+        }
+        registro_resultados.registrar({"time": timestamp, "sensor": sensor or series.SENSOR_POR_DEFECTO,
+                                       "valor": valor, **respuesta})
+    except RedisError as e:
+        return f"ERROR: error al evaluar un dato con Redis => {e}", 500
+    except Exception as e:
+        return f"ERROR: error inesperado al evaluar un datos en Redis => {e}", 500
+
+    return (f"Para el dato: <b>{valor}</b>, se ha hecho la predicción: <b>{prediccion}</b>.<br>"
+            f"¿Es {valor} un dato anómalo para el umbral {modelo.threshold:.3f}?: <b>{es_anomalo}</b><br>"
+            f"CORRECTO: <b>Dato={dato} °C </b> almacenado en la fecha <b>{timestamp_a_fecha_con_formato(timestamp)}</b><br> por el hostname: <b>{socket.gethostname()}</b>")
+
+@app.route("/detectar/resultados")
+async def resultados_deteccion():
+    sensor = request.args.get("sensor")
+    try:
+        limite = int(request.args.get("limite", 100))
+    except ValueError:
+        return "ERROR: 'limite' debe ser un número entero", 400
+    return jsonify({"resultados": registro_resultados.ultimos(limite, sensor), **registro_resultados.estadisticas(),
+                    "hostname": socket.gethostname()})
+
+@app.route("/inferencia/estadisticas")
+async def estadisticas_inferencia():
+    return jsonify(planificador.estadisticas())
+
+@app.route("/healthz")
+async def vivo():
+    # Sonda de vida: el proceso responde aunque siga arrancando; incluye el estado de cada tarea del arranque
+    return jsonify({"estado": arranque.estado(), "hostname": socket.gethostname()})
+
+@app.route("/readyz")
+async def preparado():
+    # Sonda de disponibilidad: con el modelo cargado y calentado (en los roles que lo usan) y Redis accesible
+    if not arranque.listo():
+        pendientes = ", ".join(f"{nombre}: {t['estado']}" for nombre, t in arranque.estado().items() if t["estado"] != "listo")
+        return f"ERROR: la réplica aún se está iniciando => {pendientes}", 503
+    try:
+        await redis.ping()
+    except Exception as e:
+        return f"ERROR: Redis no disponible => {e}", 503
+    return "OK"
+
+@app.route("/")
+async def bienvenido_instrucciones():
+    return (
+    f"<b>Hostname:</b> {socket.gethostname()}<br>"
+    "Bienvenid@ a la API asíncrona de <b>mediciones</b>!<br>"
+    "Funciones disponibles (todas admiten ?sensor=ID para usar la serie de otro sensor):<br>"
+    "<b>(1) /nuevo?dato=VALOR </b>: añade una medición<br>"
+    "<b>(2) /listar?desde=&hasta=&limite=&formato=html|json|csv </b>: muestra las mediciones tomadas<br>"
+    "<b>(3) /borrar </b>: borra todas las mediciones<br>"
+    "<b>(4) /detectar?dato=VALOR </b>: analiza si es una anomalía y añade la medicición<br>"
+    "<b>(5) POST /nuevo_lote </b>: añade un lote de mediciones (JSON, NDJSON o binario)<br>"
+    "<b>(6) /inferencia/estadisticas </b>: tamaño de lote y espera en cola de la inferencia<br>"
+    "<b>(7) /detectar/resultados?limite=&sensor= </b>: últimos resultados de la detección<br>"
+    "<b>(8) / </b>: página principal<br>")
+
+if __name__ == "__main__":
+    PORT = int(os.getenv('PORT', 80))
+    print("PORT: "+str(PORT))
+    # Servidor de desarrollo de Quart; en producción se usa Hypercorn
+    app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from flask import g, request
+from redis import RedisError
+from inferencia import Histograma
+
+# ---------------------------------------------------------------------------------------------------
+# Métricas en formato Prometheus y perfilador por muestreo
+# ---------------------------------------------------------------------------------------------------
+# /metrics devuelve en formato de texto de Prometheus:
+#   - api_peticiones_total y api_peticion_segundos: peticiones y latencia por ruta
+#   - api_etapa_segundos: tiempo de cada etapa de una ruta (lectura de Redis, TS.ADD, escalado, modelo...)
+#   - redis_comando_segundos y redis_errores_total: latencia de cada comando y errores por modo y tipo
+#   - redis_pool_conexiones: conexiones en uso y libres de cada pool (un pool por nodo en modo CLUSTER)
+#   - inferencia_*: tamaño de los lotes del modelo y espera en cola del planificador
+# Cada worker de Gunicorn tiene sus propias métricas; Prometheus debe consultar cada réplica/worker.
+#
+# Con PERFILADOR=1 la ruta /debug/perfil?segundos=N muestrea las pilas de todos los hilos durante N
+# segundos y las devuelve en formato 'folded' (una pila por línea y su número de muestras), que se
+# convierte en un flame graph con flamegraph.pl o se abre directamente en https://www.speedscope.app
+
+PERFILADOR = os.getenv('PERFILADOR', '0') == '1'
+PERFILADOR_MAX_S = float(os.getenv('PERFILADOR_MAX_S', 60))
+PERFILADOR_INTERVALO_S = float(os.getenv('PERFILADOR_INTERVALO_S', 0.005))
+
+CUBOS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _etiquetas(pares):
+    if not pares:
+        return ""
+    texto = ",".join('{}="{}"'.format(nombre, str(valor).replace("\\", "\\\\").replace('"', '\\"')) for nombre, valor in pares)
+    return "{" + texto + "}"
+
+
+def formato_histograma(nombre, pares, histograma):
+    # Los cubos de Histograma ya son acumulados (observaciones <= límite), como los de Prometheus
+    lineas = [f"{nombre}_bucket{_etiquetas(pares + (('le', limite),))} {cuenta}"
+              for limite, cuenta in zip(histograma.cubos, histograma.cuentas)]
+    lineas.append(f"{nombre}_bucket{_etiquetas(pares + (('le', '+Inf'),))} {histograma.total}")
+    lineas.append(f"{nombre}_sum{_etiquetas(pares)} {histograma.suma}")
+    lineas.append(f"{nombre}_count{_etiquetas(pares)} {histograma.total}")
+    return lineas
+
+
+class Cronometro:
+    # Mide etapas consecutivas de una petición: cada marca guarda el tiempo desde la marca anterior
+    def __init__(self, metricas, ruta):
+        self.metricas = metricas
+        self.ruta = ruta
+        self.ultimo = time.perf_counter()
+
+    def marca(self, etapa):
+        ahora = time.perf_counter()
+        self.metricas.observar("api_etapa_segundos", ahora - self.ultimo, ruta=self.ruta, etapa=etapa)
+        self.ultimo = ahora
+
+
+class Metricas:
+    def __init__(self):
+        self._cerrojo = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        # Funciones que calculan medidas al pedir /metrics (conexiones del pool, cola de inferencia...)
+        self._recolectores = []
+
+    def contar(self, nombre, n=1, **etiquetas):
+        clave = tuple(etiquetas.items())
+        with self._cerrojo:
+            serie = self._contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + n
+
+    def observar(self, nombre, valor, cubos=CUBOS_SEGUNDOS, **etiquetas):
+        clave = tuple(etiquetas.items())
+        with self._cerrojo:
+            serie = self._histogramas.setdefault(nombre, {})
+            if clave not in serie:
+                serie[clave] = Histograma(cubos)
+            serie[clave].observar(valor)
+
+    def cronometro(self, ruta):
+        return Cronometro(self, ruta)
+
+    def recolector(self, funcion):
+        self._recolectores.append(funcion)
+        return funcion
+
+    def exposicion(self):
+        lineas = []
+        with self._cerrojo:
+            for nombre, serie in sorted(self._contadores.items()):
+                lineas.append(f"# TYPE {nombre} counter")
+                lineas += [f"{nombre}{_etiquetas(pares)} {valor}" for pares, valor in serie.items()]
+            for nombre, serie in sorted(self._histogramas.items()):
+                lineas.append(f"# TYPE {nombre} histogram")
+                for pares, histograma in serie.items():
+                    lineas += formato_histograma(nombre, pares, histograma)
+        for recolector in self._recolectores:
+            try:
+                lineas += recolector()
+            except Exception as e:
+                lineas.append(f"# ERROR en {recolector.__name__}: {e}")
+        return "\n".join(lineas) + "\n"
+
+
+registro = Metricas()
+
+
+def instrumentar_flask(app):
+    # Latencia y código de estado de todas las rutas. En las respuestas en streaming (/listar) se mide
+    # hasta que empieza el envío
+    @app.before_request
+    def _inicio_peticion():
+        g.inicio_peticion = time.perf_counter()
+
+    @app.after_request
+    def _fin_peticion(respuesta):
+        inicio = g.pop("inicio_peticion", None)
+        if inicio is not None:
+            ruta = request.url_rule.rule if request.url_rule else "desconocida"
+            registro.observar("api_peticion_segundos", time.perf_counter() - inicio, ruta=ruta)
+            registro.contar("api_peticiones_total", ruta=ruta, estado=respuesta.status_code)
+        return respuesta
+
+
+def instrumentar_redis(cliente, modo):
+    # Envuelve execute_command del cliente (todos los comandos pasan por él) para medir la latencia
+    # de cada comando y contar los errores por tipo
+    if cliente is None:
+        return cliente
+    original = cliente.execute_command
+
+    def execute_command(*args, **kwargs):
+        comando = str(args[0]).upper() if args else ""
+        inicio = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        except RedisError as e:
+            registro.contar("redis_errores_total", modo=modo, tipo=type(e).__name__)
+            raise
+        finally:
+            registro.observar("redis_comando_segundos", time.perf_counter() - inicio, modo=modo, comando=comando)
+
+    cliente.execute_command = execute_command
+    _clientes_redis[modo] = cliente
+    return cliente
+
+
+# Clientes instrumentados por modo, de los que se publica el uso del pool de conexiones
+_clientes_redis = {}
+
+
+@registro.recolector
+def pool_redis():
+    lineas = ["# TYPE redis_pool_conexiones gauge"]
+    for modo, cliente in list(_clientes_redis.items()):
+        for nodo, pool in _pools(cliente):
+            for estado, conexiones in zip(("en_uso", "libres"), _uso_pool(pool)):
+                pares = (("modo", modo), ("nodo", nodo), ("estado", estado))
+                lineas.append(f"redis_pool_conexiones{_etiquetas(pares)} {conexiones}")
+    return lineas
+
+
+def _uso_pool(pool):
+    # (conexiones en uso, conexiones libres) de un pool de redis-py
+    if hasattr(pool, "_connections") and hasattr(pool, "pool"):
+        # BlockingConnectionPool (modo SIMPLE): la cola tiene las conexiones libres y un None por cada
+        # conexión que aún se puede abrir; _connections, todas las abiertas
+        libres = sum(1 for conexion in list(pool.pool.queue) if conexion is not None)
+        return len(pool._connections) - libres, libres
+    return len(getattr(pool, "_in_use_connections", ())), len(getattr(pool, "_available_connections", ()))
+
+
+def _pools(cliente):
+    if hasattr(cliente, "get_nodes"):
+        # RedisCluster: un cliente (y un pool) por nodo
+        for nodo in cliente.get_nodes():
+            if nodo.redis_connection is not None:
+                yield nodo.name, nodo.redis_connection.connection_pool
+    elif getattr(cliente, "connection_pool", None) is not None:
+        yield "principal", cliente.connection_pool
+
+
+def instrumentar_planificador(planificador):
+    @registro.recolector
+    def inferencia():
+        tam_lote, espera, en_cola = planificador.histogramas()
+        lineas = ["# TYPE inferencia_lote_tamano histogram"]
+        lineas += formato_histograma("inferencia_lote_tamano", (), tam_lote)
+        lineas.append("# TYPE inferencia_espera_cola_ms histogram")
+        lineas += formato_histograma("inferencia_espera_cola_ms", (), espera)
+        lineas.append("# TYPE inferencia_en_cola gauge")
+        lineas.append(f"inferencia_en_cola {en_cola}")
+        return lineas
+
+
+def perfil(segundos, intervalo_s=PERFILADOR_INTERVALO_S):
+    # Perfilador por muestreo: cada intervalo_s guarda la pila de cada hilo (salvo el que muestrea) y
+    # devuelve las pilas en formato 'folded': "hilo;funcion (fichero);funcion (fichero) muestras"
+    propio = threading.get_ident()
+    pilas = Counter()
+    fin = time.monotonic() + min(segundos, PERFILADOR_MAX_S)
+    while time.monotonic() < fin:
+        nombres = {hilo.ident: hilo.name for hilo in threading.enumerate()}
+        for ident, marco in sys._current_frames().items():
+            if ident == propio:
+                continue
+            pila = []
+            while marco is not None:
+                pila.append(f"{marco.f_code.co_name} ({os.path.basename(marco.f_code.co_filename)})")
+                marco = marco.f_back
+            pilas[";".join([nombres.get(ident, str(ident))] + pila[::-1])] += 1
+        time.sleep(intervalo_s)
+    return "".join(f"{pila} {n}\n" for pila, n in pilas.most_common())
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from redis import RedisError
+import inferencia
+import ventanas
+import metricas
+
+# ---------------------------------------------------------------------------------------------------
+# Registro de modelos por sensor y versión
+# ---------------------------------------------------------------------------------------------------
+# Además del modelo base (src/modelo.keras, src/scaler.pkl y src/config.json, cargado al arrancar), cada
+# sensor puede tener sus propios modelos versionados en MODELOS_DIRECTORIO:
+#
+#   src/modelos/<sensor>/<version>/   modelo.keras, modelo_pesos.npz, modelo_*.tflite, scaler.pkl y config.json
+#
+# como los que guarda src_p1/entrenar.py con --version. La versión activa de cada sensor es la indicada en
+# el hash de Redis MODELOS_CLAVE_ACTIVOS (GET /modelos/activar) y, si no hay ninguna, la última versión en
+# orden alfabético (por ejemplo fechas AAAAMMDDHHMMSS). Los sensores sin modelos propios usan el modelo base.
+#
+# - Los modelos se cargan la primera vez que se usan y se guardan en una LRU acotada por MODELOS_MEMORIA_MB;
+#   al superarla se descartan los menos usados. El tamaño de cada modelo es lo que crece la memoria residente
+#   del proceso (VmRSS) al cargarlo y calentarlo, sin contar la importación de las librerías, que comparten
+#   todos; si no se puede medir (fuera de Linux), el tamaño de los ficheros del modelo y del escalador.
+# - El directorio y el hash de Redis se vuelven a leer cada MODELOS_REFRESCO_S segundos en un hilo en segundo
+#   plano (solo la primera lectura se hace en la petición): para desplegar un modelo reentrenado basta con
+#   copiar su versión y, si no es la última, activarla, sin reiniciar réplicas.
+# - El cambio de versión es atómico: cada petición obtiene el modelo al empezar y lo usa hasta el final,
+#   aunque entre tanto se active otra versión o se descarte de la LRU.
+
+MODELOS_DIRECTORIO = os.getenv('MODELOS_DIRECTORIO', 'src/modelos')
+MODELOS_MEMORIA_MB = float(os.getenv('MODELOS_MEMORIA_MB', 256))
+MODELOS_REFRESCO_S = float(os.getenv('MODELOS_REFRESCO_S', 10))
+MODELOS_CLAVE_ACTIVOS = os.getenv('MODELOS_CLAVE_ACTIVOS', 'modelos:activos')
+
+# Versión del modelo base
+VERSION_BASE = "base"
+
+
+class VersionModelo:
+    # Todo lo que /detectar necesita de un modelo: predicción, escalador, umbral y tamaño de ventana
+    def __init__(self, sensor, version, predecir, scaler, threshold, windows_size, tam=0):
+        self.sensor = sensor
+        self.version = version
+        self.predecir = predecir
+        self.scaler = scaler
+        self.escalar = ventanas.funcion_escalado(scaler) if scaler is not None else None
+        self.threshold = threshold
+        self.windows_size = windows_size
+        self.tam = tam
+
+
+def memoria_residente():
+    # VmRSS del proceso en bytes (solo Linux), o None
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _importar_backend(backend):
+    # La librería del backend se importa antes de medir: la comparten todos los modelos y no debe contar
+    # como memoria del primero que se carga
+    if backend == 'keras':
+        import keras  # noqa: F401
+    elif backend.startswith('tflite'):
+        inferencia.clase_interprete_tflite()
+
+
+def cargar_version(directorio, sensor, version, backend=inferencia.MODELO_BACKEND):
+    # Carga y calienta el modelo de un directorio con los mismos ficheros que src/
+    import joblib
+    with open(os.path.join(directorio, "config.json"), "r") as f:
+        config = json.load(f)
+    ruta_keras = os.path.join(directorio, "modelo.keras")
+    ruta_pesos = os.path.join(directorio, "modelo_pesos.npz")
+    ruta_scaler = os.path.join(directorio, "scaler.pkl")
+    # El escalador se carga antes de medir: ocupa muy poco, pero la primera vez importa scikit-learn
+    scaler = joblib.load(ruta_scaler)
+    backend = inferencia.elegir_backend(ruta_keras, backend)
+    _importar_backend(backend)
+    antes = memoria_residente()
+    modelo = inferencia.cargar_modelo(ruta_keras, ruta_pesos, backend)
+    for n in sorted({1, inferencia.INFERENCIA_MAX_LOTE}):
+        modelo.predict_on_batch(np.zeros((n, config["windows_size"], 1), dtype=np.float32))
+    despues = memoria_residente()
+    ruta_modelo = {"numpy": ruta_pesos, "keras": ruta_keras}.get(backend) or \
+        inferencia.ruta_tflite(ruta_keras, backend.split('-')[1])
+    tam = os.path.getsize(ruta_modelo) + os.path.getsize(ruta_scaler)
+    if antes is not None and despues is not None:
+        # Es aproximado: si otro hilo reserva o libera memoria mientras tanto también cuenta. Nunca se
+        # toma menos que los ficheros
+        tam = max(tam, despues - antes)
+    return VersionModelo(sensor, version, modelo.predict_on_batch, scaler, config["threshold"],
+                         config["windows_size"], tam)
+
+
+class RegistroModelos:
+    def __init__(self, redis=None, directorio=MODELOS_DIRECTORIO, memoria_mb=MODELOS_MEMORIA_MB,
+                 refresco_s=MODELOS_REFRESCO_S, cargar=cargar_version):
+        self.redis = redis
+        self.directorio = directorio
+        self.max_bytes = int(memoria_mb * 1024 * 1024)
+        self.refresco_s = refresco_s
+        self.cargar = cargar
+        # (sensor, version) => VersionModelo, del menos al más usado
+        self._cargados = OrderedDict()
+        self._bytes = 0
+        # Versiones en disco por sensor (ordenadas) y versiones activadas en Redis
+        self._versiones = {}
+        self._activos = {}
+        self._refrescado = None
+        self._cerrojo = threading.Lock()
+        self._cerrojo_refresco = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        # Un cerrojo por modelo que se está cargando, para no cargar el mismo dos veces a la vez
+        self._cargando = {}
+        self.cargas = 0
+        self.expulsiones = 0
+
+    # ---------------------------------------------------------------------------------------------
+    # Versiones disponibles y activas
+    # ---------------------------------------------------------------------------------------------
+    def _leer_directorio(self):
+        versiones = {}
+        if not os.path.isdir(self.directorio):
+            return versiones
+        for sensor in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, sensor)
+            if not os.path.isdir(ruta):
+                continue
+            disponibles = sorted(v for v in os.listdir(ruta) if os.path.isfile(os.path.join(ruta, v, "config.json")))
+            if disponibles:
+                versiones[sensor] = disponibles
+        return versiones
+
+    def refrescar(self):
+        versiones = self._leer_directorio()
+        activos = self._activos
+        if self.redis is not None:
+            try:
+                activos = self.redis.hgetall(MODELOS_CLAVE_ACTIVOS)
+            except RedisError as e:
+                # Se sigue con las versiones activas leídas la última vez
+                print(f"ERROR: no se pudieron leer las versiones activas de los modelos: {e}")
+        for sensor, version in activos.items():
+            if version not in versiones.get(sensor, ()):
+                print(f"ERROR: la versión activa '{version}' del sensor '{sensor}' no está en {self.directorio}, "
+                      f"se usa la última disponible")
+        with self._cerrojo:
+            self._versiones, self._activos = versiones, dict(activos)
+            self._refrescado = time.monotonic()
+
+    def _asegurar_refresco(self):
+        # La primera lectura se hace en la petición, que no puede elegir modelo sin ella; las siguientes las
+        # hace el hilo en segundo plano
+        if self._refrescado is None:
+            with self._cerrojo_refresco:
+                if self._refrescado is None:
+                    self.refrescar()
+        self._asegurar_hilo()
+
+    def _asegurar_hilo(self):
+        # Como en resultados.RegistroResultados: el hilo se arranca con la primera petición y se vuelve a
+        # arrancar si el proceso se ha bifurcado
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._cerrojo:
+            if self._pid != os.getpid() or self._hilo is None or not self._hilo.is_alive():
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name="registro-modelos", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            # Como mínimo un segundo entre lecturas del directorio y de Redis
+            time.sleep(max(self.refresco_s, 1))
+            try:
+                with self._cerrojo_refresco:
+                    self.refrescar()
+            except Exception as e:
+                # Se sigue con lo leído la última vez
+                print(f"ERROR: no se pudo refrescar el registro de modelos: {e}")
+
+    def version_activa(self, sensor):
+        # Versión que usa el sensor, o None si no tiene modelos propios (usa el modelo base)
+        self._asegurar_refresco()
+        with self._cerrojo:
+            disponibles = self._versiones.get(sensor)
+            if not disponibles:
+                return None
+            activa = self._activos.get(sensor)
+            return activa if activa in disponibles else disponibles[-1]
+
+    def activar(self, redis, sensor, version):
+        # Activa una versión en todas las réplicas (cada una la usa a partir de su siguiente refresco)
+        self.refrescar()
+        with self._cerrojo:
+            disponibles = self._versiones.get(sensor, [])
+        if version not in disponibles:
+            raise ValueError(f"el sensor '{sensor}' no tiene la versión '{version}' "
+                             f"(disponibles: {', '.join(disponibles) or 'ninguna'})")
+        redis.hset(MODELOS_CLAVE_ACTIVOS, sensor, version)
+        with self._cerrojo:
+            self._activos[sensor] = version
+
+    # ---------------------------------------------------------------------------------------------
+    # Modelos cargados (LRU)
+    # ---------------------------------------------------------------------------------------------
+    def obtener(self, sensor):
+        # Modelo de la versión activa del sensor (cargándolo si hace falta), o None si no tiene modelos
+        # propios
+        version = self.version_activa(sensor)
+        if version is None:
+            return None
+        clave = (sensor, version)
+        with self._cerrojo:
+            modelo = self._cargados.get(clave)
+            if modelo is not None:
+                self._cargados.move_to_end(clave)
+                metricas.registro.contar("modelos_registro_total", resultado="acierto")
+                return modelo
+            cerrojo = self._cargando.setdefault(clave, threading.Lock())
+        with cerrojo:
+            with self._cerrojo:
+                modelo = self._cargados.get(clave)
+            if modelo is None:
+                modelo = self.cargar(os.path.join(self.directorio, sensor, version), sensor, version)
+                self._guardar(clave, modelo)
+                print(f"Modelo del sensor '{sensor}' versión '{version}' cargado ({modelo.tam / 1024:.0f} KB)")
+        with self._cerrojo:
+            self._cargando.pop(clave, None)
+        return modelo
+
+    def _guardar(self, clave, modelo):
+        with self._cerrojo:
+            self._cargados[clave] = modelo
+            self._bytes += modelo.tam
+            self.cargas += 1
+            metricas.registro.contar("modelos_registro_total", resultado="carga")
+            # El modelo recién cargado se queda aunque él solo supere el límite
+            while self._bytes > self.max_bytes and len(self._cargados) > 1:
+                _, expulsado = self._cargados.popitem(last=False)
+                self._bytes -= expulsado.tam
+                self.expulsiones += 1
+                metricas.registro.contar("modelos_registro_total", resultado="expulsion")
+
+    def estado(self):
+        with self._cerrojo:
+            return {
+                "directorio": self.directorio,
+                "versiones": dict(self._versiones),
+                "activas": dict(self._activos),
+                "cargados": [{"sensor": s, "version": v, "bytes": m.tam} for (s, v), m in self._cargados.items()],
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "cargas": self.cargas,
+                "expulsiones": self.expulsiones,
+            }
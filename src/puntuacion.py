@@ -0,0 +1,190 @@
+import io
+import os
+import sys
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import ingesta
+import consultas
+import agregados
+
+# ---------------------------------------------------------------------------------------------------
+# Puntuación por lotes de series históricas
+# ---------------------------------------------------------------------------------------------------
+# Evalúa todas las ventanas de un rango de la serie (o de un CSV como src_p1/datos.csv) sin pasar por
+# /detectar valor a valor: las muestras se leen por trozos, las ventanas son vistas de NumPy sobre el
+# trozo (más las últimas windows_size muestras del trozo anterior, para no perder las que cruzan de un
+# trozo a otro) y se predicen con llamadas grandes al modelo. Si se pide (escribir=1), el resultado de
+# cada ventana (1 anómala, 0 normal) se escribe con el timestamp de la muestra evaluada en la serie
+# derivada '{<serie>}:anomalias' cuando se puntúa la propia serie, y en '{<serie>}:anomalias:csv' cuando
+# se puntúa un CSV, para no mezclar en el histórico de anomalías del sensor timestamps que no están en él.
+#
+# La puntuación se hace dentro de la petición, así que su tamaño está acotado: como mucho
+# PUNTUACION_MAX_BYTES de CSV y PUNTUACION_MAX_MUESTRAS muestras de la serie (para más, la línea de
+# comandos, que no tiene límite).
+#
+# Se usa con la ruta /detectar/lote o desde la línea de comandos (desde la raíz del proyecto):
+#   python src/puntuacion.py --csv src/src_p1/datos.csv
+#   python src/puntuacion.py --redis-host localhost --sensor caldera-1 --desde 1700000000000
+
+# Muestras que se leen de Redis (o del CSV) en cada trozo
+PUNTUACION_TROZO = int(os.getenv('PUNTUACION_TROZO', 10000))
+# Ventanas por llamada al modelo
+PUNTUACION_LOTE = int(os.getenv('PUNTUACION_LOTE', 4096))
+# Anomalías que se devuelven en el resumen (el resto solo se cuentan)
+PUNTUACION_MAX_EJEMPLOS = int(os.getenv('PUNTUACION_MAX_EJEMPLOS', 100))
+# Tamaño máximo del CSV y número máximo de muestras de la serie que se puntúan en una petición
+PUNTUACION_MAX_BYTES = int(os.getenv('PUNTUACION_MAX_BYTES', 20 * 1024 * 1024))
+PUNTUACION_MAX_MUESTRAS = int(os.getenv('PUNTUACION_MAX_MUESTRAS', 500000))
+
+
+class LoteDemasiadoGrande(ValueError):
+    pass
+
+
+def clave_anomalias(clave):
+    return agregados.clave_derivada(clave, "anomalias")
+
+
+def clave_anomalias_csv(clave):
+    # Resultados de los CSV puntuados para la serie: sus timestamps no son los de la serie
+    return agregados.clave_derivada(clave, "anomalias:csv")
+
+
+def leer_csv(flujo, max_bytes=PUNTUACION_MAX_BYTES):
+    # Cuerpo de la petición como fichero, sin leer más de max_bytes
+    datos = flujo.read(max_bytes + 1)
+    if len(datos) > max_bytes:
+        raise LoteDemasiadoGrande(f"el CSV supera el máximo de {max_bytes} bytes (PUNTUACION_MAX_BYTES)")
+    return io.BytesIO(datos)
+
+
+def comprobar_rango(redis, clave, desde='-', hasta='+', max_muestras=PUNTUACION_MAX_MUESTRAS):
+    # Cuenta las muestras del rango con un único bucket de TS.RANGE ... AGGREGATION count
+    respuesta = redis.execute_command('TS.RANGE', clave, desde, hasta, 'AGGREGATION', 'count', ingesta.MAX_TIMESTAMP)
+    muestras = int(float(respuesta[0][1])) if respuesta else 0
+    if muestras > max_muestras:
+        raise LoteDemasiadoGrande(f"el rango tiene {muestras} muestras y el máximo es {max_muestras} "
+                                  f"(PUNTUACION_MAX_MUESTRAS): acota 'desde' y 'hasta'")
+    return muestras
+
+
+def trozos_redis(redis, clave, desde='-', hasta='+', contexto=0, tam_trozo=PUNTUACION_TROZO):
+    # Trozos (marcas, valores) de la serie en orden cronológico. Si el rango no empieza al principio de
+    # la serie se leen antes las 'contexto' muestras anteriores, para poder evaluar también las primeras
+    if contexto and desde != '-' and int(desde) > 0:
+        previas = redis.execute_command('TS.REVRANGE', clave, '-', int(desde) - 1, 'COUNT', contexto)
+        if previas:
+            pares = np.asarray(previas[::-1], dtype=np.float64)
+            yield pares[:, 0].astype(np.int64), pares[:, 1]
+    for trozo in consultas.leer_trozos(redis, clave, desde, hasta, "asc", tam_trozo=tam_trozo):
+        pares = np.asarray(trozo, dtype=np.float64)
+        yield pares[:, 0].astype(np.int64), pares[:, 1]
+
+
+def trozos_csv(fuente, tam_trozo=PUNTUACION_TROZO):
+    # Trozos (marcas, valores) de un CSV fecha,valor (ruta o fichero abierto)
+    import pandas as pd
+    for df in pd.read_csv(fuente, index_col=0, parse_dates=True, chunksize=tam_trozo):
+        marcas = df.index.values.astype('datetime64[ms]').astype(np.int64)
+        yield marcas, df.iloc[:, 0].to_numpy(dtype=np.float64)
+
+
+def predecir_ventanas(predecir, escalar, valores, windows_size, lote=PUNTUACION_LOTE):
+    # valores: windows_size muestras de contexto seguidas de las muestras a evaluar; devuelve la
+    # predicción de cada muestra evaluada a partir de las windows_size anteriores
+    escalados = np.asarray(escalar(valores), dtype=np.float32)
+    X = sliding_window_view(escalados[:-1], windows_size)[..., np.newaxis]
+    predicciones = np.empty(len(X))
+    for inicio in range(0, len(X), lote):
+        predicciones[inicio:inicio + lote] = np.asarray(predecir(X[inicio:inicio + lote])).reshape(-1)
+    return predicciones
+
+
+def puntuar(trozos, predecir, escalar, windows_size, umbral, lote=PUNTUACION_LOTE):
+    # Generador de (marcas, valores, predicciones, anómalas) por trozo
+    contexto_t = np.empty(0, dtype=np.int64)
+    contexto_v = np.empty(0, dtype=np.float64)
+    for marcas, valores in trozos:
+        marcas = np.concatenate([contexto_t, marcas])
+        valores = np.concatenate([contexto_v, valores])
+        if len(valores) > windows_size:
+            predicciones = predecir_ventanas(predecir, escalar, valores, windows_size, lote)
+            evaluados = valores[windows_size:]
+            yield marcas[windows_size:], evaluados, predicciones, np.abs(evaluados - predicciones) > umbral
+        contexto_t, contexto_v = marcas[-windows_size:], valores[-windows_size:]
+
+
+def escribir_anomalias(redis, destino, marcas, anomalas):
+    for argumentos in agregados.comandos_madd(destino, list(zip(marcas.tolist(), anomalas.astype(int).tolist()))):
+        redis.execute_command(*argumentos)
+
+
+def ejecutar(trozos, predecir, escalar, windows_size, umbral, redis=None, destino=None, lote=PUNTUACION_LOTE):
+    # Puntúa todos los trozos y, si se indica destino, escribe los resultados en esa serie.
+    # Devuelve el resumen con el rendimiento en ventanas por segundo
+    if redis is not None and destino:
+        # Al volver a puntuar un rango se sobrescriben los resultados anteriores
+        ingesta.asegurar_serie(redis, destino, ['tipo', 'anomalias'], politica_duplicados='LAST')
+
+    inicio = time.perf_counter()
+    ventanas = anomalias = 0
+    ejemplos = []
+    for marcas, valores, predicciones, anomalas in puntuar(trozos, predecir, escalar, windows_size, umbral, lote):
+        ventanas += len(marcas)
+        anomalias += int(anomalas.sum())
+        for i in np.flatnonzero(anomalas)[:PUNTUACION_MAX_EJEMPLOS - len(ejemplos)]:
+            ejemplos.append({"time": int(marcas[i]), "valor": float(valores[i]), "prediccion": float(predicciones[i])})
+        if redis is not None and destino:
+            escribir_anomalias(redis, destino, marcas, anomalas)
+    segundos = time.perf_counter() - inicio
+
+    return {
+        "ventanas": ventanas,
+        "anomalias": anomalias,
+        "umbral": umbral,
+        "destino": destino,
+        "segundos": segundos,
+        "ventanas_por_segundo": ventanas / segundos if segundos else 0.0,
+        "ejemplos": ejemplos,
+    }
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    import joblib
+    import inferencia
+    import ventanas as ventanas_modulo
+    import series
+
+    parser = argparse.ArgumentParser(description="Puntúa por lotes una serie histórica de Redis o un CSV")
+    parser.add_argument("--csv", help="CSV fecha,valor a puntuar (por defecto se lee la serie de Redis)")
+    parser.add_argument("--redis-host", default=os.getenv('REDIS_HOST'))
+    parser.add_argument("--sensor")
+    parser.add_argument("--desde", default='-')
+    parser.add_argument("--hasta", default='+')
+    parser.add_argument("--no-escribir", action="store_true", help="no escribe la serie de anomalías")
+    args = parser.parse_args()
+
+    model = inferencia.cargar_modelo('src/modelo.keras', 'src/modelo_pesos.npz')
+    escalar = ventanas_modulo.funcion_escalado(joblib.load('src/scaler.pkl'))
+    with open("src/config.json", "r") as f:
+        data = json.load(f)
+
+    redis = None
+    if args.redis_host:
+        from redis import Redis
+        redis = Redis(host=args.redis_host, db=0, socket_connect_timeout=2, decode_responses=True)
+    elif not args.csv:
+        sys.exit("ERROR: indica --csv o --redis-host")
+
+    clave = series.clave_serie(args.sensor)
+    trozos = trozos_csv(args.csv) if args.csv else trozos_redis(redis, clave, args.desde, args.hasta, data['windows_size'])
+    destino = None
+    if not args.no_escribir and redis is not None:
+        destino = clave_anomalias_csv(clave) if args.csv else clave_anomalias(clave)
+    # Mismo criterio que /detectar: anomalía si el error supera la cuarta parte del umbral
+    resumen = ejecutar(trozos, model.predict_on_batch, escalar, data['windows_size'], data['threshold'] / 4,
+                       redis, destino)
+    print(json.dumps({k: v for k, v in resumen.items() if k != "ejemplos"}, indent=2))
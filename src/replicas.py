@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+import itertools
+from redis import Redis, RedisError
+import conexiones
+import metricas
+
+# ---------------------------------------------------------------------------------------------------
+# Lecturas desde las réplicas en modo SENTINEL
+# ---------------------------------------------------------------------------------------------------
+# Las escrituras (TS.ADD, borrados, creación de series) siguen yendo al maestro, pero las consultas
+# (/listar, /agregar, /sensores...) se reparten por turnos entre las réplicas que conocen los centinelas.
+# /detectar lee la ventana en el maestro, en el mismo script atómico que añade la medición.
+#
+# Cada LECTURA_COMPROBACION_S segundos se piden las réplicas a los centinelas y su estado al maestro
+# (INFO replication). El retraso de una réplica son los bytes del flujo de replicación que le faltan:
+# master_repl_offset del maestro menos el 'offset' que la réplica confirmó en su último REPLCONF ACK.
+# El campo 'lag' son los segundos desde ese ACK, así que no dice cuántos datos faltan, solo lo antiguo
+# que es el 'offset' anterior. Reciben lecturas las réplicas 'online' con un retraso de como mucho
+# LECTURA_RETRASO_MAX_BYTES y un 'lag' de como mucho LECTURA_RETRASO_MAX_S. Si no queda ninguna, o la
+# lectura en la réplica falla, se lee del maestro.
+#
+# Las réplicas se conectan con clientes Redis propios (discover_slaves) en lugar de slave_for: así se
+# sabe a qué réplica va cada lectura para comprobar su retraso, repartir por turnos y descartar la que
+# falla. Cada cliente lleva los reintentos de conexiones.opciones() y su propio circuito, para que una
+# réplica caída no abra el del maestro.
+
+LECTURA_REPLICAS = os.getenv('LECTURA_REPLICAS', '1') == '1'
+# Retraso máximo de una réplica, en bytes del flujo de replicación que aún no ha confirmado
+LECTURA_RETRASO_MAX_BYTES = int(os.getenv('LECTURA_RETRASO_MAX_BYTES', 1048576))
+# Segundos máximos desde la última confirmación (REPLCONF ACK) de la réplica
+LECTURA_RETRASO_MAX_S = float(os.getenv('LECTURA_RETRASO_MAX_S', 2))
+# Cada cuánto se revisan las réplicas disponibles y su retraso
+LECTURA_COMPROBACION_S = float(os.getenv('LECTURA_COMPROBACION_S', 5))
+
+
+class LectorReplicas:
+    def __init__(self, sentinel, servicio, maestro, retraso_max_bytes=LECTURA_RETRASO_MAX_BYTES,
+                 retraso_max_s=LECTURA_RETRASO_MAX_S, comprobacion_s=LECTURA_COMPROBACION_S, **opciones_conexion):
+        self.sentinel = sentinel
+        self.servicio = servicio
+        self.maestro = maestro
+        self.retraso_max_bytes = retraso_max_bytes
+        self.retraso_max_s = retraso_max_s
+        self.comprobacion_s = comprobacion_s
+        # Las rutas esperan cadenas, como las que devuelve el maestro (decode_responses=True)
+        self.opciones_conexion = {"decode_responses": True, **conexiones.opciones(), **opciones_conexion}
+        self._clientes = {}
+        self._sanas = []
+        self._retrasos = {}
+        self._turno = itertools.count()
+        self._comprobado = None
+        self._cerrojo = threading.Lock()
+
+    def _comprobar(self):
+        ahora = time.monotonic()
+        if self._comprobado is not None and ahora - self._comprobado < self.comprobacion_s:
+            return
+        with self._cerrojo:
+            if self._comprobado is not None and ahora - self._comprobado < self.comprobacion_s:
+                return
+            self._comprobado = ahora
+            try:
+                direcciones = [(host, int(puerto)) for host, puerto in self.sentinel.discover_slaves(self.servicio)]
+                info = self.maestro.info('replication')
+            except RedisError as e:
+                print(f"ERROR: no se pudieron comprobar las réplicas, se lee del maestro: {e}")
+                self._sanas = []
+                return
+
+            # INFO replication del maestro: master_repl_offset y
+            # slaveN => {'ip', 'port', 'state', 'offset', 'lag'}
+            offset_maestro = int(info.get('master_repl_offset', 0))
+            retrasos = {}
+            for nombre, replica in info.items():
+                if nombre.startswith('slave') and isinstance(replica, dict) and replica.get('state') == 'online':
+                    retrasos[(replica['ip'], int(replica['port']))] = {
+                        "bytes": max(0, offset_maestro - int(replica.get('offset', 0))),
+                        "lag_s": int(replica.get('lag', 0)),
+                    }
+            self._retrasos = retrasos
+            sanas = [d for d in direcciones if d in retrasos and retrasos[d]["bytes"] <= self.retraso_max_bytes
+                     and retrasos[d]["lag_s"] <= self.retraso_max_s]
+            for direccion in sanas:
+                if direccion not in self._clientes:
+                    host, puerto = direccion
+                    cliente = conexiones.proteger(Redis(host=host, port=puerto, **self.opciones_conexion),
+                                                  conexiones.Circuito())
+                    self._clientes[direccion] = metricas.instrumentar_redis(cliente, f"REPLICA {host}:{puerto}")
+            self._sanas = sanas
+
+    def cliente(self):
+        # Réplica al día a la que le toca la lectura o, si no hay ninguna, el maestro
+        self._comprobar()
+        sanas = self._sanas
+        if not sanas:
+            return self.maestro
+        return self._clientes[sanas[next(self._turno) % len(sanas)]]
+
+    def _descartar(self, cliente):
+        # La réplica no vuelve a recibir lecturas hasta la siguiente comprobación
+        with self._cerrojo:
+            self._sanas = [d for d in self._sanas if self._clientes.get(d) is not cliente]
+
+    def leer(self, funcion):
+        # Ejecuta funcion(cliente) en una réplica y, si falla, la repite en el maestro
+        cliente = self.cliente()
+        if cliente is self.maestro:
+            metricas.registro.contar("redis_lecturas_total", destino="maestro")
+            return funcion(self.maestro)
+        try:
+            resultado = funcion(cliente)
+            metricas.registro.contar("redis_lecturas_total", destino="replica")
+            return resultado
+        except RedisError as e:
+            print(f"ERROR: lectura fallida en una réplica, se repite en el maestro: {e}")
+            self._descartar(cliente)
+            metricas.registro.contar("redis_lecturas_total", destino="maestro_tras_fallo")
+            return funcion(self.maestro)
+
+    def estado(self):
+        return {
+            "replicas": [f"{host}:{puerto}" for host, puerto in self._sanas],
+            "retrasos": {f"{host}:{puerto}": retraso for (host, puerto), retraso in self._retrasos.items()},
+            "retraso_max_bytes": self.retraso_max_bytes,
+            "retraso_max_s": self.retraso_max_s,
+        }
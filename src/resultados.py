@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+
+# ---------------------------------------------------------------------------------------------------
+# Registro de resultados de /detectar
+# ---------------------------------------------------------------------------------------------------
+# Cada detección se guarda en un buffer circular en memoria con los últimos RESULTADOS_MAX resultados,
+# que se consulta con /detectar/resultados. Opcionalmente (RESULTADOS_DESTINO) se guardan también de
+# forma persistente: un hilo en segundo plano los recoge de una cola y los escribe por lotes, así la
+# petición nunca espera a la escritura en disco ni a Redis.
+#   - jsonl:  se añaden al fichero RESULTADOS_FICHERO, un resultado JSON por línea
+#   - stream: se añaden al stream de Redis RESULTADOS_STREAM con XADD (acotado a RESULTADOS_STREAM_MAXLEN)
+
+# Número de resultados que se guardan en memoria
+RESULTADOS_MAX = int(os.getenv('RESULTADOS_MAX', 1000))
+# Destino persistente: '' (solo memoria), 'jsonl' o 'stream'
+RESULTADOS_DESTINO = os.getenv('RESULTADOS_DESTINO', '')
+RESULTADOS_FICHERO = os.getenv('RESULTADOS_FICHERO', 'src/resultados.jsonl')
+RESULTADOS_STREAM = os.getenv('RESULTADOS_STREAM', 'detecciones')
+RESULTADOS_STREAM_MAXLEN = int(os.getenv('RESULTADOS_STREAM_MAXLEN', 100000))
+# Tamaño máximo de cada lote de escritura y espera máxima para completarlo
+RESULTADOS_LOTE = int(os.getenv('RESULTADOS_LOTE', 100))
+RESULTADOS_ESPERA_S = float(os.getenv('RESULTADOS_ESPERA_S', 1))
+# Resultados pendientes de escribir; si el destino no da abasto se descartan en lugar de bloquear
+RESULTADOS_COLA_MAX = int(os.getenv('RESULTADOS_COLA_MAX', 10000))
+
+DESTINOS = ('', 'jsonl', 'stream')
+
+
+class RegistroResultados:
+    def __init__(self, redis=None, destino=RESULTADOS_DESTINO, max_resultados=RESULTADOS_MAX):
+        if destino not in DESTINOS:
+            print(f"ERROR: RESULTADOS_DESTINO '{destino}' no reconocido, los resultados solo se guardan en memoria")
+            destino = ''
+        self.redis = redis
+        self.destino = destino
+        self._ultimos = deque(maxlen=max_resultados)
+        self._cerrojo = threading.Lock()
+        self._cola = queue.Queue(maxsize=RESULTADOS_COLA_MAX)
+        self._hilo = None
+        self._pid = None
+        self.escritos = 0
+        self.descartados = 0
+        self.errores = 0
+
+    def registrar(self, resultado):
+        with self._cerrojo:
+            self._ultimos.append(resultado)
+        if not self.destino:
+            return
+        self._asegurar_hilo()
+        try:
+            self._cola.put_nowait(resultado)
+        except queue.Full:
+            with self._cerrojo:
+                self.descartados += 1
+
+    def ultimos(self, limite=None, sensor=None):
+        # Resultados más recientes primero, opcionalmente solo los de un sensor
+        with self._cerrojo:
+            resultados = list(self._ultimos)
+        resultados.reverse()
+        if sensor is not None:
+            resultados = [r for r in resultados if r.get("sensor") == sensor]
+        return resultados[:limite] if limite else resultados
+
+    def estadisticas(self):
+        with self._cerrojo:
+            return {
+                "destino": self.destino or "memoria",
+                "en_memoria": len(self._ultimos),
+                "pendientes": self._cola.qsize(),
+                "escritos": self.escritos,
+                "descartados": self.descartados,
+                "errores": self.errores,
+            }
+
+    def _asegurar_hilo(self):
+        # Igual que en el planificador de inferencia: el hilo se arranca con el primer resultado y se
+        # vuelve a arrancar si el proceso se ha bifurcado
+        if self._pid == os.getpid() and self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._cerrojo:
+            if self._pid != os.getpid() or self._hilo is None or not self._hilo.is_alive():
+                if self._pid != os.getpid():
+                    self._cola = queue.Queue(maxsize=RESULTADOS_COLA_MAX)
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name="registro-resultados", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self):
+        cola = self._cola
+        while True:
+            lote = [cola.get()]
+            limite = time.monotonic() + RESULTADOS_ESPERA_S
+            while len(lote) < RESULTADOS_LOTE:
+                restante = limite - time.monotonic()
+                try:
+                    lote.append(cola.get(timeout=restante) if restante > 0 else cola.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._escribir(lote)
+                with self._cerrojo:
+                    self.escritos += len(lote)
+            except Exception as e:
+                print(f"ERROR: no se pudieron guardar {len(lote)} resultados en '{self.destino}': {e}")
+                with self._cerrojo:
+                    self.errores += len(lote)
+
+    def _escribir(self, lote):
+        if self.destino == 'jsonl':
+            with open(RESULTADOS_FICHERO, "a") as f:
+                f.write("".join(json.dumps(r) + "\n" for r in lote))
+        else:
+            # El cliente se puede asignar después (main-ej3.py conecta con Redis en segundo plano)
+            if self.redis is None:
+                raise RuntimeError("el destino 'stream' necesita un cliente de Redis")
+            pipe = self.redis.pipeline(transaction=False)
+            for r in lote:
+                pipe.xadd(RESULTADOS_STREAM, {"resultado": json.dumps(r)},
+                          maxlen=RESULTADOS_STREAM_MAXLEN, approximate=True)
+            pipe.execute()
@@ -0,0 +1,62 @@
+import os
+from flask import request
+
+# ---------------------------------------------------------------------------------------------------
+# Réplicas por rol
+# ---------------------------------------------------------------------------------------------------
+# Con ROL cada réplica de main-ej2.py / main-ej3.py atiende solo una parte de la API, así se puede escalar
+# cada parte por separado (muchas réplicas de ingesta ligeras y pocas con el modelo):
+#   ingesta:   /nuevo, /nuevo_lote y /borrar
+#   consulta:  /listar, /exportar, /agregar, /sensores y /sensores/mediciones
+#   deteccion: /detectar, /detectar/lote, /detectar/resultados, /inferencia/estadisticas y /modelos
+#   todo:      todas las rutas (por defecto)
+# Las réplicas de ingesta y consulta no importan joblib/scikit-learn ni cargan el escalador y el modelo,
+# así que arrancan antes, ocupan menos memoria y su imagen no necesita el stack de ML (Dockerfile-ingesta
+# y Dockerfile-consulta). Las sondas (/healthz, /readyz), /metrics, /debug/perfil y / están en todos los
+# roles; el resto de rutas responden 404 en las réplicas de otro rol.
+#
+# Se admiten también los nombres en inglés (ROLE=ingest|query|detect|all).
+
+ROLES = ("ingesta", "consulta", "deteccion", "todo")
+ALIAS = {"ingest": "ingesta", "query": "consulta", "detect": "deteccion", "all": "todo"}
+
+RUTAS = {
+    "ingesta": {"nueva_medicion", "nuevo_lote", "borrar_mediciones"},
+    "consulta": {"listar", "exportar_mediciones", "agregar", "listar_sensores", "mediciones_sensores"},
+    "deteccion": {"detectar_dato_anomalia", "detectar_lote", "resultados_deteccion", "estadisticas_inferencia",
+                  "estado_modelos", "activar_modelo"},
+}
+RUTAS_COMUNES = {"vivo", "preparado", "metricas_prometheus", "perfil", "bienvenido_instrucciones", "static"}
+
+ROL = os.getenv('ROL', os.getenv('ROLE', 'todo')).lower()
+ROL = ALIAS.get(ROL, ROL)
+if ROL not in ROLES:
+    print(f"ERROR: ROL '{ROL}' no reconocido (debe ser uno de {', '.join(ROLES)}), se atienden todas las rutas")
+    ROL = "todo"
+
+
+def con_modelo(rol=ROL):
+    # Solo las réplicas que detectan cargan el escalador y el modelo
+    return rol in ("deteccion", "todo")
+
+
+def atiende(endpoint, rol=ROL):
+    return rol == "todo" or endpoint in RUTAS_COMUNES or endpoint in RUTAS[rol]
+
+
+def rechazo(endpoint, rol=ROL):
+    # Respuesta 404 para las rutas de otro rol, o None si la réplica la atiende
+    if endpoint is not None and not atiende(endpoint, rol):
+        return f"ERROR: esta réplica solo atiende las rutas del rol '{rol}'", 404
+    return None
+
+
+def instalar(app, rol=ROL):
+    # Las rutas de otro rol responden 404 antes de llegar a su función (main-ej3-async.py hace lo mismo
+    # con rechazo en su before_request de Quart)
+    if rol == "todo":
+        return
+
+    @app.before_request
+    def comprobar_rol():
+        return rechazo(request.endpoint, rol)
@@ -0,0 +1,153 @@
+import re
+import threading
+from redis.cluster import RedisCluster
+import ingesta
+import agregados
+import comandos
+
+# ---------------------------------------------------------------------------------------------------
+# Series por sensor
+# ---------------------------------------------------------------------------------------------------
+# Cada sensor tiene su propia serie 'mediciones:{<sensor>}'. Las llaves son un hash tag: en modo CLUSTER
+# el slot de la serie depende solo del identificador del sensor, así que los sensores se reparten entre
+# todos los maestros (y sus series compactadas caen en el mismo slot que la original). Las peticiones
+# sin parámetro 'sensor' siguen usando la serie 'mediciones' de siempre.
+#
+# Todas las series se crean con las etiquetas tipo=mediciones y sensor=<sensor>, que permiten consultar
+# varios sensores a la vez con TS.MGET y TS.MRANGE ... FILTER tipo=mediciones.
+
+CLAVE_POR_DEFECTO = 'mediciones'
+SENSOR_POR_DEFECTO = 'principal'
+PATRON_SENSOR = re.compile(r"^[A-Za-z0-9_.\-]{1,64}$")
+
+# Series ya creadas (con etiquetas y compactaciones) por este proceso, para no comprobarlo en cada escritura
+_aseguradas = set()
+_cerrojo = threading.Lock()
+
+
+class ParametroInvalido(ValueError):
+    pass
+
+
+def clave_serie(sensor=None):
+    if not sensor:
+        return CLAVE_POR_DEFECTO
+    if not PATRON_SENSOR.match(sensor):
+        raise ParametroInvalido("'sensor' solo puede contener letras, números, '.', '_' o '-' (máximo 64)")
+    return f"{CLAVE_POR_DEFECTO}:{{{sensor}}}"
+
+
+def etiquetas(sensor=None):
+    return ['tipo', 'mediciones', 'sensor', sensor or SENSOR_POR_DEFECTO]
+
+
+def pasos_asegurar_sensor(sensor=None):
+    # Crea la serie del sensor con sus etiquetas y sus compactaciones la primera vez que se usa
+    clave = clave_serie(sensor)
+    if clave in _aseguradas:
+        return clave
+    yield from ingesta.pasos_asegurar_serie(clave, etiquetas(sensor))
+    yield from agregados.pasos_asegurar_compactaciones(clave)
+    # Las series creadas antes de cambiar RETENCION_MS o RETENCION_COMPACTADAS pasan a la nueva retención
+    for argumentos in agregados.comandos_retencion(clave):
+        yield argumentos
+    with _cerrojo:
+        _aseguradas.add(clave)
+    return clave
+
+
+def asegurar_sensor(redis, sensor=None):
+    return comandos.ejecutar(redis, pasos_asegurar_sensor(sensor))
+
+
+def pasos_preparar_serie_principal():
+    # La serie 'mediciones' puede venir de versiones anteriores sin etiquetas: se las añadimos
+    yield from pasos_asegurar_sensor()
+    yield ['TS.ALTER', CLAVE_POR_DEFECTO, 'LABELS', *etiquetas()]
+
+
+def preparar_serie_principal(redis):
+    comandos.ejecutar(redis, pasos_preparar_serie_principal())
+
+
+def olvidar(clave):
+    # La serie se ha borrado: la próxima escritura debe volver a crearla
+    with _cerrojo:
+        _aseguradas.discard(clave)
+
+
+def pasos_recrear(sensor=None):
+    # Tras borrar la serie entera se vuelve a crear vacía con sus etiquetas, su retención y sus
+    # compactaciones: _aseguradas es de cada proceso y el resto de workers la siguen dando por creada, así
+    # que su siguiente TS.ADD la crearía sin etiquetas ni reglas (y TS.MADD fallaría). Si otro worker
+    # escribe entre el borrado y la creación, TS.ADD la habrá creado sin etiquetas: se ponen con TS.ALTER
+    clave = clave_serie(sensor)
+    olvidar(clave)
+    yield from pasos_asegurar_sensor(sensor)
+    yield ['TS.ALTER', clave, 'LABELS', *etiquetas(sensor)]
+    return clave
+
+
+def recrear(redis, sensor=None):
+    return comandos.ejecutar(redis, pasos_recrear(sensor))
+
+
+def en_todos_los_maestros(redis, *argumentos):
+    # TS.MGET y TS.MRANGE solo consultan el nodo que los recibe: en modo CLUSTER se envían a todos los
+    # maestros y se juntan las respuestas
+    if isinstance(redis, RedisCluster):
+        respuestas = redis.execute_command(*argumentos, target_nodes=RedisCluster.PRIMARIES)
+        if isinstance(respuestas, dict):
+            return [elemento for respuesta in respuestas.values() for elemento in _como_lista(respuesta)]
+        return _como_lista(respuestas)
+    return _como_lista(redis.execute_command(*argumentos))
+
+
+def _como_lista(respuesta):
+    # RESP2 devuelve [[clave, etiquetas, datos], ...] y RESP3 un diccionario por clave: {clave: [etiquetas,
+    # datos]} en TS.MGET y {clave: [etiquetas, metadatos, datos]} en TS.MRANGE (los metadatos describen la
+    # agregación). Las etiquetas van siempre primero y los datos al final
+    if isinstance(respuesta, dict):
+        return [[clave, resto[0], resto[-1]] for clave, resto in respuesta.items()]
+    return list(respuesta or [])
+
+
+def _etiquetas_a_dict(etiquetas_redis):
+    if isinstance(etiquetas_redis, dict):
+        return etiquetas_redis
+    return {nombre: valor for nombre, valor in etiquetas_redis}
+
+
+def _filtro(sensores):
+    filtro = ['FILTER', 'tipo=mediciones']
+    if sensores:
+        for sensor in sensores:
+            clave_serie(sensor)
+        filtro.append(f"sensor=({','.join(sensores)})")
+    return filtro
+
+
+def ultimos_valores(redis, sensores=None):
+    # Última medición de cada sensor con TS.MGET
+    respuesta = en_todos_los_maestros(redis, 'TS.MGET', 'WITHLABELS', *_filtro(sensores))
+    resultado = []
+    for clave, etiquetas_redis, muestra in respuesta:
+        sensor = _etiquetas_a_dict(etiquetas_redis).get('sensor')
+        t, v = (int(muestra[0]), float(muestra[1])) if muestra else (None, None)
+        resultado.append({"sensor": sensor, "clave": clave, "time": t, "valor": v})
+    return sorted(resultado, key=lambda r: r["sensor"] or "")
+
+
+def rango_sensores(redis, desde='-', hasta='+', sensores=None, limite=None, funcion=None, bucket_ms=None):
+    # Mediciones de varios sensores con TS.MRANGE (opcionalmente agregadas por bucket)
+    argumentos = ['TS.MRANGE', desde, hasta]
+    if limite:
+        argumentos += ['COUNT', limite]
+    if funcion:
+        argumentos += ['AGGREGATION', funcion, bucket_ms]
+    argumentos += ['WITHLABELS', *_filtro(sensores)]
+    resultado = {}
+    for clave, etiquetas_redis, muestras in en_todos_los_maestros(redis, *argumentos):
+        sensor = _etiquetas_a_dict(etiquetas_redis).get('sensor', clave)
+        resultado[sensor] = [(int(t), float(v)) for t, v in muestras]
+    return resultado
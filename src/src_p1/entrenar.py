@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ------------------------------------------------------------------------------
+# ENTRENAMIENTO SIN INTERFAZ (UNO O VARIOS SENSORES)
+# ------------------------------------------------------------------------------
+# Versión por línea de comandos de main-p1-nba.py pensada para ficheros grandes:
+#   - Las ventanas son vistas de NumPy sobre la serie (sliding_window_view), sin
+#     copiar cada ventana en una lista de Python.
+#   - Los datos llegan al modelo por lotes con tf.data a partir de un generador, así
+#     solo se copia en memoria el lote que se está entrenando.
+#   - Con varios sensores se entrena un modelo por sensor en paralelo en un pool de
+#     procesos (cada proceso carga su propio TensorFlow).
+#   - Las gráficas se guardan en PNG en lugar de mostrarse con plt.show().
+#
+# Se ejecuta desde la raíz del proyecto:
+#   python src/src_p1/entrenar.py                              # datos.csv => src/
+#   python src/src_p1/entrenar.py --csv sensores.csv --columna-sensor sensor --procesos 4
+#
+# El CSV puede tener una columna de valores por sensor (formato ancho) o una columna
+# con el identificador del sensor (--columna-sensor) y otra con el valor (formato
+# largo). Con un solo sensor los ficheros se guardan donde los usan los servicios
+# (src/modelo.keras, src/scaler.pkl, src/config.json, src/modelo_pesos.npz y los
+# modelos TFLite src/modelo_float16.tflite y src/modelo_int8.tflite); con
+# varios, o con --version, en <salida>/modelos/<sensor>/<version>/, donde los
+# carga el registro de modelos de los servicios (src/modelos.py) sin reiniciarlos.
+# La versión por defecto es la fecha y hora del entrenamiento (AAAAMMDDHHMMSS), así
+# la más reciente es la última en orden alfabético.
+
+RUTA_DATOS = "src/src_p1/datos.csv"
+RUTA_SALIDA = "src"
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def crear_ventanas(data, data_scaled, windows_size):
+	# X[i] = data_scaled[i:i+windows_size] y y[i] = data[i+windows_size], igual que
+	# split_sequence, pero X es una vista sobre data_scaled (no copia los datos)
+	data = np.asarray(data, dtype=np.float64).reshape(-1, 1)
+	data_scaled = np.asarray(data_scaled, dtype=np.float64).reshape(-1)
+	X = sliding_window_view(data_scaled[:-1], windows_size)[..., np.newaxis]
+	y = data[windows_size:]
+	return X, y
+
+
+def generador_lotes(X, y, indices, batch_size, barajar):
+	# Devuelve una función generadora para tf.data: cada lote se copia de las vistas
+	# al pedirlo; si barajar, el orden cambia en cada época
+	def generar():
+		orden = np.random.permutation(indices) if barajar else indices
+		for inicio in range(0, len(orden), batch_size):
+			lote = np.sort(orden[inicio:inicio + batch_size])
+			yield X[lote].astype(np.float32), y[lote].astype(np.float32)
+	return generar
+
+
+def crear_dataset(X, y, indices, batch_size, barajar=False):
+	import tensorflow as tf
+	windows_size = X.shape[1]
+	firma = (
+		tf.TensorSpec(shape=(None, windows_size, 1), dtype=tf.float32),
+		tf.TensorSpec(shape=(None, 1), dtype=tf.float32),
+	)
+	dataset = tf.data.Dataset.from_generator(generador_lotes(X, y, indices, batch_size, barajar), output_signature=firma)
+	return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def leer_sensores(ruta_csv, columna_sensor=None, columna_valor=None):
+	# Devuelve {sensor: DataFrame de una columna ordenado por fecha}
+	import pandas as pd
+	df = pd.read_csv(ruta_csv, index_col=0, parse_dates=True)
+	if columna_sensor:
+		columna_valor = columna_valor or next(c for c in df.columns if c != columna_sensor)
+		return {
+			str(sensor): grupo[[columna_valor]].sort_index()
+			for sensor, grupo in df.groupby(columna_sensor)
+		}
+	return {str(columna): df[[columna]].dropna().sort_index() for columna in df.columns}
+
+
+def guardar_grafica(fechas, y_inv, y_pred_inv, anomalies, ruta):
+	import matplotlib
+	matplotlib.use("Agg")
+	import matplotlib.pyplot as plt
+	plt.figure(figsize=(12,5))
+	plt.plot(fechas, y_inv, color='blue', label='Valor real-y_test')
+	plt.plot(fechas, y_pred_inv, color='orange', linestyle='dotted',label='Predicción-y_pred')
+	plt.scatter(fechas[anomalies], y_inv[anomalies], color='red', label='Anomalías')
+	plt.legend()
+	plt.title("Detección de anomalías con LSTM")
+	plt.savefig(ruta)
+	plt.close()
+
+
+def entrenar_sensor(sensor, df, directorio, windows_size=10, epochs=20, batch_size=32,
+		validation_split=0.1, hilos=None, graficas=False):
+	# Entrena el modelo de un sensor y guarda modelo, escalador, config y pesos en directorio
+	import tensorflow as tf
+	if hilos:
+		tf.config.threading.set_intra_op_parallelism_threads(hilos)
+		tf.config.threading.set_inter_op_parallelism_threads(hilos)
+	from keras.models import Sequential
+	from keras.layers import LSTM, Dense, Input
+	from sklearn.preprocessing import MinMaxScaler
+	import joblib
+	from exportar_pesos import exportar_pesos
+	from exportar_tflite import exportar_tflite
+
+	data = df.values.astype(np.float64)
+	if len(data) <= windows_size + 1:
+		raise ValueError(f"el sensor '{sensor}' solo tiene {len(data)} muestras")
+	scaler = MinMaxScaler()
+	data_scaled = scaler.fit_transform(data)
+	X, y = crear_ventanas(data, data_scaled, windows_size)
+
+	# Como validation_split de Keras: la validación es el último tramo de la serie
+	n_validacion = int(len(X) * validation_split)
+	indices = np.arange(len(X))
+	entrenamiento = crear_dataset(X, y, indices[:len(X) - n_validacion], batch_size, barajar=True)
+	validacion = crear_dataset(X, y, indices[len(X) - n_validacion:], batch_size) if n_validacion else None
+
+	model = Sequential()
+	model.add(Input(shape=(windows_size, 1)))
+	model.add(LSTM(50, activation='relu'))
+	model.add(Dense(1))
+	model.compile(optimizer='adam', loss='mse')
+	model.fit(entrenamiento, validation_data=validacion, epochs=epochs, verbose=2)
+
+	# Umbral: percentil 99 del error absoluto, prediciendo también por lotes
+	y_pred = model.predict(crear_dataset(X, y, indices, 1024).map(lambda x, _: x), verbose=0)
+	y_pred_inv = scaler.inverse_transform(y_pred)
+	y_inv = scaler.inverse_transform(y)
+	mae = np.mean(np.abs(y_pred_inv - y_inv), axis=1)
+	threshold = float(np.percentile(mae, 99))
+	anomalies = mae > threshold
+
+	os.makedirs(directorio, exist_ok=True)
+	model.save(os.path.join(directorio, "modelo.keras"))
+	joblib.dump(scaler, os.path.join(directorio, "scaler.pkl"))
+	with open(os.path.join(directorio, "config.json"), "w") as f:
+		json.dump({"threshold": threshold, "windows_size": windows_size}, f)
+	exportar_pesos(model, os.path.join(directorio, "modelo_pesos.npz"))
+	exportar_tflite(model, os.path.join(directorio, "modelo.keras"))
+	if graficas:
+		guardar_grafica(df.index[windows_size:], y_inv, y_pred_inv, anomalies, os.path.join(directorio, "anomalias.png"))
+
+	print(f"[{sensor}] {len(X)} ventanas, umbral {threshold:.3f}, {int(np.sum(anomalies))} anomalías => {directorio}")
+	return {"sensor": sensor, "ventanas": len(X), "threshold": threshold, "anomalias": int(np.sum(anomalies)), "directorio": directorio}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Entrena el modelo LSTM de detección de anomalías (uno por sensor)")
+	parser.add_argument("--csv", default=RUTA_DATOS)
+	parser.add_argument("--columna-sensor", help="columna con el identificador del sensor (formato largo)")
+	parser.add_argument("--columna-valor", help="columna con el valor (formato largo)")
+	parser.add_argument("--sensores", help="lista de sensores a entrenar separados por comas (por defecto todos)")
+	parser.add_argument("--salida", default=RUTA_SALIDA)
+	parser.add_argument("--ventana", type=int, default=10)
+	parser.add_argument("--epocas", type=int, default=20)
+	parser.add_argument("--lote", type=int, default=32)
+	parser.add_argument("--validacion", type=float, default=0.1)
+	parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--graficas", action="store_true", help="guarda anomalias.png junto al modelo")
+	parser.add_argument("--version", help="versión de los modelos (por defecto la fecha y hora actual)")
+	args = parser.parse_args()
+
+	sensores = leer_sensores(args.csv, args.columna_sensor, args.columna_valor)
+	if args.sensores:
+		sensores = {s: sensores[s] for s in args.sensores.split(",")}
+
+	from datetime import datetime
+	version = args.version or datetime.now().strftime("%Y%m%d%H%M%S")
+
+	def directorio(sensor):
+		if len(sensores) == 1 and not args.version:
+			return args.salida
+		return os.path.join(args.salida, "modelos", sensor, version)
+
+	opciones = dict(windows_size=args.ventana, epochs=args.epocas, batch_size=args.lote,
+		validation_split=args.validacion, graficas=args.graficas)
+	procesos = max(1, min(args.procesos, len(sensores)))
+	if procesos == 1:
+		resultados = [entrenar_sensor(s, df, directorio(s), **opciones) for s, df in sensores.items()]
+	else:
+		# TensorFlow no admite fork: los procesos se crean con spawn y se reparten los núcleos
+		import multiprocessing
+		from concurrent.futures import ProcessPoolExecutor
+		hilos = max(1, (os.cpu_count() or 1) // procesos)
+		with ProcessPoolExecutor(procesos, mp_context=multiprocessing.get_context("spawn")) as pool:
+			futuros = [pool.submit(entrenar_sensor, s, df, directorio(s), hilos=hilos, **opciones) for s, df in sensores.items()]
+			resultados = [f.result() for f in futuros]
+
+	if len(sensores) > 1:
+		with open(os.path.join(args.salida, "modelos", f"resumen-{version}.json"), "w") as f:
+			json.dump(resultados, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
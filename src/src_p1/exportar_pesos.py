@@ -0,0 +1,75 @@
+import os
+import sys
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# EXPORTACIÓN DE LOS PESOS DEL MODELO PARA EL MOTOR NUMPY
+# ------------------------------------------------------------------------------
+# Guarda los pesos de la LSTM y la capa densa de modelo.keras en un fichero .npz
+# que el motor de inferencia de NumPy (src/inferencia.py) puede cargar sin TensorFlow.
+# Se ejecuta desde la raíz del proyecto:
+#   python src/src_p1/exportar_pesos.py [--verificar]
+# Con --verificar compara las predicciones de ambos motores sobre datos.csv y
+# termina con error si la diferencia supera la tolerancia.
+
+RUTA_MODELO = "src/modelo.keras"
+RUTA_PESOS = "src/modelo_pesos.npz"
+RUTA_SCALER = "src/scaler.pkl"
+RUTA_CONFIG = "src/config.json"
+RUTA_DATOS = "src/src_p1/datos.csv"
+
+# Diferencia máxima admitida entre Keras y NumPy en la salida del modelo, que está escalada con
+# scaler.pkl (en las unidades originales equivale a TOLERANCIA por el rango de los datos de entrenamiento)
+TOLERANCIA = 1e-3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def exportar_pesos(model, ruta_pesos=RUTA_PESOS):
+	from keras.layers import LSTM, Dense
+	lstm = next(capa for capa in model.layers if isinstance(capa, LSTM))
+	densa = next(capa for capa in model.layers if isinstance(capa, Dense))
+	kernel, recurrent_kernel, bias = lstm.get_weights()
+	dense_kernel, dense_bias = densa.get_weights()
+	np.savez(
+		ruta_pesos,
+		kernel=kernel,
+		recurrent_kernel=recurrent_kernel,
+		bias=bias,
+		dense_kernel=dense_kernel,
+		dense_bias=dense_bias,
+		activation=np.array(lstm.activation.__name__),
+		recurrent_activation=np.array(lstm.recurrent_activation.__name__),
+	)
+	print(f"Pesos exportados en {ruta_pesos}")
+
+
+def verificar_paridad(model, ruta_pesos=RUTA_PESOS, n_ventanas=2000):
+	# Compara model.predict con el motor NumPy sobre ventanas reales de datos.csv
+	import json
+	import joblib
+	import pandas as pd
+	from numpy.lib.stride_tricks import sliding_window_view
+	from inferencia import ModeloNumpy
+
+	with open(RUTA_CONFIG, "r") as f:
+		windows_size = json.load(f)["windows_size"]
+	scaler = joblib.load(RUTA_SCALER)
+	df = pd.read_csv(RUTA_DATOS, index_col=0, parse_dates=True)
+	datos_escalados = scaler.transform(df.values).ravel()
+	X = sliding_window_view(datos_escalados, windows_size)[:n_ventanas].reshape(-1, windows_size, 1)
+
+	y_keras = model.predict(X, verbose=0)
+	y_numpy = ModeloNumpy(ruta_pesos).predict_on_batch(X)
+	diferencia = float(np.max(np.abs(y_keras - y_numpy)))
+	print(f"Diferencia máxima Keras vs NumPy sobre {len(X)} ventanas: {diferencia:.2e}")
+	return diferencia
+
+
+if __name__ == "__main__":
+	from keras.models import load_model
+	model = load_model(RUTA_MODELO)
+	exportar_pesos(model)
+	if "--verificar" in sys.argv and verificar_paridad(model) > TOLERANCIA:
+		print(f"ERROR: la diferencia supera la tolerancia {TOLERANCIA}")
+		sys.exit(1)
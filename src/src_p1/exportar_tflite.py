@@ -0,0 +1,55 @@
+import os
+import sys
+
+# ------------------------------------------------------------------------------
+# EXPORTACIÓN DEL MODELO A TFLITE
+# ------------------------------------------------------------------------------
+# Convierte modelo.keras a TFLite en dos variantes que el motor TFLite de
+# src/inferencia.py carga con MODELO_BACKEND=tflite-float16|tflite-int8:
+#   src/modelo_float16.tflite: pesos en float16
+#   src/modelo_int8.tflite:    cuantización de rango dinámico (pesos en int8)
+# Se ejecuta desde la raíz del proyecto:
+#   python src/src_p1/exportar_tflite.py
+# La LSTM se convierte desenrollada (unroll=True, los mismos pesos): con el bucle
+# de Keras el convertidor necesitaría operaciones de TensorFlow (Select TF ops) o
+# un tamaño de lote fijo; desenrollada solo usa operaciones básicas de TFLite y el
+# intérprete admite cualquier tamaño de lote.
+
+RUTA_MODELO = "src/modelo.keras"
+VARIANTES = ("float16", "int8")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def desenrollar(model):
+	# Copia de model con la LSTM desenrollada
+	from keras.models import Sequential
+	from keras.layers import LSTM, Dense, Input
+	lstm = next(capa for capa in model.layers if isinstance(capa, LSTM))
+	densa = next(capa for capa in model.layers if isinstance(capa, Dense))
+	copia = Sequential()
+	copia.add(Input(shape=model.input_shape[1:]))
+	copia.add(LSTM(lstm.units, activation=lstm.activation, recurrent_activation=lstm.recurrent_activation, unroll=True))
+	copia.add(Dense(densa.units))
+	copia.set_weights(model.get_weights())
+	return copia
+
+
+def exportar_tflite(model, ruta_modelo=RUTA_MODELO, variantes=VARIANTES):
+	import tensorflow as tf
+	from inferencia import ruta_tflite
+	copia = desenrollar(model)
+	for variante in variantes:
+		convertidor = tf.lite.TFLiteConverter.from_keras_model(copia)
+		convertidor.optimizations = [tf.lite.Optimize.DEFAULT]
+		if variante == "float16":
+			convertidor.target_spec.supported_types = [tf.float16]
+		ruta = ruta_tflite(ruta_modelo, variante)
+		with open(ruta, "wb") as f:
+			f.write(convertidor.convert())
+		print(f"Modelo TFLite ({variante}) exportado en {ruta}")
+
+
+if __name__ == "__main__":
+	from keras.models import load_model
+	exportar_tflite(load_model(RUTA_MODELO))
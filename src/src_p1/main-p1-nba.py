@@ -7,6 +7,9 @@ from keras.layers import LSTM, Dense, Input
 from sklearn.preprocessing import MinMaxScaler
 import joblib
 import json
+from exportar_pesos import exportar_pesos
+from exportar_tflite import exportar_tflite
+from entrenar import crear_ventanas
 
 # ------------------------------------------------------------------------------
 # CARGA DE DATOS
@@ -40,18 +43,9 @@ n_features = 1
 # pasando la ventana actual que tenemos.
 
 def split_sequence(data, data_scaled, windows_size):
-	X, y = list(), list()
-	for i in range(len(data)):
-		# find the end of this pattern
-		end_ix = i + windows_size
-		# check if we are beyond the sequence
-		if end_ix > len(data)-1:
-			break
-		# gather input and output parts of the pattern
-		data_x, data_y = data_scaled[i:end_ix], data[end_ix]  # Lo que se predice (y) es el "siguiente" valor de la secuencia
-		X.append(data_x)
-		y.append(data_y)
-	return np.array(X),np. array(y)
+	# Las ventanas son vistas sobre data_scaled (sliding_window_view): sin bucle de Python
+	# ni copias de cada ventana. Ver entrenar.py para entrenar sin interfaz y por sensores
+	return crear_ventanas(data, data_scaled, windows_size)
 
 
 X, y = split_sequence(data, data_scaled, windows_size)
@@ -139,4 +133,8 @@ plt.show()
 # Guardamos el modelo
 model.save('src/modelo.keras')
 # Guardamos el escalador
-joblib.dump(scaler, 'src/scaler.pkl')
\ No newline at end of file
+joblib.dump(scaler, 'src/scaler.pkl')
+# Exportamos los pesos para el motor de inferencia de NumPy (servicios sin TensorFlow)
+exportar_pesos(model)
+# Exportamos el modelo a TFLite (float16 e int8) para el motor TFLite de los servicios
+exportar_tflite(model)
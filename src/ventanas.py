@@ -0,0 +1,146 @@
+import os
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+
+# ---------------------------------------------------------------------------------------------------
+# Ventanas deslizantes en memoria por serie (modo online de /detectar)
+# ---------------------------------------------------------------------------------------------------
+# En el modo por defecto (MODO_VENTANA=REDIS) cada /detectar lee las últimas windows_size muestras con
+# TS.REVRANGE (junto con el TS.ADD, en el script de más abajo) y reescala la ventana completa. En el modo
+# online (MODO_VENTANA=ONLINE) cada proceso guarda en un buffer circular las últimas windows_size
+# muestras ya escaladas de cada serie, de forma que en el camino caliente solo se escribe en Redis
+# (TS.ADD) y solo se escala el valor nuevo.
+# El buffer se reconstruye desde Redis la primera vez que se usa una serie (arranque o fallo de caché).
+#
+# IMPORTANTE: el buffer solo ve las mediciones que pasan por este proceso. Si varias réplicas escriben
+# en la misma serie, cada una evaluará con su propia ventana; el modo online está pensado para
+# despliegues donde cada serie la escribe un único proceso.
+
+MODO_VENTANA = os.getenv('MODO_VENTANA', 'REDIS').upper()
+# Número máximo de series con ventana en memoria (se descarta la usada hace más tiempo)
+VENTANA_MAX_SERIES = int(os.getenv('VENTANA_MAX_SERIES', 1000))
+
+
+# ---------------------------------------------------------------------------------------------------
+# Ventana y escritura en una sola llamada (modo REDIS)
+# ---------------------------------------------------------------------------------------------------
+# Un script Lua lee las últimas windows_size muestras de la serie y añade la nueva medición con TS.ADD.
+# Redis ejecuta el script de forma atómica: ninguna otra escritura se cuela entre la lectura y el TS.ADD,
+# así que dos réplicas que detectan a la vez sobre la misma serie ven cada una la ventana real anterior
+# a su medición, y cada /detectar hace un solo viaje de ida y vuelta a Redis en lugar de dos. El script
+# solo toca la serie que recibe en KEYS, por lo que en modo CLUSTER se ejecuta en el maestro de su slot.
+
+SCRIPT_VENTANA = """
+local ventana = redis.call('TS.REVRANGE', KEYS[1], '-', '+', 'COUNT', ARGV[3])
+redis.call('TS.ADD', KEYS[1], ARGV[1], ARGV[2])
+return ventana
+"""
+
+
+def registrar_script(redis):
+    # Carga el script al arrancar (en modo CLUSTER, SCRIPT LOAD va a todos los maestros). El Script de
+    # redis-py lo ejecuta con EVALSHA y lo vuelve a cargar si el servidor no lo conoce, por ejemplo un
+    # maestro nuevo tras un failover de Sentinel
+    script = redis.register_script(SCRIPT_VENTANA)
+    redis.script_load(SCRIPT_VENTANA)
+    return script
+
+
+def anadir_y_leer(script, clave, timestamp, valor, windows_size):
+    # Añade la medición y devuelve la ventana anterior a ella [(time, valor)] en orden cronológico
+    muestras = script(keys=[clave], args=[timestamp, valor, windows_size])
+    # Redis las da al revés cronológicamente
+    return list(reversed(muestras))
+
+
+def funcion_escalado(scaler):
+    # Para un MinMaxScaler la transformación es afín (x * scale_ + min_) y se aplica directamente con
+    # numpy, sin el coste de validación de scaler.transform; para otros escaladores se usa transform
+    if hasattr(scaler, "scale_") and hasattr(scaler, "min_") and hasattr(scaler, "data_range_"):
+        escala, minimo = float(scaler.scale_[0]), float(scaler.min_[0])
+        return lambda valores: np.asarray(valores, dtype=np.float64) * escala + minimo
+    return lambda valores: scaler.transform(np.asarray(valores, dtype=np.float64).reshape(-1, 1)).ravel()
+
+
+class _Ventana:
+    __slots__ = ("muestras", "escalados", "cargada", "cerrojo")
+
+    def __init__(self, windows_size):
+        self.muestras = deque(maxlen=windows_size)
+        self.escalados = deque(maxlen=windows_size)
+        self.cargada = False
+        self.cerrojo = threading.Lock()
+
+
+class CacheVentanas:
+    def __init__(self, windows_size, escalar, max_series=VENTANA_MAX_SERIES):
+        self.windows_size = windows_size
+        self.escalar = escalar
+        self.max_series = max_series
+        self._series = OrderedDict()
+        self._cerrojo = threading.Lock()
+
+    def _ventana(self, clave):
+        with self._cerrojo:
+            ventana = self._series.get(clave)
+            if ventana is not None:
+                self._series.move_to_end(clave)
+                return ventana
+            ventana = _Ventana(self.windows_size)
+            self._series[clave] = ventana
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+            return ventana
+
+    def _cargar(self, redis, clave, ventana):
+        muestras = redis.execute_command('TS.REVRANGE', clave, '-', '+', 'COUNT', self.windows_size) \
+            if redis.exists(clave) else []
+        # Redis las da al revés cronológicamente
+        muestras = [(int(t), float(v)) for t, v in reversed(muestras)]
+        ventana.muestras.extend(muestras)
+        ventana.escalados.extend(self.escalar([v for _, v in muestras]).tolist() if muestras else [])
+        ventana.cargada = True
+
+    def anadir_y_ventana(self, redis, clave, timestamp, valor):
+        # Añade la medición a Redis y devuelve la ventana anterior a ella: (muestras [(time, valor)],
+        # valores escalados como array numpy). Las peticiones a la misma serie se serializan para que
+        # el orden del buffer coincida con el de Redis.
+        ventana = self._ventana(clave)
+        with ventana.cerrojo:
+            try:
+                if not ventana.cargada:
+                    self._cargar(redis, clave, ventana)
+                muestras = list(ventana.muestras)
+                escalados = np.array(ventana.escalados, dtype=np.float64)
+                redis.execute_command('TS.ADD', clave, timestamp, valor)
+            except Exception:
+                # Ante cualquier error no sabemos qué ha llegado a Redis: se descarta la ventana
+                self.invalidar(clave)
+                raise
+            ventana.muestras.append((timestamp, valor))
+            ventana.escalados.append(float(self.escalar([valor])[0]))
+        return muestras, escalados
+
+    def anadir(self, clave, timestamp, valor):
+        # Registra una medición escrita por otra ruta (/nuevo) si la serie ya tiene ventana en memoria
+        with self._cerrojo:
+            ventana = self._series.get(clave)
+        if ventana is None:
+            return
+        with ventana.cerrojo:
+            if not ventana.cargada:
+                return
+            if not ventana.muestras or timestamp > ventana.muestras[-1][0]:
+                ventana.muestras.append((timestamp, valor))
+                ventana.escalados.append(float(self.escalar([valor])[0]))
+            else:
+                self.invalidar(clave)
+
+    def invalidar(self, clave=None):
+        # Descarta la ventana de una serie (o de todas) para que se vuelva a cargar de Redis
+        with self._cerrojo:
+            if clave is None:
+                self._series.clear()
+            else:
+                self._series.pop(clave, None)
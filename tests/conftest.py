@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+# Las aplicaciones y los scripts leen los ficheros del modelo con rutas relativas a la raíz del proyecto
+# ('src/modelo.keras', 'src/config.json'...) e importan los módulos de src/ sin paquete
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO_SRC = os.path.join(RAIZ, "src")
+
+# Las aplicaciones se prueban con el motor NumPy del modelo, sin cargar TensorFlow
+os.environ.setdefault("MODELO_BACKEND", "numpy")
+
+if DIRECTORIO_SRC not in sys.path:
+    sys.path.insert(0, DIRECTORIO_SRC)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def directorio_raiz():
+    anterior = os.getcwd()
+    os.chdir(RAIZ)
+    yield RAIZ
+    os.chdir(anterior)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import fakeredis
+import agregados
+import ingesta
+
+MINUTO = 60000
+HORA = 3600000
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    monkeypatch.setattr(agregados, "FUNCIONES_COMPACTADAS", "avg,min,max,sum,count")
+    cliente = fakeredis.FakeRedis(decode_responses=True)
+    agregados.asegurar_compactaciones(cliente, "mediciones")
+    # Tres horas de mediciones irregulares (varias por minuto) hace un día, ya compactadas por las reglas
+    rng = np.random.default_rng(1)
+    inicio = (int(agregados.time.time() * 1000) - 86400000) // HORA * HORA
+    marcas = np.unique(inicio + rng.integers(0, 3 * HORA, 2000))
+    valores = np.round(rng.normal(20, 5, len(marcas)), 2)
+    ingesta.almacenar_lote(cliente, "mediciones", marcas, valores, {})
+    cliente.inicio = inicio
+    return cliente
+
+
+def _comparar(datos, esperados):
+    assert [t for t, _ in datos] == [t for t, _ in esperados]
+    assert [v for _, v in datos] == pytest.approx([v for _, v in esperados])
+
+
+def _original(redis, funcion, bucket_ms, desde, hasta):
+    datos = redis.execute_command('TS.RANGE', "mediciones", desde, hasta, 'AGGREGATION', funcion, bucket_ms)
+    return [(int(t), float(v)) for t, v in datos]
+
+
+@pytest.mark.parametrize("funcion", ["count", "sum", "min", "max"])
+@pytest.mark.parametrize("bucket_ms", [HORA, 2 * HORA])
+def test_compactada_da_lo_mismo_que_la_serie_original(redis, funcion, bucket_ms):
+    # Con buckets de 1h se lee la compactada de 1h tal cual y con 2h se vuelve a agregar
+    origen, datos = agregados.agregar(redis, "mediciones", funcion, bucket_ms)
+    assert origen == f"{{mediciones}}:{funcion}:1h"
+    _comparar(datos, _original(redis, funcion, bucket_ms, '-', '+'))
+
+
+def test_count_se_lee_de_la_compactada_de_count(redis):
+    origen, datos = agregados.agregar(redis, "mediciones", "count", 2 * HORA)
+    assert origen.startswith("{mediciones}:count:")
+    assert sum(v for _, v in datos) == redis.execute_command('TS.INFO', "mediciones")["totalSamples"]
+
+
+@pytest.mark.parametrize("funcion", ["count", "sum", "min", "max", "avg"])
+@pytest.mark.parametrize("bucket_ms", [MINUTO, HORA])
+def test_rango_que_empieza_y_acaba_a_mitad_de_bucket(redis, funcion, bucket_ms):
+    desde, hasta = redis.inicio + 90 * MINUTO + 12345, redis.inicio + 150 * MINUTO + 6789
+    _, datos = agregados.agregar(redis, "mediciones", funcion, bucket_ms, str(desde), str(hasta))
+    _comparar(datos, _original(redis, funcion, bucket_ms, desde, hasta))
@@ -0,0 +1,142 @@
+import time
+import pytest
+import fakeredis
+import redis.sentinel
+import benchmark
+import replicas
+import series
+
+SENSORES = (None, "s1", "s2")
+
+
+def _olvidar_series():
+    # _aseguradas es del proceso: sin esto una aplicación daría por creadas las series de la anterior
+    for sensor in SENSORES:
+        series.olvidar(series.clave_serie(sensor))
+
+
+def _cargar(nombre, servidor):
+    _olvidar_series()
+    return benchmark.cargar_app(nombre, servidor).app.test_client()
+
+
+def _rellenar(cliente):
+    for i in range(12):
+        assert cliente.get(f"/nuevo?dato={20 + i % 3}").status_code == 200
+        assert cliente.get(f"/nuevo?dato={i}&sensor=s1").status_code == 200
+        time.sleep(0.002)
+
+
+@pytest.fixture(params=["ej2", "ej3"])
+def app(request, monkeypatch):
+    monkeypatch.setenv("MODO_REDIS", "SIMPLE")
+    cliente = _cargar(request.param, fakeredis.FakeServer())
+    _rellenar(cliente)
+    yield cliente
+    _olvidar_series()
+
+
+class FalsoSentinel:
+    # Sentinel que da como maestro y como réplica el mismo servidor de fakeredis. Cada cliente decodifica
+    # las respuestas solo si se le pide, como los de redis-py
+    servidor = None
+
+    def __init__(self, hosts, **kwargs):
+        self.sentinels = [_cliente_sentinel() for _ in hosts]
+
+    def discover_master(self, servicio):
+        return ("maestro", 6379)
+
+    def discover_slaves(self, servicio):
+        return [("replica", 6380)]
+
+    def master_for(self, servicio, **kwargs):
+        return _cliente_sentinel(**kwargs)
+
+
+def _cliente_sentinel(*args, decode_responses=False, **kwargs):
+    return fakeredis.FakeRedis(server=FalsoSentinel.servidor, decode_responses=decode_responses)
+
+
+@pytest.fixture(params=[False, True], ids=["maestro", "replicas"])
+def app_sentinel(request, monkeypatch):
+    FalsoSentinel.servidor = fakeredis.FakeServer()
+    monkeypatch.setenv("MODO_REDIS", "SENTINEL")
+    monkeypatch.setattr(redis.sentinel, "Sentinel", FalsoSentinel)
+    monkeypatch.setattr(replicas, "Redis", _cliente_sentinel)
+    monkeypatch.setattr(replicas, "LECTURA_REPLICAS", request.param)
+    _olvidar_series()
+    modulo = benchmark.cargar_app("ej3", FalsoSentinel.servidor)
+    if request.param:
+        modulo.redis.info = lambda *args: {"master_repl_offset": 1000,
+                                           "slave0": {"ip": "replica", "port": 6380, "state": "online",
+                                                      "offset": 1000, "lag": 0}}
+    cliente = modulo.app.test_client()
+    _rellenar(cliente)
+    yield cliente
+    _olvidar_series()
+
+
+def test_nuevo(app):
+    respuesta = app.get("/nuevo?dato=21.5&sensor=s2")
+    assert respuesta.status_code == 200 and "CORRECTO" in respuesta.get_data(as_text=True)
+    assert app.get("/nuevo?dato=abc").status_code == 400
+
+
+def test_listar(app):
+    respuesta = app.get("/listar?limite=2&formato=json")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()
+    assert [m["valor"] for m in datos["mediciones"]] == [22.0, 21.0]
+    siguiente = app.get(f"/listar?limite=100&formato=json&cursor={datos['cursor']}").get_json()
+    assert len(siguiente["mediciones"]) == 10
+
+
+def test_agregar(app):
+    respuesta = app.get("/agregar?funcion=max&bucket=1m&sensor=s1")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()
+    assert datos["origen"] == "mediciones:{s1}:max:1m"
+    assert max(valor for _, valor in datos["datos"]) == 11.0
+    assert app.get("/agregar?funcion=nada&bucket=1m").status_code == 400
+
+
+def test_mediciones_de_varios_sensores(app):
+    respuesta = app.get("/sensores/mediciones?sensores=principal,s1")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()["sensores"]
+    assert sorted(datos) == ["principal", "s1"] and len(datos["s1"]) == 12
+    # TS.MRANGE con agregación (RESP3 añade un elemento más a cada serie)
+    agregados = app.get("/sensores/mediciones?sensores=s1&funcion=sum&bucket=1d").get_json()["sensores"]
+    assert sum(valor for _, valor in agregados["s1"]) == sum(range(12))
+
+
+def test_detectar(app):
+    normal = app.get("/detectar?dato=21")
+    anomalo = app.get("/detectar?dato=500")
+    assert normal.status_code == anomalo.status_code == 200
+    assert "<b>False</b>" in normal.get_data(as_text=True)
+    assert "<b>True</b>" in anomalo.get_data(as_text=True)
+    assert app.get("/detectar?dato=abc").status_code == 400
+
+
+def test_sentinel(app_sentinel):
+    listado = app_sentinel.get("/listar?limite=2&formato=json")
+    assert listado.status_code == 200 and len(listado.get_json()["mediciones"]) == 2
+    assert app_sentinel.get("/agregar?funcion=avg&bucket=1m").status_code == 200
+    mediciones = app_sentinel.get("/sensores/mediciones?sensores=s1")
+    assert mediciones.status_code == 200 and len(mediciones.get_json()["sensores"]["s1"]) == 12
+    assert app_sentinel.get("/detectar?dato=21").status_code == 200
+
+
+def test_replica_retrasada_en_bytes_no_recibe_lecturas(monkeypatch):
+    FalsoSentinel.servidor = fakeredis.FakeServer()
+    monkeypatch.setattr(replicas, "Redis", _cliente_sentinel)
+    maestro = _cliente_sentinel(decode_responses=True)
+    # 'lag' 0 (confirmó hace nada) pero le faltan 5000 bytes del flujo de replicación
+    maestro.info = lambda *args: {"master_repl_offset": 6000,
+                                  "slave0": {"ip": "replica", "port": 6380, "state": "online",
+                                             "offset": 1000, "lag": 0}}
+    lector = replicas.LectorReplicas(FalsoSentinel([]), "mymaster", maestro, retraso_max_bytes=4096)
+    assert lector.cliente() is maestro
+    assert lector.estado()["retrasos"] == {"replica:6380": {"bytes": 5000, "lag_s": 0}}
@@ -0,0 +1,34 @@
+import os
+import threading
+import pytest
+import arranque
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="necesita fork")
+def test_worker_relanza_las_tareas_pendientes_al_comprobar_el_fork():
+    # La tarea no termina en el padre (como la conexión con Redis antes de que responda); el hijo la
+    # relanza con comprobar_fork, que es lo que hacen el hook post_fork y el before_request de main-ej3.py
+    disponible = threading.Event()
+
+    def conectar():
+        if not disponible.is_set():
+            raise ConnectionError("Redis no responde")
+        return "conectado"
+
+    arranque.tarea("prueba_fork", conectar, reintentar_s=0.05)
+    lectura, escritura = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            disponible.set()
+            arranque.comprobar_fork()
+            resultado = arranque.esperar("prueba_fork", timeout=5)
+            os.write(escritura, resultado.encode())
+        finally:
+            os._exit(0)
+    os.close(escritura)
+    os.waitpid(pid, 0)
+    assert os.read(lectura, 100) == b"conectado"
+    assert arranque.estado()["prueba_fork"]["estado"] == "reintentando"
+    disponible.set()
+    assert arranque.esperar("prueba_fork", timeout=5) == "conectado"
@@ -0,0 +1,84 @@
+import asyncio
+import importlib.util
+import os
+import pytest
+import fakeredis
+import redis
+import arranque
+import detector
+import series
+from conftest import DIRECTORIO_SRC
+
+pytest.importorskip("quart")
+
+
+@pytest.fixture
+def app_async(monkeypatch):
+    servidor = fakeredis.FakeServer()
+    monkeypatch.setenv("MODO_REDIS", "SIMPLE")
+    # Cliente síncrono del registro de modelos (detector.conectar)
+    monkeypatch.setattr(redis, "Redis", lambda *args, **kwargs: fakeredis.FakeRedis(server=servidor,
+                                                                                    decode_responses=True))
+    for sensor in (None, "s1"):
+        series.olvidar(series.clave_serie(sensor))
+    spec = importlib.util.spec_from_file_location("main_ej3_async", os.path.join(DIRECTORIO_SRC, "main-ej3-async.py"))
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    modulo.Redis = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=servidor, decode_responses=True)
+    yield modulo
+    for sensor in (None, "s1"):
+        series.olvidar(series.clave_serie(sensor))
+
+
+def _ejecutar(modulo, prueba):
+    async def principal():
+        async with modulo.app.test_app() as app:
+            for tarea in arranque.estado():
+                await asyncio.to_thread(arranque.esperar, tarea)
+            await prueba(app.test_client(), modulo.redis)
+    asyncio.run(principal())
+
+
+def test_escrituras_compartidas(app_async):
+    async def prueba(cliente, r):
+        assert (await cliente.get("/readyz")).status_code == 200
+        for i in range(12):
+            assert (await cliente.get(f"/nuevo?dato={i}&sensor=s1")).status_code == 200
+            await asyncio.sleep(0.002)
+        # La serie del sensor se crea con sus etiquetas y sus compactaciones (series.pasos_asegurar_sensor)
+        info = await r.execute_command('TS.INFO', 'mediciones:{s1}')
+        assert info["labels"] == [["tipo", "mediciones"], ["sensor", "s1"]] or \
+            info["labels"] == {"tipo": "mediciones", "sensor": "s1"}
+        assert len(info["rules"]) == 9
+        lote = await cliente.post("/nuevo_lote?sensor=s1", json=[[1, 1.0], [1, 2.0], [2, 3.0]])
+        assert (await lote.get_json())["almacenadas"] == 2
+        borrado = await cliente.get("/borrar?sensor=s1&desde=0&hasta=10")
+        assert "Se han borrado 2 mediciones" in await borrado.get_data(as_text=True)
+        assert (await cliente.get("/borrar?sensor=s1")).status_code == 200
+        assert await r.execute_command('TS.RANGE', 'mediciones:{s1}', '-', '+') == []
+        assert len((await r.execute_command('TS.INFO', 'mediciones:{s1}'))["rules"]) == 9
+    _ejecutar(app_async, prueba)
+
+
+def test_detectar(app_async):
+    async def prueba(cliente, r):
+        for i in range(12):
+            await cliente.get(f"/nuevo?dato={20 + i % 3}")
+            await asyncio.sleep(0.002)
+        normal = await (await cliente.get("/detectar?dato=21")).get_data(as_text=True)
+        anomalo = await (await cliente.get("/detectar?dato=500")).get_data(as_text=True)
+        assert "<b>False</b>" in normal and "<b>True</b>" in anomalo
+        estado = await (await cliente.get("/healthz")).get_json()
+        assert estado["estado"]["modelo"]["estado"] == "listo"
+    _ejecutar(app_async, prueba)
+
+
+def test_nuevo_con_deteccion_asincrona(app_async, monkeypatch):
+    monkeypatch.setattr(detector, "DETECCION_ASINCRONA", True)
+
+    async def prueba(cliente, r):
+        assert (await cliente.get("/nuevo?dato=21.5&sensor=s1")).status_code == 200
+        assert [float(v) for _, v in await r.execute_command('TS.RANGE', 'mediciones:{s1}', '-', '+')] == [21.5]
+        encoladas = [campos for _, campos in await r.xrange(detector.DETECCION_STREAM)]
+        assert [(c["sensor"], c["valor"]) for c in encoladas] == [("s1", "21.5")]
+    _ejecutar(app_async, prueba)
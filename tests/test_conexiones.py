@@ -0,0 +1,42 @@
+import os
+import json
+import fakeredis
+from redis import BlockingConnectionPool
+import conexiones
+import metricas
+
+
+def test_buffer_sin_pendientes_no_crea_ficheros(tmp_path):
+    buffer = conexiones.BufferEscrituras(lambda entradas: [], str(tmp_path / "buffer.jsonl"))
+    assert buffer.reenviar_pendientes() == 0
+    assert os.listdir(tmp_path) == []
+
+
+def test_buffer_guarda_las_mediciones_rechazadas(tmp_path):
+    fichero = str(tmp_path / "buffer.jsonl")
+    escritas = []
+
+    def reenviar(entradas):
+        escritas.extend(e for e in entradas if e["time"] != 2000)
+        return [{**e, "error": "TSDB: duplicado"} for e in entradas if e["time"] == 2000]
+
+    buffer = conexiones.BufferEscrituras(reenviar, fichero)
+    with open(fichero, "w") as f:
+        for t in (1000, 2000, 3000):
+            f.write(json.dumps({"sensor": "s1", "time": t, "valor": 1.0}) + "\n")
+    assert buffer.reenviar_pendientes() == 3
+    assert [e["time"] for e in escritas] == [1000, 3000]
+    with open(fichero + ".rechazadas") as f:
+        assert [json.loads(linea) for linea in f] == [{"sensor": "s1", "time": 2000, "valor": 1.0, "error": "TSDB: duplicado"}]
+    estadisticas = buffer.estadisticas()
+    assert (estadisticas["pendientes"], estadisticas["reenviadas"], estadisticas["rechazadas"]) == (0, 2, 1)
+
+
+def test_uso_del_pool_bloqueante():
+    pool = BlockingConnectionPool(max_connections=5, connection_class=fakeredis.FakeConnection,
+                                  server=fakeredis.FakeServer())
+    assert metricas._uso_pool(pool) == (0, 0)
+    a, _ = pool.get_connection(), pool.get_connection()
+    assert metricas._uso_pool(pool) == (2, 0)
+    pool.release(a)
+    assert metricas._uso_pool(pool) == (1, 1)
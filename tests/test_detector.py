@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import fakeredis
+import detector
+import puntuacion
+import series
+
+
+def _predecir(X):
+    # Predice la media de la ventana
+    return X.mean(axis=1)
+
+
+@pytest.fixture
+def redis():
+    cliente = fakeredis.FakeRedis(decode_responses=True)
+    for sensor in ("s1", "s2"):
+        series.olvidar(series.clave_serie(sensor))
+        series.asegurar_sensor(cliente, sensor)
+    yield cliente
+    for sensor in ("s1", "s2"):
+        series.olvidar(series.clave_serie(sensor))
+
+
+def _detector(redis, predecir=_predecir):
+    d = detector.Detector(redis, predecir, lambda valores: np.asarray(valores, dtype=np.float64), 3, 5.0,
+                          nombre="prueba")
+    d.crear_grupo()
+    return d
+
+
+def _encolar(redis, sensor, valores):
+    for i, valor in enumerate(valores):
+        detector.anadir_y_publicar(redis, series.clave_serie(sensor), sensor, 1000 * (i + 1), valor)
+
+
+def test_anadir_y_publicar_escribe_la_serie_y_el_stream(redis):
+    _encolar(redis, "s1", [1.0, 2.0])
+    assert redis.execute_command('TS.RANGE', series.clave_serie("s1"), '-', '+') == [[1000, 1.0], [2000, 2.0]]
+    assert [campos for _, campos in redis.xrange(detector.DETECCION_STREAM)] == [
+        {"sensor": "s1", "time": "1000", "valor": "1.0"}, {"sensor": "s1", "time": "2000", "valor": "2.0"}]
+
+
+def test_procesar_puntua_y_confirma(redis):
+    _encolar(redis, "s1", [1.0, 1.0, 1.0, 1.0, 20.0])
+    d = _detector(redis)
+    d.procesar(d._leer())
+    assert d.procesadas == 5 and d.sin_ventana == 3 and d.anomalias == 1
+    anomalias = redis.execute_command('TS.RANGE', puntuacion.clave_anomalias(series.clave_serie("s1")), '-', '+')
+    assert anomalias == [[4000, 0.0], [5000, 1.0]]
+    assert redis.xpending(detector.DETECCION_STREAM, detector.DETECCION_GRUPO)["pending"] == 0
+
+
+def test_un_sensor_que_falla_no_bloquea_el_resto_y_acaba_en_fallidas(redis, monkeypatch):
+    monkeypatch.setattr(detector, "DETECCION_RECLAMAR_MS", 0)
+    monkeypatch.setattr(detector, "DETECCION_MAX_ENTREGAS", 2)
+    _encolar(redis, "s1", [1.0, 1.0, 1.0, 1.0])
+    _encolar(redis, "s2", [1.0, 999.0, 1.0, 1.0])
+
+    def predecir(X):
+        # Las ventanas de s2 hacen fallar siempre al modelo
+        if (X > 900).any():
+            raise RuntimeError("fallo del modelo")
+        return _predecir(X)
+
+    d = _detector(redis, predecir)
+    d.procesar(d._leer())
+    assert d.procesadas == 4 and d.fallidas == 0
+    assert redis.xpending(detector.DETECCION_STREAM, detector.DETECCION_GRUPO)["pending"] == 4
+    # Segunda entrega (reclamada): llega a DETECCION_MAX_ENTREGAS y pasa a fallidas
+    d.procesar(d._leer())
+    assert d.fallidas == 4
+    assert redis.xpending(detector.DETECCION_STREAM, detector.DETECCION_GRUPO)["pending"] == 0
+    fallidas = [campos for _, campos in redis.xrange(detector.DETECCION_STREAM_FALLIDAS)]
+    assert {f["sensor"] for f in fallidas} == {"s2"} and "fallo del modelo" in fallidas[0]["error"]
+
+
+def test_mensaje_mal_formado_va_directo_a_fallidas(redis):
+    redis.xadd(detector.DETECCION_STREAM, {"sensor": "s1", "time": "no-es-un-numero", "valor": "1"})
+    d = _detector(redis)
+    d.procesar(d._leer())
+    assert d.fallidas == 1
+    assert redis.xpending(detector.DETECCION_STREAM, detector.DETECCION_GRUPO)["pending"] == 0
+    assert "mal formado" in redis.xrange(detector.DETECCION_STREAM_FALLIDAS)[0][1]["error"]
@@ -0,0 +1,39 @@
+import io
+import numpy as np
+import pytest
+import fakeredis
+from flask import Flask
+import exportar
+
+
+@pytest.fixture
+def redis():
+    cliente = fakeredis.FakeRedis(decode_responses=True)
+    for t in range(1, 11):
+        cliente.execute_command('TS.ADD', 'serie', t * 1000, float(t))
+    return cliente
+
+
+def _cuerpo(respuesta):
+    return b"".join(respuesta.response)
+
+
+def test_npy_fija_el_rango_y_se_puede_leer(redis, monkeypatch):
+    monkeypatch.setattr(exportar, "EXPORTAR_TROZO", 3)
+    with Flask(__name__).test_request_context():
+        respuesta = exportar.exportar(redis, 'serie', {"desde": "2500"})
+        # Una medición nueva durante la exportación no cambia el número de registros anunciado
+        redis.execute_command('TS.ADD', 'serie', 20000, 20.0)
+        datos = np.load(io.BytesIO(_cuerpo(respuesta)))
+    assert list(datos["time"]) == [t * 1000 for t in range(3, 11)]
+
+
+def test_npy_falla_si_se_borran_muestras_durante_la_exportacion(redis, monkeypatch):
+    monkeypatch.setattr(exportar, "EXPORTAR_TROZO", 3)
+    with Flask(__name__).test_request_context():
+        respuesta = exportar.exportar(redis, 'serie', {})
+        partes = iter(respuesta.response)
+        next(partes)
+        redis.execute_command('TS.DEL', 'serie', 5000, 10000)
+        with pytest.raises(exportar.ExportacionIncompleta):
+            list(partes)
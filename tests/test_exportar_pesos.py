@@ -0,0 +1,46 @@
+import os
+import importlib.util
+import numpy as np
+import pytest
+from conftest import DIRECTORIO_SRC
+
+keras = pytest.importorskip("keras")
+
+
+def _exportar_pesos():
+    ruta = os.path.join(DIRECTORIO_SRC, "src_p1", "exportar_pesos.py")
+    spec = importlib.util.spec_from_file_location("exportar_pesos", ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+@pytest.fixture(scope="module")
+def exportar_pesos():
+    return _exportar_pesos()
+
+
+@pytest.fixture(scope="module")
+def modelo(exportar_pesos):
+    return keras.models.load_model(exportar_pesos.RUTA_MODELO)
+
+
+def test_pesos_exportados_dan_las_mismas_predicciones(exportar_pesos, modelo, tmp_path):
+    ruta_pesos = str(tmp_path / "modelo_pesos.npz")
+    exportar_pesos.exportar_pesos(modelo, ruta_pesos)
+    assert exportar_pesos.verificar_paridad(modelo, ruta_pesos) <= exportar_pesos.TOLERANCIA
+
+
+def test_pesos_del_repositorio_corresponden_al_modelo(exportar_pesos, modelo):
+    # src/modelo_pesos.npz tiene que volver a exportarse cada vez que se reentrena src/modelo.keras
+    assert exportar_pesos.verificar_paridad(modelo) <= exportar_pesos.TOLERANCIA
+
+
+def test_motor_numpy_coincide_con_keras_en_lotes_de_cualquier_tamano(exportar_pesos, modelo):
+    from inferencia import ModeloNumpy
+    motor = ModeloNumpy(exportar_pesos.RUTA_PESOS)
+    rng = np.random.default_rng(0)
+    for n in (1, 7, 64):
+        X = rng.uniform(0, 1, (n, modelo.input_shape[1], 1)).astype(np.float32)
+        np.testing.assert_allclose(motor.predict_on_batch(X), modelo.predict(X, verbose=0),
+                                   atol=exportar_pesos.TOLERANCIA)
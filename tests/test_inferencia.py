@@ -0,0 +1,43 @@
+import importlib.util
+import pytest
+import inferencia
+
+
+@pytest.fixture
+def ruta_keras(tmp_path):
+    ruta = tmp_path / "modelo.keras"
+    (tmp_path / "modelo_float16.tflite").write_bytes(b"")
+    return str(ruta)
+
+
+def _instalados(monkeypatch, paquetes):
+    # Simula qué paquetes de inferencia están instalados
+    find_spec = importlib.util.find_spec
+
+    def simulado(nombre, *args):
+        if nombre in ("ai_edge_litert", "tflite_runtime", "tensorflow"):
+            return object() if nombre in paquetes else None
+        return find_spec(nombre, *args)
+
+    monkeypatch.setattr(importlib.util, "find_spec", simulado)
+
+
+@pytest.mark.parametrize("paquetes, esperado", [
+    ({"tensorflow"}, "keras"),
+    ({"tflite_runtime"}, "numpy"),
+    (set(), "numpy"),
+    ({"ai_edge_litert", "tensorflow"}, "tflite-float16"),
+])
+def test_auto_solo_usa_tflite_con_ai_edge_litert(monkeypatch, ruta_keras, paquetes, esperado):
+    _instalados(monkeypatch, paquetes)
+    assert inferencia.elegir_backend(ruta_keras, 'auto') == esperado
+
+
+def test_auto_sin_modelo_tflite_no_usa_tflite(monkeypatch, tmp_path):
+    _instalados(monkeypatch, {"ai_edge_litert"})
+    assert inferencia.elegir_backend(str(tmp_path / "modelo.keras"), 'auto') == "numpy"
+
+
+def test_backend_explicito(monkeypatch, ruta_keras):
+    _instalados(monkeypatch, {"tensorflow"})
+    assert inferencia.elegir_backend(ruta_keras, 'tflite-int8') == "tflite-int8"
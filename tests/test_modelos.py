@@ -0,0 +1,46 @@
+import os
+import shutil
+import time
+import fakeredis
+import modelos
+from conftest import DIRECTORIO_SRC
+
+
+def _version(directorio, sensor, version):
+    ruta = os.path.join(directorio, sensor, version)
+    os.makedirs(ruta)
+    for fichero in ("modelo_pesos.npz", "scaler.pkl", "config.json"):
+        shutil.copy(os.path.join(DIRECTORIO_SRC, fichero), ruta)
+    return ruta
+
+
+def _falso_cargar(directorio, sensor, version):
+    return modelos.VersionModelo(sensor, version, None, None, 1.0, 10, tam=1)
+
+
+def test_cargar_version_mide_la_memoria(tmp_path):
+    ruta = _version(str(tmp_path), "s1", "v1")
+    modelo = modelos.cargar_version(ruta, "s1", "v1", backend="numpy")
+    ficheros = os.path.getsize(os.path.join(ruta, "modelo_pesos.npz")) + os.path.getsize(os.path.join(ruta, "scaler.pkl"))
+    assert modelo.tam >= ficheros
+    assert modelo.predecir is not None and modelo.windows_size > 0
+
+
+def test_el_registro_se_refresca_en_segundo_plano(tmp_path):
+    directorio = str(tmp_path)
+    _version(directorio, "s1", "v1")
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    registro = modelos.RegistroModelos(redis, directorio=directorio, refresco_s=1, cargar=_falso_cargar)
+    # La primera lectura se hace en la petición
+    assert registro.version_activa("s1") == "v1"
+    refrescado = registro._refrescado
+    _version(directorio, "s1", "v2")
+    redis.hset(modelos.MODELOS_CLAVE_ACTIVOS, "s2", "x")
+    # Las siguientes no leen el directorio: hasta que refresca el hilo se sigue con lo leído
+    assert registro.version_activa("s1") == "v1"
+    limite = time.monotonic() + 5
+    while registro._refrescado == refrescado and time.monotonic() < limite:
+        time.sleep(0.05)
+    assert registro.version_activa("s1") == "v2"
+    assert registro.obtener("s1").version == "v2"
+    assert registro.estado()["activas"] == {"s2": "x"}
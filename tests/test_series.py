@@ -0,0 +1,56 @@
+import pytest
+import fakeredis
+import series
+
+
+@pytest.fixture(params=[2, 3], ids=["resp2", "resp3"])
+def redis(request):
+    cliente = fakeredis.FakeRedis(decode_responses=True, protocol=request.param)
+    for sensor, valores in (("s1", [1.0, 2.0, 3.0]), ("s2", [10.0, 20.0])):
+        clave = series.clave_serie(sensor)
+        series.olvidar(clave)
+        series.asegurar_sensor(cliente, sensor)
+        for i, valor in enumerate(valores):
+            cliente.execute_command('TS.ADD', clave, 1000 * (i + 1), valor)
+    yield cliente
+    for sensor in ("s1", "s2"):
+        series.olvidar(series.clave_serie(sensor))
+
+
+def test_como_lista_admite_las_respuestas_de_resp2_y_resp3():
+    etiquetas, muestras = [['sensor', 's1']], [[1000, '1']]
+    esperado = [['a', etiquetas, muestras]]
+    assert series._como_lista([['a', etiquetas, muestras]]) == esperado
+    assert series._como_lista({'a': [etiquetas, muestras]}) == esperado
+    assert series._como_lista({'a': [etiquetas, {'aggregators': []}, muestras]}) == esperado
+
+
+def test_ultimos_valores(redis):
+    ultimos = series.ultimos_valores(redis)
+    assert [(u["sensor"], u["clave"], u["time"], u["valor"]) for u in ultimos] == [
+        ("s1", "mediciones:{s1}", 3000, 3.0), ("s2", "mediciones:{s2}", 2000, 20.0)]
+
+
+def test_rango_sensores(redis):
+    assert series.rango_sensores(redis) == {"s1": [(1000, 1.0), (2000, 2.0), (3000, 3.0)],
+                                            "s2": [(1000, 10.0), (2000, 20.0)]}
+    assert series.rango_sensores(redis, sensores=["s2"], funcion="sum", bucket_ms=10000) == {"s2": [(0, 30.0)]}
+
+
+def test_filtro_rechaza_sensores_invalidos(redis):
+    with pytest.raises(series.ParametroInvalido):
+        series.rango_sensores(redis, sensores=["a b"])
+
+
+def test_recrear_deja_la_serie_vacia_con_etiquetas_y_reglas(redis):
+    import agregados
+    clave = series.clave_serie("s1")
+    redis.unlink(clave, *agregados.claves_compactadas(clave))
+    # Otro worker que aún la da por creada escribe antes de que se recree: TS.ADD la crea sin etiquetas
+    redis.execute_command('TS.ADD', clave, 5000, 1.0)
+    series.recrear(redis, "s1")
+    info = redis.execute_command('TS.INFO', clave)
+    etiquetas = info["labels"] if isinstance(info, dict) else dict(info[info.index("labels") + 1])
+    assert series._etiquetas_a_dict(etiquetas) == {"tipo": "mediciones", "sensor": "s1"}
+    assert all(redis.exists(destino) for destino in agregados.claves_compactadas(clave))
+    assert [u["sensor"] for u in series.ultimos_valores(redis)] == ["s1", "s2"]